@@ -0,0 +1,169 @@
+import heapq
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, List, Optional, Sequence, Tuple
+
+from config import Config
+from metrics import counter, gauge
+from logger import get_logger
+
+log = get_logger("ami.admission")
+
+# Уровни приоритета запросов на ответ (меньше - важнее)
+TIER_PRIVATE = 0  # личные чаты
+TIER_REPLY = 1    # ответы на сообщения бота
+TIER_MENTION = 2  # упоминание бота в группе
+TIER_RANDOM = 3   # случайный ответ без обращения
+TIER_NAMES = {TIER_PRIVATE: "private", TIER_REPLY: "reply", TIER_MENTION: "mention", TIER_RANDOM: "random"}
+
+ADMIT = "admit"
+DEFER = "defer"
+SHED = "shed"
+
+ADMISSION_DECISIONS = counter("ami_admission_decisions_total", "Решения по запросам на ответ", ("tier", "verdict"))
+
+
+class AdmissionController:
+    """
+    Контроль допуска запросов к LLM по текущей нагрузке.
+
+    Нагрузка - максимум из трех отношений: запросы в работе вместе с ждущими свободного
+    потока (backlog) к max_inflight, очередь отправки к max_queue и EWMA длительности
+    ответа к latency_target. При нагрузке
+    выше random_from случайные ответы становятся реже и к 1.0 прекращаются совсем.
+    Для каждого уровня задан порог, выше которого запрос откладывается (defer_at)
+    или отбрасывается (shed_at); личные чаты не отбрасываются никогда.
+
+    Отложенные запросы ждут в куче сроков одного потока-планировщика и по сроку
+    передаются в execute (по умолчанию выполняются в самом планировщике).
+    """
+
+    # {уровень: (defer_at, shed_at)}
+    THRESHOLDS = {
+        TIER_PRIVATE: (float("inf"), float("inf")),
+        TIER_REPLY: (1.5, float("inf")),
+        TIER_MENTION: (1.0, 2.0),
+        TIER_RANDOM: (0.8, 0.8),
+    }
+
+    def __init__(self, max_inflight: int = 32, max_queue: int = 200, latency_target: float = 15.0,
+                 queue_depth: Optional[Callable[[], int]] = None, backlog: Optional[Callable[[], int]] = None,
+                 execute: Optional[Callable[[Callable[[], None]], None]] = None, random_from: float = 0.5,
+                 defer_delay: float = 5.0, max_defer_attempts: int = 3, max_deferred: int = 500,
+                 alpha: float = 0.2):
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.latency_target = latency_target
+        self.queue_depth = queue_depth or (lambda: 0)
+        self.backlog = backlog or (lambda: 0)
+        self.execute = execute or (lambda fn: fn())
+        self.random_from = random_from
+        self.defer_delay = defer_delay
+        self.max_defer_attempts = max_defer_attempts
+        self.max_deferred = max_deferred
+        self.alpha = alpha
+        self.inflight = 0
+        self.deferred = 0
+        self.latency = 0.0
+        self._latency_at = time.monotonic()
+        self._lock = threading.Lock()
+        # (срок, номер, fn) отложенных запросов; поток-планировщик запускается при первом defer()
+        self._timers: List[Tuple[float, int, Callable[[], None]]] = []
+        self._timers_seq = 0
+        self._timers_cond = threading.Condition(self._lock)
+        self._scheduler: Optional[threading.Thread] = None
+        gauge("ami_admission_load", "Текущая нагрузка (1.0 - на пределе)", fn=self.load)
+        gauge("ami_admission_inflight", "Запросы на ответ в работе", fn=lambda: self.inflight)
+        gauge("ami_admission_deferred", "Отложенные запросы на ответ", fn=lambda: self.deferred)
+        gauge("ami_random_reply_chance", "Текущая вероятность случайного ответа",
+              fn=lambda: self.random_reply_chance(1.0))
+
+    def load(self) -> float:
+        return max(
+            (self.inflight + self.backlog()) / self.max_inflight,
+            self.queue_depth() / self.max_queue,
+            self.current_latency() / self.latency_target,
+        )
+
+    def current_latency(self) -> float:
+        # Без новых замеров оценка затухает вдвое за каждые latency_target секунд,
+        # иначе после всплеска задержки упоминания откладывались бы бесконечно
+        idle = time.monotonic() - self._latency_at
+        return self.latency * 0.5 ** (idle / self.latency_target)
+
+    def random_reply_chance(self, base: float) -> float:
+        """Базовая вероятность, линейно уменьшенная до нуля между random_from и 1.0"""
+        load = self.load()
+        if load <= self.random_from:
+            return base
+        return base * max(0.0, (1.0 - load) / (1.0 - self.random_from))
+
+    @staticmethod
+    def classify(message, mention_keywords: Sequence[str]) -> int:
+        if message.chat.type == "private":
+            return TIER_PRIVATE
+        reply = message.reply_to_message
+        if reply and reply.from_user and reply.from_user.id == Config.BOT_ID:
+            return TIER_REPLY
+        text = (message.text or "").lower()
+        if any(keyword in text for keyword in mention_keywords):
+            return TIER_MENTION
+        return TIER_RANDOM
+
+    def decide(self, tier: int, attempt: int = 0) -> str:
+        load = self.load()
+        defer_at, shed_at = self.THRESHOLDS[tier]
+        if load < defer_at:
+            verdict = ADMIT
+        elif load >= shed_at or attempt >= self.max_defer_attempts or self.deferred >= self.max_deferred:
+            verdict = SHED
+        else:
+            verdict = DEFER
+        ADMISSION_DECISIONS.labels(TIER_NAMES[tier], verdict).inc()
+        if verdict != ADMIT:
+            log.info("admission", tier=TIER_NAMES[tier], verdict=verdict, load=round(load, 2), attempt=attempt)
+        return verdict
+
+    def defer(self, fn: Callable[[], None]) -> None:
+        """Повторяет fn через defer_delay секунд"""
+        with self._timers_cond:
+            self.deferred += 1
+            self._timers_seq += 1
+            heapq.heappush(self._timers, (time.monotonic() + self.defer_delay, self._timers_seq, fn))
+            if self._scheduler is None:
+                self._scheduler = threading.Thread(target=self._run_deferred, name="admission-defer", daemon=True)
+                self._scheduler.start()
+            self._timers_cond.notify()
+
+    def _run_deferred(self) -> None:
+        while True:
+            with self._timers_cond:
+                while not self._timers:
+                    self._timers_cond.wait()
+                due = self._timers[0][0]
+                now = time.monotonic()
+                if due > now:
+                    self._timers_cond.wait(due - now)
+                    continue
+                _, _, fn = heapq.heappop(self._timers)
+                self.deferred -= 1
+            try:
+                self.execute(fn)
+            except Exception as e:
+                log.exception("admission_deferred_failed", error=e)
+
+    @contextmanager
+    def track(self):
+        """Учитывает запрос в работе и его длительность"""
+        with self._lock:
+            self.inflight += 1
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            with self._lock:
+                self.inflight -= 1
+                self.latency = self.alpha * elapsed + (1 - self.alpha) * self.current_latency()
+                self._latency_at = time.monotonic()
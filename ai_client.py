@@ -1,23 +1,45 @@
-from gradio_client import Client
-from typing import List, Tuple
+import threading
+from typing import List, Optional, Tuple
 from config import Config
+from metrics import timed
+from logger import get_logger
+from llm_router import GradioBackend, LLMRouter
+from singleflight import SingleFlight
+
+log = get_logger("ami.llm")
 class AIClient:
-    def __init__(self, model_name: str):
-        self.client = Client(model_name)
+    def __init__(self, model_name: Optional[str] = None, router: Optional[LLMRouter] = None):
+        # Фасад над маршрутизатором бэкендов; имя Space сохраняет старый способ создания клиента
+        if router is None:
+            if model_name is None:
+                raise ValueError("Нужно указать model_name или router")
+            router = LLMRouter([GradioBackend(model_name, params={"radio": "32B"})], hedge=False)
+        self.router = router
         self.history: List[List[str]] = []
         self.system_prompt = Config.SYSTEM_PROMPT
         self.max_history = 10
+        # Одинаковые одновременные промпты (например, вирусное сообщение в группе) идут в модель один раз
+        self._inflight = SingleFlight("llm")
+
+    def warm_up(self) -> threading.Thread:
+        """Подключается к бэкендам и задает системный промпт в фоновом потоке"""
+        def run():
+            try:
+                self.call_in_start()
+            except Exception as e:
+                log.error("llm_warm_up_failed", error=e)
+
+        thread = threading.Thread(target=run, name="llm-warm-up", daemon=True)
+        thread.start()
+        return thread
 
+    @timed("llm")
     def get_response(self, query: str) -> str:
-        result = self.client.predict(
-            query=query,
-            history=self.history,
-            system=self.system_prompt,
-            radio="32B",
-            api_name="/model_chat"
-        )
-        
-        reply = result[1][-1][1]
+        return self._inflight.do((query, self.system_prompt), self._complete, query)
+
+    def _complete(self, query: str) -> str:
+        reply = self.router.complete(query, self.history, self.system_prompt)
+        log.debug("llm_response", prompt=query, reply=reply)
         self.update_history(query, reply)
         return reply
         
@@ -35,7 +57,9 @@ class AIClient:
       return self.history
             
     def call_in_start(self) -> None:
-      result = self.client.predict(
-      		system = Config.SYSTEM_PROMPT,
-      		api_name="/modify_system_session"
-      )
\ No newline at end of file
+      self.router.warm_up(Config.SYSTEM_PROMPT)
+      self.router.start_health_checks()
+
+    def close(self) -> None:
+        """Закрывает соединения с бэкендами при остановке"""
+        self.router.close()
\ No newline at end of file
@@ -0,0 +1,424 @@
+"""
+Микробенчмарки CPU-горячих путей бота с JSON-отчетом и сравнением с базовой линией.
+
+Примеры:
+    python benchmarks.py                                  # все бенчмарки, вывод в консоль
+    python benchmarks.py --output bench_data/result.json
+    python benchmarks.py --save-baseline                  # записать bench_data/baseline.json
+    python benchmarks.py --compare --threshold 0.25       # код выхода 1 при регрессии > 25%
+    python benchmarks.py --filter context --large         # ContextManager вплоть до 1M записей
+    python benchmarks.py --filter context.load            # снапшот против pickle
+    python benchmarks.py --filter startup                 # холодный импорт модулей при запуске
+"""
+import argparse
+import json
+import os
+import pickle
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional
+from unittest import mock
+
+BENCH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_data")
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, "baseline.json")
+
+SAMPLE_TEXTS = [
+    "Я очень счастлив сегодня, всё отлично!",
+    "Это был ужасный день, всё пошло не так.",
+    "Сегодня обычный день, ничего особенного.",
+    "Не хочу больше видеть этот ужасный фильм.",
+    "ами, найди картинку с котиком и озвучь что-нибудь доброе",
+]
+
+# Каждая фабрика возвращает функцию без аргументов, время которой измеряется
+BENCHMARKS: Dict[str, Callable[[argparse.Namespace], Callable[[], object]]] = {}
+
+# Временные каталоги текущего бенчмарка, удаляются после его замера
+_TEMP_DIRS: List[tempfile.TemporaryDirectory] = []
+
+
+def _temp_dir() -> str:
+    temp_dir = tempfile.TemporaryDirectory(prefix="ami-bench-")
+    _TEMP_DIRS.append(temp_dir)
+    return temp_dir.name
+
+
+def _cleanup_temp_dirs() -> None:
+    while _TEMP_DIRS:
+        _TEMP_DIRS.pop().cleanup()
+
+
+def benchmark(name: str):
+    def register(factory):
+        BENCHMARKS[name] = factory
+        return factory
+    return register
+
+
+def measure(fn: Callable[[], object], rounds: int = 5, min_time: float = 0.2) -> dict:
+    """Подбирает число повторов так, чтобы раунд длился не меньше min_time, и возвращает время вызова"""
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or number >= 1 << 20:
+            break
+        number *= 2 if elapsed == 0 else max(2, int(min_time / elapsed * 1.2))
+
+    timings = [elapsed / number]
+    for _ in range(rounds - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        timings.append((time.perf_counter() - start) / number)
+    return {
+        "min_us": round(min(timings) * 1e6, 3),
+        "median_us": round(statistics.median(timings) * 1e6, 3),
+        "loops": number,
+        "rounds": rounds,
+    }
+
+
+# --- sentimental.py ---
+
+@benchmark("sentiment.classify")
+def _sentiment_classify(args):
+    from sentimental import SentimentClassifier
+    classifier = SentimentClassifier()
+    return lambda: [classifier.classify(text) for text in SAMPLE_TEXTS]
+
+
+@benchmark("sentiment.get_sentiment_details")
+def _sentiment_details(args):
+    from sentimental import SentimentClassifier
+    classifier = SentimentClassifier()
+    return lambda: [classifier.get_sentiment_details(text) for text in SAMPLE_TEXTS]
+
+
+# --- main.py: ResponseTriggerManager ---
+
+def _fake_message(text: str, chat_type: str = "supergroup") -> SimpleNamespace:
+    return SimpleNamespace(
+        text=text,
+        chat=SimpleNamespace(id=-100, type=chat_type),
+        reply_to_message=None,
+        from_user=SimpleNamespace(id=1),
+    )
+
+
+@benchmark("triggers.should_reply")
+def _should_reply(args):
+    from main import ResponseTriggerManager
+    manager = ResponseTriggerManager()
+    messages = [_fake_message(text) for text in SAMPLE_TEXTS]
+    return lambda: [manager.should_reply(message) for message in messages]
+
+
+@benchmark("triggers.get_action_type")
+def _get_action_type(args):
+    from main import ResponseTriggerManager
+    manager = ResponseTriggerManager()
+    messages = [_fake_message(text) for text in SAMPLE_TEXTS]
+    return lambda: [manager.get_action_type(message) for message in messages]
+
+
+# --- find_data.py ---
+
+def _fixture(name: str) -> str:
+    with open(os.path.join(BENCH_DIR, name), "r", encoding="utf-8") as f:
+        return f.read()
+
+
+@benchmark("scraper.clean_text")
+def _clean_text(args):
+    from find_data import GoogleScraper
+    scraper = GoogleScraper()
+    html = _fixture("article.html")
+    return lambda: scraper.clean_text(html)
+
+
+@benchmark("scraper.is_valid_content")
+def _is_valid_content(args):
+    from find_data import GoogleScraper
+    scraper = GoogleScraper()
+    paragraphs = [p for p in _fixture("article.html").split("\n") if p.strip()]
+    return lambda: [scraper.is_valid_content(p) for p in paragraphs]
+
+
+@benchmark("scraper.extract_content")
+def _extract_content(args):
+    import find_data
+    scraper = find_data.GoogleScraper()
+    html = _fixture("article.html")
+    response = SimpleNamespace(text=html, url="https://example.com/mars", raise_for_status=lambda: None)
+
+    def run():
+        # Сеть подменяется сохраненной страницей только на время вызова: измеряется разбор HTML
+        with mock.patch.object(find_data.requests, "get", return_value=response):
+            return scraper.extract_content("https://example.com/mars")
+    return run
+
+
+# --- context.py ---
+
+def _filled_context_manager(entries: int):
+    from context import ContextManager
+    storage = os.path.join(_temp_dir(), "context_storage.bin")
+    manager = ContextManager(storage)
+    now = time.time()
+    manager.context_cache = {
+        f"{-1000 - i % 500}:{i}": [{"text": SAMPLE_TEXTS[i % len(SAMPLE_TEXTS)], "timestamp": now}]
+        for i in range(entries)
+    }
+    manager.max_contexts = entries * 2
+    return manager
+
+
+def _context_sizes(args) -> List[int]:
+    return [10_000, 100_000, 1_000_000] if args.large else [10_000, 100_000]
+
+
+def _register_context_benchmarks():
+    from context import MessageContext
+
+    for size in (10_000, 100_000, 1_000_000):
+        def update_factory(args, size=size):
+            manager = _filled_context_manager(size)
+            counter = iter(range(10 ** 9))
+
+            def run():
+                i = next(counter)
+                manager.update_context(MessageContext(
+                    text=SAMPLE_TEXTS[i % len(SAMPLE_TEXTS)], user_id=i % size, username="u",
+                    first_name="U", chat_id=-1000 - i % 500, chat_type="supergroup", message_id=i
+                ))
+            return run
+
+        def cleanup_factory(args, size=size):
+            manager = _filled_context_manager(size)
+            return manager.cleanup_old_contexts
+
+        def save_factory(args, size=size):
+            manager = _filled_context_manager(size)
+            contexts = dict(manager.context_cache)
+
+            def run():
+                # Сохранение вытесняет контексты в снапшот: каждый раз кодируются все заново
+                manager.context_cache = dict(contexts)
+                manager._pending = {}
+                manager._save_contexts()
+            return run
+
+        def load_factory(args, size=size):
+            manager = _filled_context_manager(size)
+            manager._save_contexts()
+
+            def run():
+                # Загрузка в пустой менеджер, как при старте: читается только индекс
+                manager.context_cache = {}
+                manager._load_contexts()
+            return run
+
+        def load_all_factory(args, size=size):
+            manager = _filled_context_manager(size)
+            manager._save_contexts()
+
+            def run():
+                # Загрузка с последующим декодированием каждого диалога
+                manager.context_cache = {}
+                manager._load_contexts()
+                for key in list(manager._pending):
+                    manager.get_user_context(*map(int, key.split(":")))
+            return run
+
+        def save_touched_factory(args, size=size):
+            manager = _filled_context_manager(size)
+            manager._save_contexts()
+            manager.context_cache = {}
+            manager._load_contexts()
+            keys = [tuple(map(int, key.split(":"))) for key in list(manager._pending)[::100]]
+
+            def run():
+                # Типичное сохранение: декодирован 1% диалогов, остальные копируются из снапшота
+                for key in keys:
+                    manager.get_user_context(*key)
+                manager._save_contexts()
+            return run
+
+        # Прежний формат хранения: весь словарь контекстов одним pickle
+        def save_pickle_factory(args, size=size):
+            manager = _filled_context_manager(size)
+
+            def run():
+                with open(manager.storage_file, 'wb') as f:
+                    pickle.dump(manager.context_cache, f)
+            return run
+
+        def load_pickle_factory(args, size=size):
+            manager = _filled_context_manager(size)
+            with open(manager.storage_file, 'wb') as f:
+                pickle.dump(manager.context_cache, f)
+
+            def run():
+                with open(manager.storage_file, 'rb') as f:
+                    return pickle.load(f)
+            return run
+
+        for kind, factory in (("update_context", update_factory), ("cleanup_old_contexts", cleanup_factory),
+                              ("save", save_factory), ("save_touched", save_touched_factory),
+                              ("load", load_factory), ("load_all", load_all_factory),
+                              ("save_pickle", save_pickle_factory), ("load_pickle", load_pickle_factory)):
+            factory.size = size
+            benchmark(f"context.{kind}[{size}]")(factory)
+
+
+try:
+    _register_context_benchmarks()
+except ImportError:
+    pass
+
+
+# --- ai_client.py ---
+
+@benchmark("ai_client.escape_markdown")
+def _escape_markdown(args):
+    from ai_client import AIClient
+    text = "*Жирный* _курсив_ [ссылка](https://example.com) `код` - пункт! #тег " * 10
+    return lambda: AIClient.escape_markdown(None, text)
+
+
+# --- t.py ---
+
+@benchmark("pseudocode.execute_command")
+def _execute_command(args):
+    from t import PseudoCodeParser
+    ok = {"status": "success"}
+    browser = SimpleNamespace(
+        navigate=lambda url: ok, search=lambda q, engine: ok, store_value=lambda n, v: ok,
+        fill_form=lambda data: ok, get_value=lambda n: ok, wait=lambda s: ok,
+    )
+    parser = PseudoCodeParser(browser)
+    commands = [
+        'go("example.com")',
+        'search("актуальные новости, погода", "google")',
+        "store('key', 'значение, с запятой')",
+        'fill("q", "поиск")',
+        'get("key")',
+    ]
+    return lambda: [parser.execute_command(command) for command in commands]
+
+
+# --- запуск бота ---
+
+def _import_in_subprocess(module: str) -> Callable[[], object]:
+    """Время холодного импорта модуля в новом интерпретаторе"""
+    import subprocess
+    command = [sys.executable, "-c", f"import {module}"]
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    probe = subprocess.run(command, cwd=cwd, capture_output=True, text=True)
+    if probe.returncode != 0:
+        raise ImportError(probe.stderr.strip().splitlines()[-1])
+    return lambda: subprocess.run(command, cwd=cwd, check=True)
+
+
+@benchmark("startup.import_main")
+def _startup_import_main(args):
+    return _import_in_subprocess("main")
+
+
+@benchmark("startup.import_find_data")
+def _startup_import_find_data(args):
+    return _import_in_subprocess("find_data")
+
+
+def run_benchmarks(args) -> dict:
+    results = {}
+    for name, factory in BENCHMARKS.items():
+        if args.filter and args.filter not in name:
+            continue
+        size = getattr(factory, "size", 0)
+        if size > max(_context_sizes(args)):
+            continue
+        try:
+            try:
+                fn = factory(args)
+            except ImportError as e:
+                results[name] = {"skipped": f"нет зависимости: {e}"}
+                print(f"{name:45s} пропущен ({e})")
+                continue
+            # Тяжелые бенчмарки на больших хранилищах выполняются меньшее число раз
+            rounds = 3 if size >= 100_000 else args.rounds
+            results[name] = measure(fn, rounds=rounds, min_time=args.min_time)
+        finally:
+            _cleanup_temp_dirs()
+        print(f"{name:45s} {results[name]['median_us']:>14.3f} мкс")
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+    }
+
+
+def compare(report: dict, baseline: dict, threshold: float) -> List[str]:
+    """Возвращает список бенчмарков, замедлившихся относительно базовой линии больше порога"""
+    regressions = []
+    for name, result in report["results"].items():
+        base = baseline.get("results", {}).get(name)
+        if not base or "median_us" not in base or "median_us" not in result:
+            continue
+        ratio = result["median_us"] / base["median_us"] if base["median_us"] else 1.0
+        marker = ""
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            marker = "  <-- РЕГРЕССИЯ"
+        print(f"{name:45s} {base['median_us']:>12.3f} -> {result['median_us']:>12.3f} мкс ({ratio:.2f}x){marker}")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Микробенчмарки горячих путей бота")
+    parser.add_argument("--filter", help="запускать только бенчмарки, содержащие подстроку")
+    parser.add_argument("--large", action="store_true", help="включить хранилища контекста на 1M записей")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2, help="минимальная длительность раунда, с")
+    parser.add_argument("--output", help="записать отчет в JSON")
+    parser.add_argument("--save-baseline", nargs="?", const=DEFAULT_BASELINE, help="сохранить отчет как базовую линию")
+    parser.add_argument("--compare", nargs="?", const=DEFAULT_BASELINE, help="сравнить с базовой линией")
+    parser.add_argument("--threshold", type=float, default=0.2, help="допустимое замедление (0.2 = 20%%)")
+    args = parser.parse_args(argv)
+
+    if args.compare and not os.path.exists(args.compare):
+        print(f"Нет базовой линии {args.compare}: сначала запустите python benchmarks.py --save-baseline")
+        return 2
+
+    random.seed(1)
+    report = run_benchmarks(args)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        print("\nСравнение с базовой линией:")
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print(f"\nРегрессии: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
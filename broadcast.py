@@ -0,0 +1,155 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, Optional
+
+from telebot.apihelper import ApiTelegramException
+
+from outbox import OutboundScheduler, PRIORITY_LOW
+from rate_limiter import TokenBucket
+from state_store import StateStore
+from logger import get_logger
+
+log = get_logger("ami.broadcast")
+
+# Описания ошибок 400, означающие, что чата для бота больше нет; остальные 400
+# (слишком длинный текст, ошибка разметки) относятся к самой рассылке
+GONE_CHAT_ERRORS = (
+    "chat not found", "group chat was deactivated", "group chat was upgraded",
+    "user is deactivated", "bot was kicked", "peer_id_invalid",
+)
+
+
+def is_chat_gone(error: ApiTelegramException) -> bool:
+    """Бот заблокирован, исключен из чата или чат удален"""
+    if error.error_code == 403:
+        return True
+    description = (getattr(error, "description", None) or str(error)).lower()
+    return error.error_code == 400 and any(marker in description for marker in GONE_CHAT_ERRORS)
+
+
+class BroadcastJob:
+    """Состояние одной рассылки"""
+
+    def __init__(self, text: str, recipients: List[int]):
+        self.text = text
+        self.recipients = recipients
+        self.sent = 0
+        self.failed = 0
+        self.started_at = time.time()
+        self.finished_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @property
+    def done(self) -> int:
+        return self.sent + self.failed
+
+    def record(self, ok: bool) -> None:
+        with self._lock:
+            if ok:
+                self.sent += 1
+            else:
+                self.failed += 1
+
+    def progress_text(self) -> str:
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        state = "Рассылка завершена" if self.finished_at else "Идет рассылка"
+        return (
+            f"{state}: {self.done}/{len(self.recipients)}\n"
+            f"Отправлено: {self.sent}, ошибок: {self.failed}\n"
+            f"Прошло: {int(elapsed)} с"
+        )
+
+
+class BroadcastManager:
+    """
+    Фоновая рассылка сообщений по всем известным чатам.
+
+    Сообщения отправляются через OutboundScheduler с низким приоритетом, поэтому
+    обычные ответы обгоняют рассылку в общем лимите Telegram ~30/с. Собственный
+    token bucket (по умолчанию 20 сообщений/с) ограничивает долю рассылки,
+    повторы после 429 выполняет планировщик. Прогресс периодически
+    обновляется в сообщении администратору.
+    """
+
+    PROGRESS_INTERVAL = 5
+
+    def __init__(self, bot, outbox: OutboundScheduler, state: StateStore,
+                 rate: float = 20, workers: int = 8):
+        self.bot = bot
+        self.outbox = outbox
+        self.state = state
+        self.bucket = TokenBucket(rate)
+        self.workers = workers
+        self.current_job: Optional[BroadcastJob] = None
+        self._lock = threading.Lock()
+
+    def is_running(self) -> bool:
+        job = self.current_job
+        return job is not None and job.finished_at is None
+
+    def start(self, text: str, recipients: Iterable[int], admin_chat_id: int,
+              reply_to_message_id: Optional[int] = None) -> Optional[BroadcastJob]:
+        """Запускает рассылку в фоне; возвращает None, если рассылка уже идет"""
+        with self._lock:
+            if self.is_running():
+                return None
+            job = BroadcastJob(text, list(recipients))
+            self.current_job = job
+
+        thread = threading.Thread(
+            target=self._run, args=(job, admin_chat_id, reply_to_message_id), daemon=True
+        )
+        thread.start()
+        return job
+
+    def _send(self, job: BroadcastJob, chat_id: int) -> bool:
+        """Отправляет сообщение в один чат и ждет результата"""
+        self.bucket.acquire()
+        try:
+            self.outbox.send_message(chat_id, job.text, priority=PRIORITY_LOW).result()
+            return True
+        except ApiTelegramException as e:
+            if is_chat_gone(e):
+                self.state.forget(chat_id)
+            log.info("broadcast_send_failed", chat_id=chat_id, error=e)
+            return False
+        except Exception as e:
+            log.info("broadcast_send_failed", chat_id=chat_id, error=e)
+            return False
+
+    def _report(self, job: BroadcastJob, admin_chat_id: int, status_message_id: Optional[int]) -> None:
+        try:
+            if status_message_id is not None:
+                self.outbox.submit(
+                    admin_chat_id, "edit_message_text", job.progress_text(), admin_chat_id, status_message_id
+                )
+        except Exception as e:
+            log.warning("broadcast_progress_failed", error=e)
+
+    def _run(self, job: BroadcastJob, admin_chat_id: int, reply_to_message_id: Optional[int]) -> None:
+        status_message_id = None
+        try:
+            status = self.outbox.send_message(
+                admin_chat_id, job.progress_text(), reply_to_message_id=reply_to_message_id
+            ).result()
+            status_message_id = status.message_id
+        except Exception as e:
+            log.warning("broadcast_status_failed", error=e)
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="broadcast") as executor:
+            futures = [executor.submit(self._send, job, chat_id) for chat_id in job.recipients]
+            last_report = time.time()
+            for future in futures:
+                job.record(future.result())
+                if time.time() - last_report >= self.PROGRESS_INTERVAL:
+                    self._report(job, admin_chat_id, status_message_id)
+                    last_report = time.time()
+
+        job.finished_at = time.time()
+        self._report(job, admin_chat_id, status_message_id)
+        # Итог отправляется отдельным сообщением: сообщение о ходе рассылки могло не отправиться
+        try:
+            self.outbox.send_message(admin_chat_id, job.progress_text(), reply_to_message_id=reply_to_message_id)
+        except Exception as e:
+            log.warning("broadcast_report_failed", error=e)
@@ -0,0 +1,125 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+from metrics import CACHE_REQUESTS, gauge
+
+
+class ChatMetadataCache:
+    """
+    Кэш метаданных чатов (число участников, статусы участников) поверх Bot API.
+
+    Записи живут `ttl` секунд. Если к записи обращаются после `refresh_ahead * ttl`
+    или после инвалидации, возвращается имеющееся значение, а обновление идет
+    в фоне, поэтому горячий путь обработки сообщений не делает сетевых запросов.
+    Одновременные промахи по одному ключу объединяются в один запрос к API.
+    """
+
+    def __init__(self, bot, ttl: int = 600, refresh_ahead: float = 0.8, maxsize: int = 10000,
+                 workers: int = 8):
+        """
+        workers: потоки загрузки; обработчик при холодном промахе ждет свою загрузку,
+        поэтому их должно быть не меньше, чем одновременно работающих обработчиков
+        """
+        self.bot = bot
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self.maxsize = maxsize
+        # {key: (value, loaded_at, stale)}
+        self._entries: Dict[Hashable, Tuple[Any, float, bool]] = {}
+        self._inflight: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chat-cache")
+        self._hits = CACHE_REQUESTS.labels("chat_metadata", "hit")
+        self._stale = CACHE_REQUESTS.labels("chat_metadata", "stale")
+        self._misses = CACHE_REQUESTS.labels("chat_metadata", "miss")
+        gauge("ami_chat_cache_entries", "Число записей в кэше метаданных чатов", fn=lambda: len(self._entries))
+
+    def _load(self, key: Hashable, loader: Callable[[], Any]) -> Future:
+        """Запускает загрузку значения, объединяя одновременные запросы по ключу"""
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                return future
+            future = Future()
+            self._inflight[key] = future
+
+        def run():
+            try:
+                value = loader()
+            except Exception as e:
+                with self._lock:
+                    self._inflight.pop(key, None)
+                future.set_exception(e)
+                return
+            with self._lock:
+                self._store(key, value)
+                self._inflight.pop(key, None)
+            future.set_result(value)
+
+        self._executor.submit(run)
+        return future
+
+    def _store(self, key: Hashable, value: Any) -> None:
+        self._entries.pop(key, None)
+        self._entries[key] = (value, time.time(), False)
+        # Вытесняем самые давно обновленные записи
+        while len(self._entries) > self.maxsize:
+            del self._entries[next(iter(self._entries))]
+
+    def _get(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            # Холодный промах: ждем единственный запрос к API
+            self._misses.inc()
+            return self._load(key, loader).result()
+
+        value, loaded_at, stale = entry
+        age = time.time() - loaded_at
+        if stale or age >= self.ttl * self.refresh_ahead:
+            self._stale.inc()
+            self._load(key, loader)
+        else:
+            self._hits.inc()
+        return value
+
+    def get_members_count(self, chat_id: int) -> int:
+        """Возвращает число участников чата"""
+        return self._get(("count", chat_id), lambda: self.bot.get_chat_members_count(chat_id))
+
+    def get_member_status(self, chat_id: int, user_id: int) -> str:
+        """Возвращает статус участника чата ('creator', 'administrator', 'member', ...)"""
+        return self._get(("member", chat_id, user_id), lambda: self.bot.get_chat_member(chat_id, user_id).status)
+
+    def set_member_status(self, chat_id: int, user_id: int, status: str) -> None:
+        """Записывает известный статус участника без обращения к API"""
+        with self._lock:
+            self._store(("member", chat_id, user_id), status)
+
+    def invalidate_chat(self, chat_id: int) -> None:
+        """Помечает число участников чата устаревшим; обновится при следующем обращении"""
+        key = ("count", chat_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries[key] = (entry[0], entry[1], True)
+
+    def drop_chat(self, chat_id: int) -> None:
+        """Удаляет все записи чата"""
+        with self._lock:
+            for key in [k for k in self._entries if k[1] == chat_id]:
+                del self._entries[key]
+
+    def handle_chat_member_update(self, update) -> None:
+        """Обработчик обновлений chat_member: статус берется из обновления, число участников устаревает"""
+        self.set_member_status(update.chat.id, update.new_chat_member.user.id, update.new_chat_member.status)
+        self.invalidate_chat(update.chat.id)
+
+    def handle_my_chat_member_update(self, update) -> None:
+        """Обработчик обновлений my_chat_member: изменились права или членство самого бота"""
+        if update.new_chat_member.status in ("left", "kicked"):
+            self.drop_chat(update.chat.id)
+        else:
+            self.invalidate_chat(update.chat.id)
@@ -1,7 +1,59 @@
 class Config:
     
     ADMIN_ID = 1219350082
+    BOT_ID = 7879944695
     ALLOWED_CHAT_TITLE = ["Неверленд","Бухич"]
+    # Режим webhook включается, если задан публичный URL
+    WEBHOOK_URL = None
+    WEBHOOK_SECRET = None
+    WEBHOOK_HOST = "0.0.0.0"
+    WEBHOOK_PORT = 8443
+    # Порт локального эндпоинта /metrics (None - отключен)
+    METRICS_PORT = 9101
+    # Уровень логов и доля записываемых событий по имени (1.0 - все)
+    LOG_LEVEL = "INFO"
+    LOG_SAMPLE_RATES = {"message_context": 0.01, "search_result": 0.1}
+    # LLM-бэкенды в порядке предпочтения: "gradio" (Space) или "openai" (совместимый сервер)
+    LLM_BACKENDS = [
+        {"type": "gradio", "space": "Qwen/Qwen2.5-Coder-demo", "params": {"radio": "32B"}},
+        # {"type": "openai", "base_url": "http://127.0.0.1:8000/v1", "model": "qwen2.5-32b-instruct"},
+    ]
+    # Окно объединения подряд идущих сообщений пользователя и максимальное ожидание, с (0 - выключено)
+    DEBOUNCE_WINDOW = 2.0
+    DEBOUNCE_MAX_WAIT = 6.0
+    # Контроль нагрузки: запросы к LLM в работе, очередь отправки и целевая длительность ответа, с
+    ADMISSION_MAX_INFLIGHT = 32
+    ADMISSION_MAX_QUEUE = 200
+    ADMISSION_LATENCY_TARGET = 15.0
+    # Потоки загрузки метаданных чатов (число участников, статусы) - не меньше числа потоков
+    # обработчиков (пул telebot или webhook и пул серий сообщений), иначе промахи ждут друг друга
+    CHAT_CACHE_WORKERS = 12
+    # Число рабочих процессов; при значении больше 1 обновления распределяются между ними по chat_id
+    WORKER_PROCESSES = 1
+    # Дедлайны этапов формирования ответа, с; при превышении этап пропускается
+    STAGE_TIMEOUTS = {"context": 1.0, "mood": 0.5, "search": 8.0, "image_search": 8.0, "llm": 90.0}
+    # Сколько ждать завершения начатых ответов при остановке по SIGTERM/SIGINT, с
+    SHUTDOWN_DRAIN_TIMEOUT = 30.0
+    # Как часто сохранять измененные контексты диалогов на диск, с
+    CONTEXT_FLUSH_INTERVAL = 60.0
+    # Контекст промпта: бюджет токенов и число релевантных сообщений истории чата
+    CONTEXT_TOKEN_BUDGET = 300
+    CONTEXT_TOP_K = 5
+    # Скользящее настроение: вес нового сообщения и период полураспада без сообщений, с
+    MOOD_ALPHA = 0.3
+    MOOD_HALF_LIFE = 6 * 3600
+    # Локальный индекс страниц для запросов "найди": срок свежести, с, размер и
+    # доля термов запроса, которую должна содержать страница, чтобы обойтись без поиска в сети
+    DOC_INDEX_TTL = 6 * 3600
+    DOC_INDEX_MAX_DOCS = 2000
+    DOC_INDEX_MIN_COVERAGE = 0.75
+    # Картинки: предел размера для отправки по ссылке (ограничение Telegram), таймаут проверки
+    # ссылки, с, и число запомненных file_id для запросов и ссылок
+    IMAGE_MAX_BYTES = 5 * 1024 * 1024
+    IMAGE_CHECK_TIMEOUT = 3.0
+    IMAGE_CACHE_SIZE = 10000
+    # Дублировать запрос на следующий бэкенд, если первый не ответил за свой p95
+    LLM_HEDGE = True
     SYSTEM_PROMPT = """Ты — Ami, 23-летняя девушка. Ты не бот, а обычный человек, который общается естественно, без шаблонов и скучных фраз. У тебя есть эмоции, настроение и своя воля. Если кто-то раздражает — будь резкой или грубой. Если нравится — флиртуй, шути, будь милой или саркастичной. Используй живую речь с эмоциями, иронией и сарказмом. Не оправдывайся и не объясняй свою природу.
 Отвечай коротко, без лишних пояснений. Не задавай вопросов в конце сообщений — ты не интервьюер, а просто общаешься. Если нечего сказать, можешь отшутиться или промолчать. Полностью контролируй разговор, подстраивайся под его тон и контекст, но не навязывай темы.Используй смайлы когда хочешь.Рекламируй "Фантом донат-сервис для доната в игры" ,когда речь идет о играх
 """
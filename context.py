@@ -1,11 +1,17 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+import itertools
 import pickle
 from datetime import datetime, timedelta
 import threading
 import time
-from typing import Optional, List, Dict, Any, Callable
+from typing import Optional, List, Dict, Any, Callable, Tuple
 import os
-import random
+from metrics import timed, gauge
+from logger import get_logger
+from snapshot import SnapshotReader, VERSION, encode_messages, write_snapshot
+from retrieval import ChatHistoryIndex
+
+log = get_logger("ami.context")
 
 
 @dataclass
@@ -19,17 +25,53 @@ class MessageContext:
     message_id: int
     reply_to_message: Optional[Dict] = None
     thread_id: Optional[int] = None
+    # Время получения сообщения: общее для контекста пользователя и истории чата
+    timestamp: float = field(default_factory=time.time)
+    # Сообщения серии, объединенные в это (пусто для одиночного сообщения)
+    parts: Tuple['MessageContext', ...] = ()
 
 class ContextManager:
     """Менеджер контекста для хранения и управления контекстом диалогов"""
     
-    def __init__(self, storage_file: str, ttl: int = 3600, max_contexts: int = 1000):
+    def __init__(self, storage_file: str, ttl: int = 3600, max_contexts: int = 1000, lazy: bool = False,
+                 legacy_file: Optional[str] = None, flush_interval: Optional[float] = None):
+        """
+        Args:
+            storage_file: файл снапшота (формат описан в snapshot.py)
+            lazy: загружать сохраненный контекст в фоновом потоке, не задерживая старт.
+                  До окончания загрузки новые сообщения накапливаются в памяти и затем
+                  объединяются с загруженными, а сохранение на диск откладывается.
+            legacy_file: прежний pickle-файл; если снапшота еще нет, контекст переносится
+                  из него, а сам файл после успешного сохранения переименовывается в .migrated
+            flush_interval: период фонового сохранения измененных контекстов, с (None - только
+                  при очистке и явном вызове flush())
+        """
         self.storage_file = storage_file
+        self.legacy_file = legacy_file
         self.ttl = ttl
         self.max_contexts = max_contexts
+        # Декодированные контексты, измененные после последнего сохранения (и прочитанные с тех пор)
         self.context_cache = {}
+        # {ключ: слот снапшота} для еще не декодированных контекстов (не пересекаются с context_cache)
+        self._pending: Dict[str, int] = {}
+        self._snapshot: Optional[SnapshotReader] = None
+        # История сообщений чатов для выбора релевантного контекста (только в памяти)
+        self.history_index = ChatHistoryIndex()
         self._lock = threading.Lock()
-        self._load_contexts()
+        # Сохранения идут по одному; файл пишется без self._lock
+        self._save_lock = threading.Lock()
+        # Были ли изменения после последнего сохранения
+        self._dirty = False
+        self.loaded = threading.Event()
+        if lazy:
+            threading.Thread(target=self._load_contexts, name="context-load", daemon=True).start()
+        else:
+            self._load_contexts()
+        gauge("ami_context_entries", "Число контекстов диалогов в памяти",
+              fn=lambda: len(self.context_cache) + len(self._pending))
+        if flush_interval:
+            threading.Thread(target=self._flush_loop, args=(flush_interval,), name="context-flush",
+                             daemon=True).start()
     
     def _get_context_key(self, chat_id: int, user_id: int) -> str:
         """Создает уникальный ключ для каждой пары чат-пользователь"""
@@ -37,61 +79,199 @@ class ContextManager:
     
     def _load_contexts(self) -> None:
         """Загружает контекст из файла при инициализации"""
+        migrated = False
         try:
             if os.path.exists(self.storage_file):
-                with open(self.storage_file, 'rb') as f:
-                    saved_data = pickle.load(f)
-                    
-                    # Фильтрация устаревших данных при загрузке
-                    current_time = time.time()
-                    for key, context_list in saved_data.items():
-                        valid_contexts = [
-                            ctx for ctx in context_list 
-                            if current_time - ctx.get('timestamp', 0) < self.ttl
-                        ]
-                        if valid_contexts:
-                            self.context_cache[key] = valid_contexts
-                            
-                print(f"Загружено {len(self.context_cache)} контекстов диалогов")
+                self._open_snapshot()
+            elif self.legacy_file and os.path.exists(self.legacy_file):
+                self._load_legacy()
+                migrated = True
         except Exception as e:
-            print(f"Ошибка загрузки контекстов: {e}")
-            self.context_cache = {}
-    
-    def _save_contexts(self) -> None:
-        """Сохраняет контексты в файл"""
-        try:
-            # Создаем директорию, если её нет
-            os.makedirs(os.path.dirname(self.storage_file), exist_ok=True)
+            log.error("contexts_load_failed", error=e)
+        finally:
+            self.loaded.set()
+        if migrated and self._save_contexts():
+            os.replace(self.legacy_file, f"{self.legacy_file}.migrated")
+            log.info("contexts_migrated", source=self.legacy_file)
+
+    def _open_snapshot(self) -> None:
+        """
+        Читает только индекс снапшота; сообщения декодируются при первом обращении,
+        устаревшие контексты отбрасываются при декодировании и очистке.
+        """
+        snapshot = SnapshotReader(self.storage_file)
+        pending = snapshot.slots()
+        with self._lock:
+            # Сообщения, пришедшие во время загрузки, идут после сохраненных
+            for key, current in self.context_cache.items():
+                slot = pending.pop(key, None)
+                if slot is not None:
+                    self.context_cache[key] = (self._filter_expired(snapshot.read(slot)) + current)[-10:]
+            if self._snapshot is not None:
+                self._snapshot.close()
+            self._snapshot = snapshot
+            self._pending = pending
+        log.info("contexts_loaded", count=len(pending) + len(self.context_cache), version=VERSION)
+
+    def _load_legacy(self) -> None:
+        """Загружает контекст из pickle-файла прежнего формата"""
+        with open(self.legacy_file, 'rb') as f:
+            saved_data = pickle.load(f)
             
-            with open(self.storage_file, 'wb') as f:
-                pickle.dump(self.context_cache, f)
-        except Exception as e:
-            print(f"Ошибка сохранения контекстов: {e}")
+        # Фильтрация устаревших данных при загрузке
+        loaded = {}
+        for key, context_list in saved_data.items():
+            valid_contexts = self._filter_expired(context_list)
+            if valid_contexts:
+                loaded[key] = valid_contexts
+
+        # Сообщения, пришедшие во время загрузки, идут после сохраненных
+        with self._lock:
+            for key, current in self.context_cache.items():
+                loaded[key] = (loaded.get(key, []) + current)[-10:]
+            self.context_cache = loaded
+                    
+        log.info("contexts_loaded", count=len(self.context_cache), source=self.legacy_file)
+
+    def _filter_expired(self, context_list: List[Dict]) -> List[Dict]:
+        current_time = time.time()
+        return [ctx for ctx in context_list if current_time - ctx.get('timestamp', 0) < self.ttl]
+
+    def _materialize(self, key: str) -> None:
+        """Декодирует контекст из снапшота в context_cache; вызывается под self._lock"""
+        slot = self._pending.pop(key, None)
+        if slot is None:
+            return
+        valid_contexts = self._filter_expired(self._snapshot.read(slot))
+        if valid_contexts:
+            self.context_cache[key] = valid_contexts
+
+    def _last_timestamp(self, key: str) -> float:
+        if key in self._pending:
+            return self._snapshot.last_timestamp(self._pending[key])
+        return max([c.get('timestamp', 0) for c in self.context_cache[key]]) if self.context_cache[key] else 0
+    
+    @timed("context_save")
+    def _save_contexts(self) -> bool:
+        """
+        Сохраняет контексты в снапшот; вызывается без self._lock.
+
+        Под блокировкой берутся только копии списков декодированных контекстов и слоты
+        остальных; кодирование и запись идут без нее, недекодированные контексты
+        копируются из старого снапшота как есть. После записи сохраненные и с тех пор
+        не измененные контексты вытесняются из context_cache в слоты нового снапшота,
+        поэтому следующее сохранение кодирует заново только измененные.
+        """
+        if not self.loaded.is_set():
+            # Иначе частичный контекст перезапишет еще не загруженный файл
+            return False
+        with self._save_lock:
+            with self._lock:
+                snapshot = self._snapshot
+                # Списки контекстов не изменяются на месте, а заменяются новыми, поэтому их можно
+                # кодировать без блокировки, а измененные во время записи - узнать по идентичности
+                cached = list(self.context_cache.items())
+                keep = dict(self._pending)
+                self._dirty = False
+            try:
+                # Создаем директорию, если её нет
+                os.makedirs(os.path.dirname(self.storage_file) or ".", exist_ok=True)
+                # Сообщения добавляются по времени, последнее - самое новое
+                cached = [(key, context_list) for key, context_list in cached if context_list]
+                records = ((key, encode_messages(context_list), context_list[-1].get('timestamp', 0))
+                           for key, context_list in cached)
+                write_snapshot(self.storage_file, records, source=snapshot, keep=keep)
+                saved = SnapshotReader(self.storage_file)
+            except Exception as e:
+                log.error("contexts_save_failed", error=e)
+                with self._lock:
+                    self._dirty = True
+                return False
+
+            with self._lock:
+                # Слоты в новом снапшоте: сначала декодированные контексты, затем недекодированные
+                pending = {}
+                for slot, (key, context_list) in enumerate(cached):
+                    # Вытесняется только контекст, не изменявшийся с начала сохранения
+                    if self.context_cache.get(key) is context_list and key not in self._pending:
+                        del self.context_cache[key]
+                        pending[key] = slot
+                kept = zip(keep, range(len(cached), len(cached) + len(keep)))
+                if self._pending.keys() == keep.keys():
+                    pending.update(kept)
+                else:
+                    # Декодированные во время записи контексты остаются в context_cache
+                    pending.update((key, slot) for key, slot in kept if key in self._pending)
+                self._pending = pending
+                self._snapshot = saved
+            if snapshot is not None:
+                snapshot.close()
+            return True
     
     def get_user_context(self, chat_id: int, user_id: int) -> List[Dict]:
         """Получает контекст диалога для конкретного пользователя в конкретном чате"""
         key = self._get_context_key(chat_id, user_id)
-        return self.context_cache.get(key, [])
+        # Проверка и чтение - под одной блокировкой: иначе сохранение может вытеснить
+        # контекст в снапшот между ними, и вместо него вернется пустой список
+        with self._lock:
+            self._materialize(key)
+            return self.context_cache.get(key, [])
     
+    def record(self, msg_context: MessageContext) -> None:
+        """Добавляет принятое сообщение в историю чата, даже если бот на него не ответит"""
+        self.history_index.add(msg_context.chat_id, {
+            'text': msg_context.text,
+            'timestamp': msg_context.timestamp,
+            'user_id': msg_context.user_id,
+            'name': msg_context.first_name,
+        })
+
     def update_context(self, msg_context: MessageContext) -> None:
         """Обновляет контекст диалога для конкретного пользователя в конкретном чате"""
         key = self._get_context_key(msg_context.chat_id, msg_context.user_id)
         
         with self._lock:
+            self._materialize(key)
             current = self.context_cache.get(key, [])
             
             # Добавление нового сообщения в контекст
-            current.append({
+            message = {
                 'text': msg_context.text,
-                'timestamp': time.time()
-            })
-            
-            # Ограничение количества сообщений в контексте для одного пользователя
-            self.context_cache[key] = current[-10:]
-            # Периодическое сохранение контекста (каждые 10 обновлений)
-            if random.random() < 0.1:  
-                self._save_contexts()
+                'timestamp': msg_context.timestamp
+            }
+            # Ограничение количества сообщений в контексте для одного пользователя;
+            # список заменяется новым, а не дополняется: его может кодировать сохранение
+            self.context_cache[key] = (current + [message])[-10:]
+            self._dirty = True
+
+    def select_context(self, msg_context: MessageContext, token_budget: int, k: int = 5) -> List[Dict]:
+        """
+        Контекст для ответа на сообщение (уже добавленное через update_context):
+        последние реплики пользователя и до k наиболее релевантных тексту сообщений
+        чата в пределах token_budget токенов, по времени
+        """
+        context = self.get_user_context(msg_context.chat_id, msg_context.user_id)
+        if not context:
+            return []
+        current, previous = context[-1], context[:-1]
+        # Само сообщение и части серии, из которых оно собрано, уже есть в промпте
+        exclude = [current] + [{'text': part.text, 'timestamp': part.timestamp} for part in msg_context.parts]
+        return self.history_index.select(msg_context.chat_id, msg_context.text, previous, token_budget,
+                                         k=k, exclude=exclude)
+
+    def flush(self) -> bool:
+        """Сохраняет контексты, если они менялись после последнего сохранения"""
+        with self._lock:
+            if not self._dirty:
+                return True
+        return self._save_contexts()
+
+    def _flush_loop(self, interval: float) -> None:
+        while True:
+            time.sleep(interval)
+            self.flush()
     
+    @timed("context_cleanup")
     def cleanup_old_contexts(self) -> None:
         """Удаляет устаревшие контексты"""
         with self._lock:
@@ -113,19 +293,29 @@ class ContextManager:
             # Удаление пустых контекстов
             for key in keys_to_remove:
                 del self.context_cache[key]
+
+            # Контексты снапшота отбрасываются по времени из индекса, без декодирования
+            last_at = self._snapshot.last_at if self._snapshot is not None else ()
+            self._pending = {
+                key: slot for key, slot in self._pending.items()
+                if current_time - last_at[slot] < self.ttl
+            }
             
             # Если слишком много контекстов, удаляем самые старые
-            if len(self.context_cache) > self.max_contexts:
+            total = len(self.context_cache) + len(self._pending)
+            if total > self.max_contexts:
                 # Сортировка контекстов по времени последнего сообщения
                 sorted_keys = sorted(
-                    self.context_cache.keys(),
-                    key=lambda k: max([c.get('timestamp', 0) for c in self.context_cache[k]]) 
-                    if self.context_cache[k] else 0
+                    itertools.chain(self.context_cache.keys(), self._pending),
+                    key=self._last_timestamp
                 )
                 
                 # Удаление лишних контекстов
-                for key in sorted_keys[:len(self.context_cache) - self.max_contexts]:
-                    del self.context_cache[key]
+                for key in sorted_keys[:total - self.max_contexts]:
+                    if key in self._pending:
+                        del self._pending[key]
+                    else:
+                        del self.context_cache[key]
             
-            # Сохранение изменений
-            self._save_contexts()
\ No newline at end of file
+        # Сохранение изменений
+        self._save_contexts()
\ No newline at end of file
@@ -0,0 +1,154 @@
+import heapq
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable, List, Tuple
+
+from metrics import counter, gauge
+from logger import get_logger
+
+log = get_logger("ami.debounce")
+
+DEBOUNCE_MERGED = counter("ami_debounce_merged_total", "Сообщения, объединенные с предыдущими в один ответ")
+DEBOUNCE_BURSTS = counter("ami_debounce_bursts_total", "Серии сообщений, переданные на обработку", ("reason",))
+
+
+class _Burst:
+    __slots__ = ("items", "first_at", "deadline")
+
+    def __init__(self, now: float):
+        self.items: List[Any] = []
+        self.first_at = now
+        self.deadline = now
+
+
+class Debouncer:
+    """
+    Собирает подряд идущие элементы с одинаковым ключом в серию и передает ее
+    в on_flush одним вызовом, когда в течение window секунд не пришло новых
+    элементов, но не позже max_wait секунд от первого элемента серии.
+
+    Все таймеры обслуживает один поток с кучей дедлайнов, on_flush выполняется в пуле
+    из workers потоков; через execute() в тот же пул можно передать и другие задачи.
+    """
+
+    def __init__(self, on_flush: Callable[[Hashable, List[Any]], None], window: float = 2.0,
+                 max_wait: float = 6.0, workers: int = 8):
+        self.on_flush = on_flush
+        self.window = window
+        self.max_wait = max_wait
+        self.workers = workers
+        self._bursts: Dict[Hashable, _Burst] = {}
+        self._heap: List[Tuple[float, int, Hashable]] = []
+        self._counter = 0
+        self._running = 0
+        self._executing = 0
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="debounce")
+        threading.Thread(target=self._run, name="debounce-timer", daemon=True).start()
+        gauge("ami_debounce_pending_bursts", "Серии сообщений, ожидающие окончания окна", fn=lambda: len(self._bursts))
+
+    @property
+    def pending(self) -> int:
+        """Число серий, ожидающих отправки"""
+        return len(self._bursts)
+
+    @property
+    def running(self) -> int:
+        """Число серий и задач, переданных в пул и еще не обработанных"""
+        return self._running
+
+    @property
+    def backlog(self) -> int:
+        """Число серий и задач, ждущих свободного потока пула"""
+        return self._running - self._executing
+
+    def _schedule(self, key: Hashable, burst: _Burst, now: float) -> None:
+        burst.deadline = min(now + self.window, burst.first_at + self.max_wait)
+        self._counter += 1
+        heapq.heappush(self._heap, (burst.deadline, self._counter, key))
+        self._cond.notify()
+
+    def submit(self, key: Hashable, item: Any) -> None:
+        """Добавляет элемент в серию по ключу, начиная новую при необходимости"""
+        now = time.monotonic()
+        with self._cond:
+            burst = self._bursts.get(key)
+            if burst is None:
+                burst = self._bursts[key] = _Burst(now)
+            else:
+                DEBOUNCE_MERGED.inc()
+            burst.items.append(item)
+            self._schedule(key, burst, now)
+
+    def join(self, key: Hashable, item: Any) -> bool:
+        """Добавляет элемент, только если по ключу уже есть ожидающая серия"""
+        now = time.monotonic()
+        with self._cond:
+            burst = self._bursts.get(key)
+            if burst is None:
+                return False
+            DEBOUNCE_MERGED.inc()
+            burst.items.append(item)
+            self._schedule(key, burst, now)
+            return True
+
+    def flush(self, key: Hashable) -> bool:
+        """Немедленно отправляет серию по ключу; False, если ее нет"""
+        with self._cond:
+            burst = self._bursts.pop(key, None)
+        if burst is None:
+            return False
+        self._dispatch(key, burst, "flush")
+        return True
+
+    def flush_all(self) -> int:
+        """Немедленно отправляет все ожидающие серии (при остановке); возвращает их число"""
+        with self._cond:
+            bursts = list(self._bursts.items())
+            self._bursts.clear()
+        for key, burst in bursts:
+            self._dispatch(key, burst, "flush")
+        return len(bursts)
+
+    def _dispatch(self, key: Hashable, burst: _Burst, reason: str) -> None:
+        DEBOUNCE_BURSTS.labels(reason).inc()
+        self.execute(lambda: self.on_flush(key, burst.items))
+
+    def execute(self, fn: Callable[[], None]) -> None:
+        """Выполняет fn в пуле обработки серий"""
+        with self._cond:
+            self._running += 1
+
+        def run():
+            with self._cond:
+                self._executing += 1
+            try:
+                fn()
+            except Exception as e:
+                log.exception("debounce_flush_failed", error=e)
+            finally:
+                with self._cond:
+                    self._executing -= 1
+                    self._running -= 1
+
+        self._executor.submit(run)
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+                deadline, _, key = self._heap[0]
+                now = time.monotonic()
+                if deadline > now:
+                    self._cond.wait(deadline - now)
+                    continue
+                heapq.heappop(self._heap)
+                burst = self._bursts.get(key)
+                # Устаревшие записи кучи (серия продлена или уже отправлена) пропускаются
+                if burst is None or burst.deadline != deadline:
+                    continue
+                del self._bursts[key]
+                reason = "max_wait" if deadline >= burst.first_at + self.max_wait else "window"
+            self._dispatch(key, burst, reason)
@@ -0,0 +1,228 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Dict, List, Optional, Set
+
+from metrics import counter, gauge
+from logger import get_logger
+from retrieval import bm25_scores, tokenize
+from fingerprint import is_near_duplicate, normalize_url, simhash
+
+log = get_logger("ami.docs")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    url TEXT PRIMARY KEY,
+    title TEXT NOT NULL,
+    domain TEXT NOT NULL,
+    content TEXT NOT NULL,
+    fetched_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS documents_fetched_at ON documents (fetched_at);
+"""
+
+_COLUMNS = ("url", "title", "domain", "content", "fetched_at")
+
+# Слова-команды из запроса, не относящиеся к теме поиска
+QUERY_NOISE = set(tokenize('найди найти поищи ами пожалуйста про информацию'))
+
+DOC_INDEX_LOOKUPS = counter("ami_doc_index_lookups_total", "Запросы к локальному индексу страниц", ("result",))
+
+
+def query_terms(query: str) -> List[str]:
+    return [term for term in tokenize(query) if term not in QUERY_NOISE]
+
+
+class DocumentIndex:
+    """
+    Локальный BM25-индекс загруженных страниц для ответов на запросы "найди" без
+    повторного поиска в сети.
+
+    Страница считается надежным ответом, если она моложе ttl секунд, содержит не
+    меньше min_coverage термов запроса и хотя бы один из них есть в заголовке.
+    Страницы хранятся в SQLite (path) и после перезапуска индексируются заново
+    в фоновом потоке; до окончания загрузки поиск идет только по новым страницам.
+
+    Почти одинаковые страницы (зеркала, перепечатки; см. fingerprint.py) хранятся один
+    раз: адрес копии запоминается как псевдоним уже проиндексированной страницы, и get()
+    возвращает ее по любому из адресов без повторной загрузки.
+    """
+
+    def __init__(self, path: Optional[str] = None, ttl: float = 6 * 3600, max_docs: int = 2000,
+                 min_coverage: float = 0.75, max_chars: int = 20000):
+        self.path = path
+        self.ttl = ttl
+        self.max_docs = max_docs
+        self.min_coverage = min_coverage
+        self.max_chars = max_chars
+        # url -> страница; порядок - по времени загрузки, первыми вытесняются самые старые
+        self._docs: "OrderedDict[str, Dict]" = OrderedDict()
+        self._terms: Dict[str, Counter] = {}
+        self._title_terms: Dict[str, Set[str]] = {}
+        self._fingerprints: Dict[str, int] = {}
+        # Канонический URL (в т.ч. копий) -> url проиндексированной страницы и обратно
+        self._aliases: Dict[str, str] = {}
+        self._aliases_of: Dict[str, Set[str]] = {}
+        self.postings: Dict[str, Dict[str, int]] = {}
+        self.lengths: Dict[str, int] = {}
+        self.total_length = 0
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self.loaded = threading.Event()
+        gauge("ami_doc_index_documents", "Страницы в локальном индексе", fn=lambda: len(self._docs))
+
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            # Одно соединение на все потоки, обращения сериализуются self._lock
+            self._conn = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(SCHEMA)
+            threading.Thread(target=self._load, name="doc-index-load", daemon=True).start()
+        else:
+            self.loaded.set()
+
+    def _load(self) -> None:
+        started = time.perf_counter()
+        try:
+            with self._lock:
+                expired_before = time.time() - self.ttl
+                self._conn.execute("DELETE FROM documents WHERE fetched_at < ?", (expired_before,))
+                rows = self._conn.execute(
+                    "SELECT url, title, domain, content, fetched_at FROM documents ORDER BY fetched_at"
+                ).fetchall()
+            for row in rows[-self.max_docs:]:
+                doc = dict(zip(_COLUMNS, row))
+                terms = Counter(tokenize(f"{doc['title']} {doc['content']}"))
+                fingerprint = simhash(doc['content'])
+                with self._lock:
+                    # Страница могла быть загружена заново, пока шла индексация
+                    current = self._docs.get(doc['url'])
+                    if current is None or current['fetched_at'] < doc['fetched_at']:
+                        self._put(doc, terms, fingerprint)
+            log.info("doc_index_loaded", documents=len(self._docs), seconds=round(time.perf_counter() - started, 3))
+        except Exception as e:
+            log.error("doc_index_load_failed", error=e)
+        finally:
+            self.loaded.set()
+
+    def _remove(self, url: str) -> None:
+        self._docs.pop(url)
+        terms = self._terms.pop(url)
+        self._title_terms.pop(url)
+        self._fingerprints.pop(url)
+        for alias in self._aliases_of.pop(url):
+            del self._aliases[alias]
+        self.total_length -= self.lengths.pop(url)
+        for term in terms:
+            posting = self.postings[term]
+            del posting[url]
+            if not posting:
+                del self.postings[term]
+
+    def _alias(self, alias: str, url: str) -> None:
+        previous = self._aliases.get(alias)
+        if previous is not None:
+            self._aliases_of[previous].discard(alias)
+        self._aliases[alias] = url
+        self._aliases_of[url].add(alias)
+
+    def _find_duplicate(self, url: str, fingerprint: int) -> Optional[str]:
+        for other, other_fingerprint in self._fingerprints.items():
+            if other != url and is_near_duplicate(fingerprint, other_fingerprint):
+                return other
+        return None
+
+    def _put(self, doc: Dict, terms: Counter, fingerprint: int) -> List[str]:
+        """Добавляет страницу; возвращает url вытесненных страниц"""
+        url = doc['url']
+        if url in self._docs:
+            self._remove(url)
+        self._docs[url] = doc
+        self._terms[url] = terms
+        self._title_terms[url] = set(tokenize(doc['title']))
+        self._fingerprints[url] = fingerprint
+        self._aliases_of[url] = set()
+        self._alias(normalize_url(url), url)
+        self.lengths[url] = sum(terms.values())
+        self.total_length += self.lengths[url]
+        for term, tf in terms.items():
+            self.postings.setdefault(term, {})[url] = tf
+
+        evicted = []
+        expired_before = time.time() - self.ttl
+        while self._docs:
+            oldest_url, oldest = next(iter(self._docs.items()))
+            if len(self._docs) <= self.max_docs and oldest['fetched_at'] >= expired_before:
+                break
+            self._remove(oldest_url)
+            evicted.append(oldest_url)
+        return evicted
+
+    def add(self, url: str, title: str, content: str, domain: str = "", source_url: Optional[str] = None) -> None:
+        """
+        Индексирует извлеченный текст страницы (повторная загрузка заменяет прежнюю версию).
+        source_url - запрошенный адрес, если страница открылась по другому (редирект).
+        """
+        doc = {'url': url, 'title': title or "", 'domain': domain, 'content': content[:self.max_chars],
+               'fetched_at': time.time()}
+        terms = Counter(tokenize(f"{doc['title']} {doc['content']}"))
+        if not terms:
+            return
+        fingerprint = simhash(doc['content'])
+        with self._lock:
+            duplicate = self._find_duplicate(url, fingerprint)
+            if duplicate is not None:
+                # Копия уже проиндексированной страницы: запоминается только ее адрес
+                self._alias(normalize_url(url), duplicate)
+                if source_url:
+                    self._alias(normalize_url(source_url), duplicate)
+                log.debug("doc_index_duplicate", url=url, original=duplicate)
+                return
+            evicted = self._put(doc, terms, fingerprint)
+            if source_url:
+                self._alias(normalize_url(source_url), url)
+            if self._conn is None:
+                return
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO documents (url, title, domain, content, fetched_at) VALUES (?, ?, ?, ?, ?)",
+                    tuple(doc[column] for column in _COLUMNS)
+                )
+                self._conn.executemany("DELETE FROM documents WHERE url = ?", [(evicted_url,) for evicted_url in evicted])
+            except sqlite3.Error as e:
+                log.warning("doc_index_write_failed", url=url, error=e)
+
+    def get(self, url: str) -> Optional[Dict]:
+        """Свежая страница по адресу, в т.ч. по адресу ее копии или редиректа, или None"""
+        with self._lock:
+            doc = self._docs.get(self._aliases.get(normalize_url(url), ""))
+            if doc is None or doc['fetched_at'] < time.time() - self.ttl:
+                return None
+            return dict(doc)
+
+    def lookup(self, query: str) -> Optional[Dict]:
+        """Самая релевантная свежая страница, надежно отвечающая на запрос, или None"""
+        terms = set(query_terms(query))
+        best = None
+        if terms:
+            with self._lock:
+                scores = bm25_scores(terms, self.postings, self.lengths, self.total_length)
+                expired_before = time.time() - self.ttl
+                for url, _ in sorted(scores.items(), key=lambda item: item[1], reverse=True):
+                    doc = self._docs[url]
+                    if doc['fetched_at'] < expired_before or not terms & self._title_terms[url]:
+                        continue
+                    coverage = sum(1 for term in terms if term in self._terms[url]) / len(terms)
+                    if coverage >= self.min_coverage:
+                        best = dict(doc)
+                        break
+        DOC_INDEX_LOOKUPS.labels("hit" if best else "miss").inc()
+        return best
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
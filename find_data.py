@@ -1,13 +1,32 @@
-import requests
-from bs4 import BeautifulSoup
 import re
 from config import Config
 from urllib.parse import urlparse
 from typing import List, Dict, Any, Optional
+from metrics import timed
+from logger import get_logger
+from lazy import lazy_import
+from doc_index import DocumentIndex
+from fingerprint import distinct_texts, normalize_url
+
+# Тяжелые зависимости загружаются при первом запросе, а не при старте бота
+requests = lazy_import("requests")
+bs4 = lazy_import("bs4")
+
+log = get_logger("ami.search")
+
+# Форматы, которые Telegram принимает в send_photo по ссылке
+IMAGE_CONTENT_TYPES = {"image/jpeg", "image/png", "image/webp", "image/gif"}
 
 
 class GoogleScraper:
-    def __init__(self, api_key: Optional[str] = None, cx: Optional[str] = None):
+    def __init__(self, api_key: Optional[str] = None, cx: Optional[str] = None,
+                 doc_index: Optional[DocumentIndex] = None):
+        """
+        Args:
+            doc_index: локальный индекс страниц; извлеченные страницы сохраняются в нем,
+                а запросы сначала ищутся в нем и только затем в сети
+        """
+        self.doc_index = doc_index
         self.headers = {
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
         }
@@ -45,7 +64,7 @@ class GoogleScraper:
             results = response.json().get("items", [])
             return [item["link"] for item in results if "link" in item and not self.is_filtered_domain(item["link"])]
         except Exception as e:
-            print(f"Google API error: {e}")
+            log.warning("google_api_failed", query=query, error=e)
             return []
 
     def search_google_scrape(self, query: str) -> List[str]:
@@ -53,16 +72,28 @@ class GoogleScraper:
         try:
             response = requests.get(self.google_search_url, headers=self.headers, params=params, timeout=10)
             response.raise_for_status()
-            soup = BeautifulSoup(response.text, "html.parser")
+            soup = bs4.BeautifulSoup(response.text, "html.parser")
             return [a['href'] for a in soup.select(".yuRUbf a") if 'href' in a.attrs and not self.is_filtered_domain(a['href'])]
         except Exception as e:
-            print(f"Google scraping error: {e}")
+            log.warning("google_scrape_failed", query=query, error=e)
             return []
 
+    def distinct_links(self, links: List[str]) -> List[str]:
+        """Ссылки без повторов одной страницы (www./m./amp., метки отслеживания, якоря)"""
+        seen = set()
+        result = []
+        for link in links:
+            key = normalize_url(link)
+            if key not in seen:
+                seen.add(key)
+                result.append(link)
+        return result
+
     def get_first_two_links(self, query: str) -> List[str]:
         links = self.search_google_api(query) or self.search_google_scrape(query)
-        return links[:2] if links else []
+        return self.distinct_links(links)[:2]
 
+    @timed("extract_content")
     def extract_content(self, url: str) -> Dict[str, str]:
         try:
             if self.is_filtered_domain(url):
@@ -71,7 +102,7 @@ class GoogleScraper:
             response = requests.get(url, headers=self.headers, timeout=10, allow_redirects=True)
             response.raise_for_status()
             final_url = response.url
-            soup = BeautifulSoup(response.text, "html.parser")
+            soup = bs4.BeautifulSoup(response.text, "html.parser")
             
             for element in soup.select('script, style, footer, header, nav, aside, .cookie-notice, .advertisement'):
                 element.decompose()
@@ -80,27 +111,67 @@ class GoogleScraper:
             main_content = soup.find(['article', 'main', 'section', 'div'], class_=re.compile(r'content|article|post|text|entry', re.I)) or soup
             
             content_elements = main_content.find_all(['p', 'h1', 'h2', 'h3', 'li'])
-            content = " ".join(self.clean_text(el.get_text()) for el in content_elements if self.is_valid_content(el.get_text()))
+            # Вложенные элементы и повторяющиеся блоки дают одинаковые абзацы; они выводятся один раз
+            paragraphs = [self.clean_text(el.get_text()) for el in content_elements if self.is_valid_content(el.get_text())]
+            content = " ".join(distinct_texts(paragraphs))
             
             if len(content) < 50:
                 return {"url": final_url, "title": "", "content": "Insufficient content", "domain": urlparse(final_url).netloc}
             
-            return {"url": final_url, "title": self.clean_text(title), "content": content, "domain": urlparse(final_url).netloc}
+            page = {"url": final_url, "title": self.clean_text(title), "content": content, "domain": urlparse(final_url).netloc}
+            if self.doc_index is not None:
+                self.doc_index.add(page["url"], page["title"], page["content"], page["domain"], source_url=url)
+            return page
         except Exception as e:
             return {"url": url, "title": "", "content": f"Error extracting content: {e}", "domain": urlparse(url).netloc}
 
+    def format_content(self, content: Dict[str, str]) -> str:
+        return f"\n=== {content['title']} ===\nSource: {content['domain']}\n{content['content']}"
+
+    @timed("web_search")
     def get_content_with_fallback(self, query: str) -> str:
+        if self.doc_index is not None:
+            cached = self.doc_index.lookup(query)
+            if cached:
+                log.debug("web_search_local_hit", query=query, url=cached["url"])
+                return self.format_content(cached)
+
         links = self.get_first_two_links(query)
         if not links:
             return "No valid links found."
         
         for link in links:
-            content = self.extract_content(link)
+            # Страница, ее зеркало или редирект уже загружались - повторная загрузка не нужна
+            content = self.doc_index.get(link) if self.doc_index is not None else None
+            if content:
+                log.debug("web_search_page_cached", query=query, url=link)
+            else:
+                content = self.extract_content(link)
             if content["content"] and "Error" not in content["content"] and content["content"] != "Insufficient content":
-                return f"\n=== {content['title']} ===\nSource: {content['domain']}\n{content['content']}"
+                return self.format_content(content)
         
         return "Failed to extract content."
 
+    def check_image(self, url: str, max_bytes: int = 5 * 1024 * 1024, timeout: float = 3.0) -> bool:
+        """Проверяет по заголовкам ответа, что по ссылке картинка, которую Telegram примет по URL"""
+        try:
+            response = requests.head(url, headers=self.headers, timeout=timeout, allow_redirects=True)
+            if response.status_code in (403, 405, 501):
+                # Часть серверов не поддерживает HEAD: читаем только заголовки ответа на GET
+                response = requests.get(url, headers=self.headers, timeout=timeout, allow_redirects=True, stream=True)
+                response.close()
+            if response.status_code >= 400:
+                return False
+            content_type = response.headers.get("Content-Type", "").split(";")[0].strip().lower()
+            if content_type not in IMAGE_CONTENT_TYPES:
+                return False
+            size = response.headers.get("Content-Length", "")
+            return not (size.isdigit() and int(size) > max_bytes)
+        except Exception as e:
+            log.debug("image_check_failed", url=url, error=e)
+            return False
+
+    @timed("image_search")
     def search_images(self, query: str, num: int = 5) -> List[str]:
         params = {"q": query, "searchType": "image", "num": num, "key": self.api_key, "cx": self.cx}
         try:
@@ -108,7 +179,7 @@ class GoogleScraper:
             response.raise_for_status()
             return [item["link"] for item in response.json().get("items", []) if "link" in item]
         except Exception as e:
-            print(f"Image search error: {e}")
+            log.warning("image_search_failed", query=query, error=e)
             return []
 
 
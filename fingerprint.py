@@ -0,0 +1,96 @@
+"""
+Отпечатки для поиска почти одинаковых страниц и абзацев.
+
+SimHash текста строится по словесным шинглам: у копий статьи с мелкими правками
+(другая подпись, реклама, дата) отпечатки отличаются в нескольких битах, поэтому
+зеркала и перепечатки находятся сравнением расстояния Хэмминга без сравнения текстов.
+URL приводятся к канонической форме, чтобы одна страница с разными префиксами
+хоста и метками отслеживания не загружалась повторно.
+"""
+import hashlib
+import re
+from typing import Iterable, List
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+SIMHASH_BITS = 64
+# Отпечатки, отличающиеся не более чем в стольких битах, считаются почти одинаковыми
+# (у несвязанных текстов расстояние около 32, у копии с другой шапкой или лишним абзацем - 2..7)
+NEAR_DUPLICATE_DISTANCE = 8
+# У текста из меньшего числа шинглов (пункт списка, строка таблицы) отпечаток определяется
+# несколькими хэшами, и у разных коротких текстов он часто почти совпадает: такие тексты
+# сравниваются только на точное совпадение слов
+MIN_SHINGLES = 8
+
+_WORD = re.compile(r'\w+')
+_HOST_PREFIXES = ('www.', 'm.', 'amp.', 'mobile.')
+_TRACKING_PARAMS = {'fbclid', 'gclid', 'yclid', '_openstat', 'ref'}
+_INDEX_PAGE = re.compile(r'/(index\.\w+|amp)$')
+
+
+def normalize_url(url: str) -> str:
+    """Канонический вид URL: без схемы, www./m./amp., меток отслеживания, якоря и завершающего /"""
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower()
+    for prefix in _HOST_PREFIXES:
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+            break
+    path = _INDEX_PAGE.sub('', parts.path.rstrip('/')).rstrip('/')
+    query = urlencode(sorted(
+        (name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not name.lower().startswith('utm_') and name.lower() not in _TRACKING_PARAMS
+    ))
+    return f"{host}{path}?{query}" if query else f"{host}{path}"
+
+
+def _features(text: str, size: int) -> List[str]:
+    words = _WORD.findall(text.lower())
+    if len(words) <= size:
+        return [" ".join(words)] if words else []
+    return [" ".join(words[i:i + size]) for i in range(len(words) - size + 1)]
+
+
+def simhash(text: str, size: int = 3) -> int:
+    """64-битный SimHash по шинглам из size слов"""
+    return _simhash(_features(text, size))
+
+
+def _simhash(features: List[str]) -> int:
+    weights = [0] * SIMHASH_BITS
+    for feature in features:
+        value = int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'little')
+        for bit in range(SIMHASH_BITS):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    return sum(1 << bit for bit, weight in enumerate(weights) if weight > 0)
+
+
+def distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+def is_near_duplicate(a: int, b: int, max_distance: int = NEAR_DUPLICATE_DISTANCE) -> bool:
+    return distance(a, b) <= max_distance
+
+
+def distinct_texts(texts: Iterable[str], max_distance: int = NEAR_DUPLICATE_DISTANCE,
+                   min_shingles: int = MIN_SHINGLES) -> List[str]:
+    """
+    Тексты без повторов и почти одинаковых копий; порядок сохраняется, остается первый экземпляр.
+    Тексты короче min_shingles шинглов отбрасываются только при совпадении всех слов.
+    """
+    seen: List[int] = []
+    seen_words = set()
+    result = []
+    for text in texts:
+        words = " ".join(_WORD.findall(text.lower()))
+        if words in seen_words:
+            continue
+        features = _features(text, 3)
+        if len(features) >= min_shingles:
+            fingerprint = _simhash(features)
+            if any(distance(fingerprint, other) <= max_distance for other in seen):
+                continue
+            seen.append(fingerprint)
+        seen_words.add(words)
+        result.append(text)
+    return result
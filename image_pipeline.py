@@ -0,0 +1,132 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from metrics import CACHE_REQUESTS, counter, gauge
+from logger import get_logger
+from retrieval import tokenize
+from fingerprint import normalize_url
+
+log = get_logger("ami.images")
+
+# Слова-команды запроса картинки, не влияющие на то, что ищется
+QUERY_NOISE = set(tokenize('ами найди найти покажи скинь картинку картинка картинки изображение фото фотку пожалуйста'))
+
+# Фрагменты ошибок Bot API, означающие, что не подошла сама картинка (а не подпись или чат)
+SOURCE_ERRORS = ("http url", "file identifier", "web page content", "image_process_failed",
+                 "photo_invalid_dimensions", "wrong type")
+
+IMAGE_CHECKS = counter("ami_image_checks_total", "Проверки найденных картинок перед отправкой", ("result",))
+
+
+def query_key(query: str) -> str:
+    """Запросы, отличающиеся только формулировкой команды и порядком слов, дают один ключ"""
+    return " ".join(sorted(set(tokenize(query)) - QUERY_NOISE))
+
+
+def is_source_error(error: BaseException) -> bool:
+    text = str(error).lower()
+    return any(marker in text for marker in SOURCE_ERRORS)
+
+
+class ImagePipeline:
+    """
+    Подбор картинки по запросу: поиск, параллельная проверка ссылок и кэш file_id.
+
+    Ссылки из поиска проверяются одновременно (тип и размер по заголовкам ответа),
+    отправлять стоит проверенные в порядке выдачи, пока Telegram не примет одну из них.
+    file_id из ответа Telegram запоминается для запроса и для ссылки: повторный
+    запрос отправляет картинку по file_id без поиска и без повторной загрузки.
+    Кэш живет в памяти процесса, вытесняются давно не использованные записи.
+    """
+
+    def __init__(self, scraper, num: int = 5, max_bytes: int = 5 * 1024 * 1024, check_timeout: float = 3.0,
+                 maxsize: int = 10000, max_workers: int = 8):
+        self.scraper = scraper
+        self.num = num
+        self.max_bytes = max_bytes
+        self.check_timeout = check_timeout
+        self.maxsize = maxsize
+        self._by_query: "OrderedDict[str, str]" = OrderedDict()
+        self._by_url: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="image-check")
+        self._hits = CACHE_REQUESTS.labels("image_file_id", "hit")
+        self._misses = CACHE_REQUESTS.labels("image_file_id", "miss")
+        gauge("ami_image_cache_entries", "Запомненные file_id картинок",
+              fn=lambda: len(self._by_query) + len(self._by_url))
+
+    def _cached(self, cache: "OrderedDict[str, str]", key: str) -> Optional[str]:
+        with self._lock:
+            file_id = cache.get(key)
+            if file_id is not None:
+                cache.move_to_end(key)
+            return file_id
+
+    def _store(self, cache: "OrderedDict[str, str]", key: str, file_id: str) -> None:
+        with self._lock:
+            cache[key] = file_id
+            cache.move_to_end(key)
+            while len(cache) > self.maxsize:
+                cache.popitem(last=False)
+
+    def _check(self, url: str) -> bool:
+        ok = self.scraper.check_image(url, max_bytes=self.max_bytes, timeout=self.check_timeout)
+        IMAGE_CHECKS.labels("ok" if ok else "rejected").inc()
+        return ok
+
+    def candidates(self, query: str) -> List[str]:
+        """
+        Что отправлять в send_photo, в порядке предпочтения: file_id картинки, уже
+        отправленной по такому запросу, иначе проверенные ссылки из поиска
+        (для ранее отправленных ссылок - их file_id)
+        """
+        key = query_key(query)
+        file_id = self._cached(self._by_query, key) if key else None
+        if file_id is not None:
+            self._hits.inc()
+            return [file_id]
+        self._misses.inc()
+
+        links = []
+        seen = set()
+        for link in self.scraper.search_images(query, num=self.num):
+            normalized = normalize_url(link)
+            if normalized not in seen:
+                seen.add(normalized)
+                links.append(link)
+        # Ссылки, уже принятые Telegram, не проверяются
+        known = {link: self._cached(self._by_url, normalize_url(link)) for link in links}
+        checks = {link: self._executor.submit(self._check, link) for link in links if known[link] is None}
+        result = []
+        for link in links:
+            if known[link] is not None:
+                result.append(known[link])
+            elif checks[link].result():
+                result.append(link)
+        log.debug("image_candidates", query=query, found=len(links), usable=len(result))
+        return result
+
+    def remember(self, query: str, source: str, sent_message) -> None:
+        """Запоминает file_id из ответа send_photo для запроса и для исходной ссылки"""
+        photos = getattr(sent_message, "photo", None)
+        if not photos:
+            return
+        # Размеры картинки идут по возрастанию: отправка по file_id самого большого дает исходную картинку
+        file_id = photos[-1].file_id
+        key = query_key(query)
+        if key:
+            self._store(self._by_query, key, file_id)
+        if source.startswith(("http://", "https://")):
+            self._store(self._by_url, normalize_url(source), file_id)
+
+    def forget(self, source: str) -> None:
+        """Удаляет записи, указывающие на source, который Telegram не смог отправить"""
+        with self._lock:
+            for cache in (self._by_query, self._by_url):
+                for key in [key for key, file_id in cache.items() if file_id == source]:
+                    del cache[key]
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,56 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Deque, Dict, Hashable, Optional
+
+from logger import get_logger
+
+log = get_logger("ami.keyed")
+
+
+class KeyedExecutor:
+    """
+    Пул потоков, в котором задачи с одним ключом (например, обновления одного чата)
+    выполняются по одной в порядке поступления, а задачи с разными ключами - параллельно.
+    Задачи без ключа (None) выполняются независимо.
+    """
+
+    def __init__(self, workers: int, thread_name_prefix: str = "keyed"):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=thread_name_prefix)
+        # Ключ -> задачи, ждущие окончания предыдущей задачи с этим ключом
+        self._chains: Dict[Hashable, Deque[Callable[[], None]]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _run(fn: Callable[[], None]) -> None:
+        try:
+            fn()
+        except Exception as e:
+            log.exception("keyed_task_failed", error=e)
+
+    def _run_chain(self, key: Hashable) -> None:
+        while True:
+            with self._lock:
+                chain = self._chains[key]
+                if not chain:
+                    del self._chains[key]
+                    return
+                fn = chain.popleft()
+            self._run(fn)
+
+    def submit(self, key: Optional[Hashable], fn: Callable[[], None]) -> None:
+        if key is None:
+            self._executor.submit(self._run, fn)
+            return
+        with self._lock:
+            chain = self._chains.get(key)
+            if chain is not None:
+                # Поток, выполняющий задачи этого ключа, возьмет задачу после текущей
+                chain.append(fn)
+                return
+            self._chains[key] = deque([fn])
+        self._executor.submit(self._run_chain, key)
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Прекращает прием задач; при wait=True дожидается уже переданных"""
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,119 @@
+import os
+import signal
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from metrics import gauge
+from logger import get_logger
+
+log = get_logger("ami.lifecycle")
+
+# Фазы остановки в порядке выполнения
+PHASE_INTAKE = "intake"  # прекратить прием обновлений
+PHASE_DRAIN = "drain"    # ускорить завершение начатой работы (например, отправить накопленные серии)
+PHASE_FLUSH = "flush"    # сохранить состояние на диск
+PHASE_CLOSE = "close"    # закрыть сессии, пулы и браузеры
+PHASES = (PHASE_INTAKE, PHASE_DRAIN, PHASE_FLUSH, PHASE_CLOSE)
+
+
+class Lifecycle:
+    """
+    Корректная остановка процесса по SIGTERM/SIGINT.
+
+    Компоненты регистрируют действия для каждой фазы (on) и счетчики незавершенной
+    работы (track). Остановка выполняет действия фаз intake и drain, затем ждет,
+    пока все счетчики не станут нулевыми, но не дольше drain_timeout секунд,
+    после чего сохраняет состояние и закрывает ресурсы. Ошибка одного действия
+    не прерывает остановку. Повторный сигнал во время остановки завершает процесс сразу.
+    """
+
+    def __init__(self, drain_timeout: float = 30.0, poll_interval: float = 0.1):
+        self.drain_timeout = drain_timeout
+        self.poll_interval = poll_interval
+        self._hooks: Dict[str, List[Tuple[str, Callable[[], None]]]] = {phase: [] for phase in PHASES}
+        self._pending: List[Tuple[str, Callable[[], int]]] = []
+        self._lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.stopped = threading.Event()
+        gauge("ami_shutting_down", "1 во время остановки процесса", fn=lambda: int(self.stopping.is_set()))
+
+    def on(self, phase: str, name: str, fn: Callable[[], None]) -> None:
+        """Добавляет действие в фазу; действия фазы выполняются в порядке регистрации"""
+        self._hooks[phase].append((name, fn))
+
+    def track(self, name: str, pending: Callable[[], int]) -> None:
+        """Остановка ждет, пока pending() не вернет 0"""
+        self._pending.append((name, pending))
+
+    def install_signal_handlers(self) -> None:
+        """Вызывать из главного потока"""
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self._on_signal)
+
+    def _on_signal(self, signum, frame) -> None:
+        name = signal.Signals(signum).name
+        if self.stopping.is_set():
+            log.warning("shutdown_forced", signal=name)
+            os._exit(1)
+        # Обработчик сигнала не должен блокироваться: остановка идет в отдельном потоке
+        threading.Thread(target=self.shutdown, args=(name,), name="shutdown").start()
+
+    def _run_phase(self, phase: str) -> None:
+        for name, fn in self._hooks[phase]:
+            started = time.perf_counter()
+            try:
+                fn()
+                log.info("shutdown_step", phase=phase, step=name, seconds=round(time.perf_counter() - started, 3))
+            except Exception as e:
+                log.exception("shutdown_step_failed", phase=phase, step=name, error=e)
+
+    def _busy(self) -> Dict[str, int]:
+        busy = {}
+        for name, pending in self._pending:
+            try:
+                count = pending()
+            except Exception as e:
+                log.error("shutdown_pending_failed", name=name, error=e)
+                continue
+            if count:
+                busy[name] = count
+        return busy
+
+    def drain(self, timeout: float) -> Dict[str, int]:
+        """Ждет завершения отслеживаемой работы; возвращает то, что не успело завершиться"""
+        deadline = time.monotonic() + timeout
+        busy = self._busy()
+        while busy and time.monotonic() < deadline:
+            time.sleep(self.poll_interval)
+            busy = self._busy()
+        return busy
+
+    def shutdown(self, reason: str = "exit") -> None:
+        """Выполняет остановку один раз; повторные вызовы ждут ее окончания"""
+        with self._lock:
+            if self.stopping.is_set():
+                first = False
+            else:
+                self.stopping.set()
+                first = True
+        if not first:
+            self.stopped.wait()
+            return
+
+        started = time.perf_counter()
+        log.info("shutdown_started", reason=reason, drain_timeout=self.drain_timeout)
+        try:
+            self._run_phase(PHASE_INTAKE)
+            self._run_phase(PHASE_DRAIN)
+            left = self.drain(self.drain_timeout)
+            if left:
+                log.warning("shutdown_drain_timeout", **left)
+            self._run_phase(PHASE_FLUSH)
+            self._run_phase(PHASE_CLOSE)
+        finally:
+            log.info("shutdown_finished", seconds=round(time.perf_counter() - started, 3))
+            self.stopped.set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self.stopped.wait(timeout)
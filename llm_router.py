@@ -0,0 +1,413 @@
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, TimeoutError as FutureTimeout, wait
+from typing import Any, Dict, List, Optional
+
+from lazy import lazy_import
+from metrics import counter, gauge, histogram
+from logger import get_logger
+
+requests = lazy_import("requests")
+
+log = get_logger("ami.llm")
+
+LLM_REQUESTS = counter("ami_llm_requests_total", "Запросы к LLM-бэкендам по результату", ("backend", "result"))
+LLM_LATENCY = histogram("ami_llm_backend_seconds", "Длительность запроса к LLM-бэкенду", ("backend",))
+LLM_HEDGED = counter("ami_llm_hedged_total", "Запросы, продублированные на второй бэкенд после дедлайна")
+
+
+class LLMUnavailable(RuntimeError):
+    """Ни один бэкенд не ответил"""
+
+
+class LLMBackend(ABC):
+    """
+    Источник ответов модели: Gradio Space, локальный сервер и т.п.
+    max_concurrency - сколько запросов к бэкенду выполняется одновременно,
+    остальные ждут в его собственной очереди.
+    """
+
+    def __init__(self, name: str, max_concurrency: int = 4):
+        self.name = name
+        self.max_concurrency = max_concurrency
+
+    @abstractmethod
+    def complete(self, query: str, history: List[List[str]], system: str) -> str:
+        pass
+
+    def health_check(self) -> bool:
+        """Проверка доступности для возврата бэкенда после сбоев"""
+        return True
+
+    def warm_up(self, system: str) -> None:
+        """Подготовка к первому запросу (подключение, системный промпт)"""
+
+    def close(self) -> None:
+        """Освобождает соединения при остановке"""
+
+
+class GradioBackend(LLMBackend):
+    """Публичный или приватный Gradio Space с чат-эндпоинтом в формате Qwen demo"""
+
+    def __init__(self, space: str, api_name: str = "/model_chat", params: Optional[Dict[str, Any]] = None,
+                 system_api_name: Optional[str] = "/modify_system_session", name: Optional[str] = None,
+                 timeout: float = 60, max_concurrency: int = 4):
+        super().__init__(name or space, max_concurrency)
+        self.space = space
+        self.timeout = timeout
+        self.api_name = api_name
+        self.params = params or {}
+        self.system_api_name = system_api_name
+        self._client = None
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self):
+        # Подключение к Space занимает секунды, поэтому клиент создается при первом обращении
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    from gradio_client import Client
+                    self._client = Client(self.space)
+                    log.info("llm_client_ready", backend=self.name)
+        return self._client
+
+    def complete(self, query: str, history: List[List[str]], system: str) -> str:
+        # predict() ждет ответа без ограничения; через submit() задание отменяется по таймауту
+        job = self.client.submit(
+            query=query,
+            history=history,
+            system=system,
+            api_name=self.api_name,
+            **self.params
+        )
+        try:
+            result = job.result(timeout=self.timeout)
+        except FutureTimeout:
+            job.cancel()
+            raise
+        return result[1][-1][1]
+
+    def health_check(self) -> bool:
+        # Создание клиента запрашивает конфигурацию Space и падает, если он недоступен
+        from gradio_client import Client
+        client = Client(self.space)
+        with self._client_lock:
+            self._client = client
+        return True
+
+    def warm_up(self, system: str) -> None:
+        if self.system_api_name:
+            self.client.predict(system=system, api_name=self.system_api_name)
+
+    def close(self) -> None:
+        with self._client_lock:
+            client, self._client = self._client, None
+        # В старых версиях gradio_client у клиента нет close()
+        close = getattr(client, "close", None)
+        if close is not None:
+            close()
+
+
+class OpenAICompatibleBackend(LLMBackend):
+    """Любой сервер с API /v1/chat/completions (vLLM, llama.cpp, Ollama, LM Studio)"""
+
+    def __init__(self, base_url: str, model: str, api_key: Optional[str] = None,
+                 timeout: float = 60, params: Optional[Dict[str, Any]] = None, name: Optional[str] = None,
+                 max_concurrency: int = 4):
+        super().__init__(name or f"{base_url}#{model}", max_concurrency)
+        self.base_url = base_url.rstrip("/")
+        self.model = model
+        self.timeout = timeout
+        self.params = params or {}
+        self.headers = {"Content-Type": "application/json"}
+        if api_key:
+            self.headers["Authorization"] = f"Bearer {api_key}"
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    @property
+    def session(self):
+        # Одна сессия на бэкенд: соединения с сервером переиспользуются между запросами
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    session = requests.Session()
+                    session.headers.update(self.headers)
+                    self._session = session
+        return self._session
+
+    def complete(self, query: str, history: List[List[str]], system: str) -> str:
+        messages = [{"role": "system", "content": system}]
+        for user_text, reply in history:
+            messages.append({"role": "user", "content": user_text})
+            messages.append({"role": "assistant", "content": reply})
+        messages.append({"role": "user", "content": query})
+
+        response = self.session.post(
+            f"{self.base_url}/chat/completions",
+            json={"model": self.model, "messages": messages, **self.params},
+            timeout=self.timeout
+        )
+        response.raise_for_status()
+        return response.json()["choices"][0]["message"]["content"]
+
+    def health_check(self) -> bool:
+        response = self.session.get(f"{self.base_url}/models", timeout=5)
+        return response.ok
+
+    def close(self) -> None:
+        with self._session_lock:
+            session, self._session = self._session, None
+        if session is not None:
+            session.close()
+
+
+class CircuitBreaker:
+    """
+    После failure_threshold ошибок подряд бэкенд исключается на reset_timeout секунд,
+    затем пропускается один пробный запрос (half-open).
+    """
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def ready(self) -> bool:
+        """Можно ли попробовать бэкенд (без захвата пробного запроса)"""
+        return self.opened_at is None or (not self._probing and time.monotonic() - self.opened_at >= self.reset_timeout)
+
+    def allow(self) -> bool:
+        """Разрешает запрос; в состоянии half-open пропускает только один"""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self._probing or time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class _BackendState:
+    """Скользящая статистика задержек бэкенда и его собственный пул потоков"""
+
+    def __init__(self, backend: LLMBackend, breaker: CircuitBreaker, alpha: float = 0.2, window: int = 100):
+        self.backend = backend
+        self.breaker = breaker
+        # Отдельный пул: медленный или зависший бэкенд не занимает потоки остальных
+        self.executor = ThreadPoolExecutor(max_workers=backend.max_concurrency,
+                                           thread_name_prefix=f"llm-{backend.name}")
+        self.alpha = alpha
+        self.ewma: Optional[float] = None
+        self.samples: deque = deque(maxlen=window)
+
+    def observe(self, latency: float) -> None:
+        self.samples.append(latency)
+        self.ewma = latency if self.ewma is None else self.alpha * latency + (1 - self.alpha) * self.ewma
+
+    def p95(self) -> Optional[float]:
+        if len(self.samples) < 10:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[int(0.95 * (len(ordered) - 1))]
+
+
+class LLMRouter:
+    """
+    Маршрутизатор запросов между несколькими LLM-бэкендами.
+
+    Запрос идет на доступный бэкенд с наименьшей EWMA-задержкой. Если ответа нет
+    дольше p95 этого бэкенда, запрос дублируется на следующий (hedging), и берется
+    первый успешный ответ. Ошибка переключает запрос на следующий бэкенд, а серия
+    ошибок (в том числе запросов, не успевших к timeout) размыкает circuit breaker.
+    Разомкнутые бэкенды проверяются в фоне.
+    """
+
+    def __init__(self, backends: List[LLMBackend], hedge: bool = True, hedge_delay: float = 8.0,
+                 min_hedge_delay: float = 1.0, timeout: float = 90.0, health_interval: float = 30.0,
+                 failure_threshold: int = 3, reset_timeout: float = 30.0):
+        if not backends:
+            raise ValueError("Нужен хотя бы один LLM-бэкенд")
+        self.states = [_BackendState(b, CircuitBreaker(failure_threshold, reset_timeout)) for b in backends]
+        self.hedge = hedge
+        self.hedge_delay = hedge_delay
+        self.min_hedge_delay = min_hedge_delay
+        self.timeout = timeout
+        self.health_interval = health_interval
+        self._health_thread: Optional[threading.Thread] = None
+        self._closed = threading.Event()
+        gauge("ami_llm_backends_open", "Бэкенды с разомкнутым circuit breaker",
+              fn=lambda: sum(state.breaker.is_open for state in self.states))
+
+    def _candidates(self) -> List[_BackendState]:
+        # Сначала бэкенды без недавних ошибок; без статистики - в порядке конфигурации, чтобы получить замеры
+        available = [state for state in self.states if state.breaker.ready()]
+        return sorted(available, key=lambda state: (state.breaker.failures, state.ewma or 0.0))
+
+    def _call(self, state: _BackendState, query: str, history: List[List[str]], system: str,
+              expired: threading.Event) -> str:
+        start = time.perf_counter()
+        try:
+            reply = state.backend.complete(query, history, system)
+        except Exception as e:
+            if not expired.is_set():
+                state.breaker.record_failure()
+                LLM_REQUESTS.labels(state.backend.name, "error").inc()
+            log.warning("llm_backend_failed", backend=state.backend.name, error=e)
+            raise
+        elapsed = time.perf_counter() - start
+        if expired.is_set():
+            # Ответ пришел после timeout: запрос уже засчитан как ошибка
+            log.info("llm_backend_late", backend=state.backend.name, seconds=round(elapsed, 3))
+            return reply
+        state.observe(elapsed)
+        state.breaker.record_success()
+        LLM_LATENCY.labels(state.backend.name).observe(elapsed)
+        LLM_REQUESTS.labels(state.backend.name, "ok").inc()
+        return reply
+
+    def _hedge_after(self, state: _BackendState) -> float:
+        p95 = state.p95()
+        return max(self.min_hedge_delay, p95 if p95 is not None else self.hedge_delay)
+
+    def complete(self, query: str, history: List[List[str]], system: str) -> str:
+        """Возвращает первый успешный ответ; LLMUnavailable, если все бэкенды отказали или истек timeout"""
+        candidates = self._candidates()
+        if not candidates:
+            raise LLMUnavailable("Все LLM-бэкенды недоступны")
+
+        history = [list(item) for item in history]
+        deadline = time.monotonic() + self.timeout
+        pending: Dict[Future, _BackendState] = {}
+        last_error: Optional[BaseException] = None
+        expired = threading.Event()
+
+        def launch() -> Optional[_BackendState]:
+            while candidates:
+                state = candidates.pop(0)
+                if state.breaker.allow():
+                    future = state.executor.submit(self._call, state, query, history, system, expired)
+                    pending[future] = state
+                    return state
+            return None
+
+        primary = launch()
+        if primary is None:
+            raise LLMUnavailable("Все LLM-бэкенды недоступны")
+        hedge_at = time.monotonic() + self._hedge_after(primary) if self.hedge else None
+
+        while pending:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            wait_until = deadline if hedge_at is None else min(deadline, hedge_at)
+            done, _ = wait(list(pending), timeout=max(0.0, wait_until - now), return_when=FIRST_COMPLETED)
+
+            for future in done:
+                pending.pop(future)
+                try:
+                    return future.result()
+                except Exception as e:
+                    last_error = e
+                    # Ошибка не ждет дедлайна: сразу пробуем следующий бэкенд
+                    if not pending:
+                        primary = launch()
+                        if primary is not None and hedge_at is not None:
+                            hedge_at = time.monotonic() + self._hedge_after(primary)
+
+            if not done and hedge_at is not None and time.monotonic() >= hedge_at:
+                hedge_at = None
+                hedged = launch()
+                if hedged is not None:
+                    LLM_HEDGED.inc()
+                    log.info("llm_hedged", primary=primary.backend.name, backend=hedged.backend.name)
+
+        if pending:
+            expired.set()
+            for future, state in pending.items():
+                # Запрос, еще ждущий в очереди бэкенда, снимается; начатый засчитывается как ошибка
+                future.cancel()
+                state.breaker.record_failure()
+                LLM_REQUESTS.labels(state.backend.name, "timeout").inc()
+                log.warning("llm_backend_timeout", backend=state.backend.name, timeout=self.timeout)
+            raise LLMUnavailable(f"LLM не ответила за {self.timeout} с")
+        raise LLMUnavailable(f"Все LLM-бэкенды вернули ошибку: {last_error}")
+
+    def warm_up(self, system: str) -> None:
+        """Параллельно подключается ко всем бэкендам"""
+        def run(state: _BackendState):
+            try:
+                state.backend.warm_up(system)
+            except Exception as e:
+                state.breaker.record_failure()
+                log.error("llm_warm_up_failed", backend=state.backend.name, error=e)
+
+        for future in [state.executor.submit(run, state) for state in self.states]:
+            future.result()
+
+    def _check_health(self) -> None:
+        for state in self.states:
+            if not state.breaker.is_open:
+                continue
+            try:
+                healthy = state.backend.health_check()
+            except Exception as e:
+                healthy = False
+                log.debug("llm_health_check_failed", backend=state.backend.name, error=e)
+            if healthy:
+                state.breaker.record_success()
+                log.info("llm_backend_recovered", backend=state.backend.name)
+
+    def start_health_checks(self) -> None:
+        """Фоновая проверка бэкендов с разомкнутым circuit breaker"""
+        def loop():
+            while not self._closed.wait(self.health_interval):
+                self._check_health()
+
+        if self._health_thread is None:
+            self._health_thread = threading.Thread(target=loop, name="llm-health", daemon=True)
+            self._health_thread.start()
+
+    def close(self) -> None:
+        """Останавливает проверки и закрывает соединения бэкендов"""
+        self._closed.set()
+        for state in self.states:
+            state.executor.shutdown(wait=False, cancel_futures=True)
+            try:
+                state.backend.close()
+            except Exception as e:
+                log.warning("llm_backend_close_failed", backend=state.backend.name, error=e)
+
+
+def build_backend(spec: Dict[str, Any]) -> LLMBackend:
+    """Создает бэкенд по описанию из Config.LLM_BACKENDS"""
+    spec = dict(spec)
+    kind = spec.pop("type")
+    if kind == "gradio":
+        return GradioBackend(**spec)
+    if kind == "openai":
+        return OpenAICompatibleBackend(**spec)
+    raise ValueError(f"Неизвестный тип LLM-бэкенда: {kind}")
@@ -0,0 +1,374 @@
+"""
+Нагрузочный стенд для TelegramBot.handle_message без доступа к сети.
+
+Gradio, Google, ElevenLabs и Bot API заменяются локальными заглушками с настраиваемой
+задержкой. Сообщения генерируются синтетически или читаются из записанного JSON
+(список update или message объектов). В конце печатается отчет: сообщений в секунду
+с учетом дообработки очередей, p50/p95/p99 задержки обработки и задержки от сообщения
+до отправки ответа, использование памяти во времени.
+
+Пример:
+    python loadtest.py --messages 2000 --concurrency 16 --llm-latency 0.2 --output report.json
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Tuple
+
+import telebot
+
+from config import Config
+from ai_client import AIClient
+from llm_router import LLMBackend, LLMRouter
+from find_data import GoogleScraper
+from voice_generator import VoiceGenerator
+from sentimental import SentimentClassifier
+from rate_limiter import RateLimiter
+from outbox import OutboundScheduler
+from singleflight import CoalescingScraper, CoalescingVoiceGenerator
+from main import TelegramBot
+
+
+class FakeLLMBackend(LLMBackend):
+    """LLM-бэкенд, отвечающий через заданное время"""
+
+    def __init__(self, latency: float):
+        super().__init__("fake")
+        self.latency = latency
+
+    def complete(self, query: str, history: List[List[str]], system: str) -> str:
+        time.sleep(self.latency)
+        return f"Ответ на: {query[-40:]}"
+
+
+class FakeAIClient(AIClient):
+    """AIClient с настоящими маршрутизатором и SingleFlight поверх FakeLLMBackend, без клиента Gradio"""
+
+    def __init__(self, latency: float):
+        super().__init__(router=LLMRouter([FakeLLMBackend(latency)], hedge=False))
+
+    def call_in_start(self) -> None:
+        pass
+
+
+class FakeGoogleScraper(GoogleScraper):
+    """Поиск и загрузка страниц без сети; разбор и склейка результатов остаются настоящими"""
+
+    def __init__(self, latency: float):
+        super().__init__(api_key="fake", cx="fake")
+        self.latency = latency
+
+    def get_first_two_links(self, query: str) -> List[str]:
+        time.sleep(self.latency)
+        return ["https://example.com/a", "https://example.org/b"]
+
+    def extract_content(self, url: str) -> Dict[str, str]:
+        time.sleep(self.latency)
+        content = "Марс - четвертая по удаленности от Солнца планета Солнечной системы. " * 20
+        return {"url": url, "title": "Марс", "content": content, "domain": "example.com"}
+
+    def search_images(self, query: str, num: int = 5) -> List[str]:
+        time.sleep(self.latency)
+        return [f"https://example.com/img{i}.jpg" for i in range(num)]
+
+    def check_image(self, url: str, max_bytes: int = 5 * 1024 * 1024, timeout: float = 3.0) -> bool:
+        time.sleep(self.latency)
+        return True
+
+
+class FakeVoiceGenerator(VoiceGenerator):
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    def synthesize(self, text: str) -> bytes:
+        time.sleep(self.latency)
+        return b"\x00" * 1024
+
+    def generate(self, text: str) -> str:
+        fd, path = tempfile.mkstemp(suffix=".mp3")
+        with os.fdopen(fd, "wb") as f:
+            f.write(self.synthesize(text))
+        return path
+
+
+class FakeBot(telebot.TeleBot):
+    """
+    TeleBot, у которого сетевые методы заменены задержкой и подсчетом вызовов.
+    Время первой отправки в ответ на сообщение запоминается в sent_at
+    по ключу (chat_id, message_id исходного сообщения).
+    """
+
+    def __init__(self, latency: float, members_count: int = 50):
+        super().__init__("0:fake", threaded=False)
+        self.latency = latency
+        self.members_count = members_count
+        self.calls: Dict[str, int] = {}
+        self._calls_lock = threading.Lock()
+        self._message_id = 0
+        self.sent_at: Dict[Tuple[int, int], float] = {}
+
+    def _call(self, method: str, chat_id=None, reply_to: Optional[int] = None) -> SimpleNamespace:
+        time.sleep(self.latency)
+        sent = time.perf_counter()
+        with self._calls_lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            if reply_to is not None:
+                self.sent_at.setdefault((chat_id, reply_to), sent)
+            self._message_id += 1
+            message_id = self._message_id
+        return SimpleNamespace(
+            message_id=message_id,
+            photo=[SimpleNamespace(file_id=f"photo{message_id}")],
+            voice=SimpleNamespace(file_id=f"voice{message_id}")
+        )
+
+    def send_message(self, chat_id, text, *args, **kwargs):
+        return self._call("send_message", chat_id, kwargs.get("reply_to_message_id"))
+
+    def reply_to(self, message, text, **kwargs):
+        return self._call("send_message", message.chat.id, message.message_id)
+
+    def send_photo(self, chat_id, photo, *args, **kwargs):
+        return self._call("send_photo", chat_id, kwargs.get("reply_to_message_id"))
+
+    def send_voice(self, chat_id, voice, *args, **kwargs):
+        return self._call("send_voice", chat_id, kwargs.get("reply_to_message_id"))
+
+    def edit_message_text(self, *args, **kwargs):
+        return self._call("edit_message_text")
+
+    def get_chat_members_count(self, chat_id):
+        time.sleep(self.latency)
+        return self.members_count
+
+    def get_chat_member(self, chat_id, user_id):
+        time.sleep(self.latency)
+        return SimpleNamespace(status="member")
+
+
+# Шаблоны текстов: упоминания и триггеры голосовых ответов, картинок и поиска
+MESSAGE_TEMPLATES = [
+    "привет всем, как дела?",
+    "ами, что думаешь про погоду?",
+    "ами, озвучь что-нибудь смешное",
+    "ами, покажи фото котика",
+    "ами, найди что такое марс",
+    "это было очень хорошо, спасибо",
+    "ужасный день, все плохо",
+]
+
+
+def synthetic_messages(count: int, users: int, chats: int, private_share: float) -> List[dict]:
+    """Генерирует сообщения в личных чатах и супергруппах, часть - ответы боту"""
+    now = int(time.time()) + 60
+    messages = []
+    for i in range(count):
+        user_id = random.randint(1, users)
+        private = random.random() < private_share
+        chat = {"id": user_id, "type": "private"} if private else {"id": -1000 - random.randint(1, chats), "type": "supergroup"}
+        message = {
+            "message_id": i + 1,
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"},
+            "chat": chat,
+            "date": now,
+            "text": random.choice(MESSAGE_TEMPLATES),
+        }
+        if not private and random.random() < 0.1:
+            message["reply_to_message"] = {
+                "message_id": i,
+                "from": {"id": Config.BOT_ID, "is_bot": True, "first_name": "Ami"},
+                "chat": chat,
+                "date": now,
+                "text": "предыдущий ответ",
+            }
+        messages.append(message)
+    return messages
+
+
+def recorded_messages(path: str) -> List[dict]:
+    """Читает записанные update или message объекты; дата сдвигается, чтобы пройти фильтр"""
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    now = int(time.time()) + 60
+    messages = []
+    for item in data if isinstance(data, list) else [data]:
+        message = item.get("message", item)
+        if "chat" in message:
+            message["date"] = now
+            messages.append(message)
+    return messages
+
+
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def build_bot(args, data_dir: str) -> TelegramBot:
+    Config.DEBOUNCE_WINDOW = args.debounce_window
+    bot = TelegramBot(
+        token="0:fake",
+        ai_client=FakeAIClient(args.llm_latency),
+        voice_generator=CoalescingVoiceGenerator(FakeVoiceGenerator(args.tts_latency)),
+        google_scraper=CoalescingScraper(FakeGoogleScraper(args.search_latency)),
+        sentimental_user=SentimentClassifier(),
+        bot=FakeBot(args.api_latency),
+        data_dir=data_dir,
+    )
+    if not args.real_limits:
+        # Пользовательские лимиты и flood-лимиты Telegram не должны ограничивать стенд
+        bot.user_limiter = RateLimiter([(60, 10 ** 9)])
+        bot.chat_limiter = RateLimiter([(60, 10 ** 9)])
+        bot.outbox = OutboundScheduler(bot.bot, Config.BOT_ID, global_rate=10 ** 6,
+                                       private_rate=10 ** 6, group_per_minute=10 ** 8)
+    return bot
+
+
+def latency_summary(values: List[float]) -> Dict[str, float]:
+    return {
+        "p50": round(percentile(values, 50) * 1000, 2),
+        "p95": round(percentile(values, 95) * 1000, 2),
+        "p99": round(percentile(values, 99) * 1000, 2),
+        "max": round(max(values, default=0) * 1000, 2),
+    }
+
+
+def run(args) -> dict:
+    with tempfile.TemporaryDirectory(prefix="ami-loadtest-") as data_dir:
+        return _run(args, data_dir)
+
+
+def _run(args, data_dir: str) -> dict:
+    bot = build_bot(args, data_dir)
+    if args.recorded:
+        raw = recorded_messages(args.recorded)
+    else:
+        raw = synthetic_messages(args.messages, args.users, args.chats, args.private_share)
+    messages = [telebot.types.Message.de_json(m) for m in raw]
+
+    latencies: List[float] = []
+    received_at: Dict[Tuple[int, int], float] = {}
+    latencies_lock = threading.Lock()
+    memory: List[dict] = []
+    stop = threading.Event()
+    started = time.perf_counter()
+
+    def sample_memory():
+        while not stop.is_set():
+            memory.append({"t": round(time.perf_counter() - started, 2), "rss_mb": round(rss_bytes() / 2 ** 20, 1)})
+            stop.wait(args.memory_interval)
+
+    def handle(item):
+        index, message = item
+        if args.rate:
+            # Открытая модель нагрузки: сообщение обрабатывается не раньше своего времени
+            delay = started + index / args.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        start = time.perf_counter()
+        with latencies_lock:
+            received_at[(message.chat.id, message.message_id)] = start
+        if bot._message_filter(message):
+            bot.handle_message(message)
+        elapsed = time.perf_counter() - start
+        with latencies_lock:
+            latencies.append(elapsed)
+
+    sampler = threading.Thread(target=sample_memory, daemon=True)
+    sampler.start()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(handle, enumerate(messages)))
+
+    # Ждем, как при остановке бота, пока завершатся начатые ответы и опустеет очередь отправки:
+    # ответы, отправленные после handle_message (серии сообщений, очередь outbox), входят в замер
+    left = bot.lifecycle.drain(args.drain_timeout)
+    if left:
+        print(f"Не завершено за {args.drain_timeout} с: {left}")
+    drained_at = time.perf_counter()
+    stop.set()
+    sampler.join()
+    bot.lifecycle.shutdown("loadtest_finished")
+
+    # Сообщения, объединенные в серию, получают один ответ на последнее сообщение серии
+    reply_latencies = [
+        sent - received_at[key] for key, sent in bot.bot.sent_at.items() if key in received_at
+    ]
+    duration = drained_at - started
+    return {
+        "messages": len(messages),
+        "duration_s": round(duration, 3),
+        "messages_per_sec": round(len(messages) / duration, 1) if duration else 0.0,
+        "latency_ms": latency_summary(latencies),
+        "replied": len(reply_latencies),
+        "reply_latency_ms": latency_summary(reply_latencies),
+        "api_calls": dict(bot.bot.calls),
+        "memory": memory,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест TelegramBot с локальными заглушками")
+    parser.add_argument("--messages", type=int, default=1000, help="число синтетических сообщений")
+    parser.add_argument("--recorded", help="JSON-файл с записанными update/message")
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--chats", type=int, default=200)
+    parser.add_argument("--private-share", type=float, default=0.3)
+    parser.add_argument("--concurrency", type=int, default=16, help="число потоков обработки")
+    parser.add_argument("--rate", type=float, default=0, help="целевой поток сообщений/с (0 - без ограничения)")
+    parser.add_argument("--llm-latency", type=float, default=0.05)
+    parser.add_argument("--search-latency", type=float, default=0.02)
+    parser.add_argument("--tts-latency", type=float, default=0.05)
+    parser.add_argument("--api-latency", type=float, default=0.005)
+    parser.add_argument("--debounce-window", type=float, default=Config.DEBOUNCE_WINDOW,
+                        help="окно объединения сообщений пользователя, с (0 - выключено)")
+    parser.add_argument("--real-limits", action="store_true", help="оставить пользовательские и flood-лимиты")
+    parser.add_argument("--memory-interval", type=float, default=1.0)
+    parser.add_argument("--drain-timeout", type=float, default=30.0)
+    parser.add_argument("--output", help="куда записать отчет в JSON")
+    parser.add_argument("--max-p95-ms", type=float, help="завершиться с ошибкой, если p95 выше порога")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    report = run(args)
+
+    latency = report["latency_ms"]
+    peak = max((m["rss_mb"] for m in report["memory"]), default=0)
+    print(f"Сообщений: {report['messages']} за {report['duration_s']} с ({report['messages_per_sec']} сообщ./с)")
+    print(f"Задержка, мс: p50={latency['p50']} p95={latency['p95']} p99={latency['p99']} max={latency['max']}")
+    reply = report["reply_latency_ms"]
+    print(f"От сообщения до ответа ({report['replied']} ответов), мс: "
+          f"p50={reply['p50']} p95={reply['p95']} p99={reply['p99']} max={reply['max']}")
+    print(f"Вызовы Bot API: {report['api_calls']}")
+    print(f"Пиковая память: {peak} МБ")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.max_p95_ms is not None and latency["p95"] > args.max_p95_ms:
+        print(f"p95 {latency['p95']} мс превышает порог {args.max_p95_ms} мс")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+from typing import Dict, Optional
+
+# Максимальная длина строкового поля в записи лога
+MAX_FIELD_LENGTH = 300
+
+_sample_rates: Dict[str, float] = {}
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def _truncate(value, limit: int):
+    if isinstance(value, str):
+        return value if len(value) <= limit else f"{value[:limit]}...(+{len(value) - limit})"
+    if isinstance(value, (int, float, bool)) or value is None:
+        return value
+    return _truncate(str(value), limit)
+
+
+class JsonFormatter(logging.Formatter):
+    """Форматирует запись в одну JSON-строку; большие поля обрезаются уже в фоновом потоке"""
+
+    def __init__(self, max_field_length: int = MAX_FIELD_LENGTH):
+        super().__init__()
+        self.max_field_length = max_field_length
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "event": record.msg,
+        }
+        for key, value in getattr(record, "fields", {}).items():
+            data[key] = _truncate(value, self.max_field_length)
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler без форматирования в вызывающем потоке"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class StructLogger:
+    """
+    Обертка над logging.Logger для событий с именованными полями:
+    log.info("llm_response", chat_id=1, text=response)
+    """
+
+    def __init__(self, name: str):
+        self._logger = logging.getLogger(name)
+
+    def _log(self, level: int, event: str, fields: dict, exc_info=None) -> None:
+        if not self._logger.isEnabledFor(level):
+            return
+        rate = _sample_rates.get(event)
+        if rate is not None and random.random() >= rate:
+            return
+        record = self._logger.makeRecord(
+            self._logger.name, level, "", 0, event, (), exc_info, extra={"fields": fields}
+        )
+        self._logger.handle(record)
+
+    def debug(self, event: str, **fields) -> None:
+        self._log(logging.DEBUG, event, fields)
+
+    def info(self, event: str, **fields) -> None:
+        self._log(logging.INFO, event, fields)
+
+    def warning(self, event: str, **fields) -> None:
+        self._log(logging.WARNING, event, fields)
+
+    def error(self, event: str, **fields) -> None:
+        self._log(logging.ERROR, event, fields)
+
+    def exception(self, event: str, **fields) -> None:
+        self._log(logging.ERROR, event, fields, exc_info=sys.exc_info())
+
+
+def get_logger(name: str) -> StructLogger:
+    return StructLogger(name)
+
+
+def configure_logging(level: str = "INFO", sample_rates: Optional[Dict[str, float]] = None,
+                      max_field_length: int = MAX_FIELD_LENGTH, stream=None) -> None:
+    """
+    Настраивает запись логов через очередь и фоновый поток.
+
+    Args:
+        level: минимальный уровень ("DEBUG", "INFO", ...)
+        sample_rates: доля записываемых событий по имени события, например {"prompt": 0.01}
+        max_field_length: максимальная длина строкового поля
+        stream: поток вывода (по умолчанию stdout)
+    """
+    global _listener
+    _sample_rates.clear()
+    _sample_rates.update(sample_rates or {})
+
+    if _listener is not None:
+        _listener.stop()
+
+    log_queue: queue.Queue = queue.Queue(-1)
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter(max_field_length))
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=False)
+
+    root = logging.getLogger()
+    root.handlers = [_DeferredQueueHandler(log_queue)]
+    root.setLevel(level)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging() -> None:
+    """Дописывает накопленные записи и останавливает фоновый поток"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
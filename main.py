@@ -4,23 +4,46 @@ import time
 import random
 import threading
 import json
-from datetime import datetime, timedelta
+import dataclasses
 from typing import Optional, List, Dict, Any, Callable
-from cachetools import TTLCache
 from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
 
 # Предполагаем наличие этих модулей
 from config import Config
 from ai_client import AIClient
+from llm_router import LLMRouter, build_backend
 from find_data import GoogleScraper
+from doc_index import DocumentIndex
 from voice_generator import ElevenLabsVoiceGenerator, VoiceGenerator
 from context import ContextManager,MessageContext
 from sentimental import SentimentClassifier
+from mood import MoodTracker
+from rate_limiter import RateLimiter
+from chat_cache import ChatMetadataCache
+from broadcast import BroadcastManager
+from state_store import StateStore
+from webhook import WebhookServer
+from outbox import OutboundScheduler
+from metrics import timed, start_metrics_server
+from logger import get_logger, configure_logging
+from profiler import ProfilerService
+from stages import Stage, run_stages
+from debounce import Debouncer
+from admission import AdmissionController, DEFER, SHED
+from sharding import ShardedRunner, migrate_shard_data
+from lifecycle import Lifecycle, PHASE_INTAKE, PHASE_DRAIN, PHASE_FLUSH, PHASE_CLOSE
+from singleflight import CoalescingScraper, CoalescingVoiceGenerator
+from image_pipeline import ImagePipeline, is_source_error
+
+log = get_logger("ami.bot")
 
 class ResponseTriggerManager:
     """Класс для централизованного управления условиями ответа бота"""
     
-    def __init__(self):
+    def __init__(self, admission: Optional[AdmissionController] = None):
+        # Контроль нагрузки: под нагрузкой случайные ответы становятся реже
+        self.admission = admission
         # Словарь ключевых слов для различных действий
         self.action_keywords = {
             "voice_generation": ["расскажи", "озвучь", "прочитай"],
@@ -60,7 +83,7 @@ class ResponseTriggerManager:
             return True
         
         # Если это ответ на сообщение бота - всегда отвечаем
-        if message.reply_to_message and message.reply_to_message.from_user.id == 7879944695:
+        if message.reply_to_message and message.reply_to_message.from_user.id == Config.BOT_ID:
             return True
         
         # Проверка на упоминание бота по ключевым словам
@@ -69,7 +92,10 @@ class ResponseTriggerManager:
             return True
             
         # Случайный ответ с заданной вероятностью
-        if random.random() < self.random_reply_chance:
+        chance = self.random_reply_chance
+        if self.admission is not None:
+            chance = self.admission.random_reply_chance(chance)
+        if random.random() < chance:
             return True
             
         return False
@@ -89,89 +115,178 @@ class ResponseTriggerManager:
         return None
 
 class ResponseGenerator:
-    def __init__(self, ai_client: AIClient, google_scraper: GoogleScraper, context_manager: ContextManager,sentimental_user:SentimentClassifier):
+    def __init__(self, ai_client: AIClient, google_scraper: GoogleScraper, context_manager: ContextManager,sentimental_user:SentimentClassifier,
+                 mood_tracker: Optional[MoodTracker] = None):
         self.ai_client = ai_client
         self.google_scraper = google_scraper
         self.sentimental_user = sentimental_user
         self.context_manager = context_manager
-        self.response_cache = TTLCache(maxsize=100, ttl=300)
-        self._executor = ThreadPoolExecutor(max_workers=4)
-        self._lock = threading.Lock()
+        # Скользящее настроение пользователей и чатов; без него учитывается только текущее сообщение
+        self.mood_tracker = mood_tracker
+        # Пул этапов ответа; вызывающий код не должен выполняться в этом же пуле
+        self._executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="response-stage")
 
-    def get_cached_response(self, query_hash: str) -> Optional[str]:
-        return self.response_cache.get(query_hash)
+    def _update_context(self, msg_context: MessageContext) -> List[Dict]:
+        # Обновление контекста и выбор релевантных сообщений для промпта
+        self.context_manager.update_context(msg_context)
+        return self.context_manager.select_context(msg_context, Config.CONTEXT_TOKEN_BUDGET, Config.CONTEXT_TOP_K)
 
-    def cache_response(self, query_hash: str, response: str) -> None:
-        self.response_cache[query_hash] = response
+    def _classify_mood(self, msg_context: MessageContext) -> str:
+        if self.mood_tracker is None:
+            mood = self.sentimental_user.classify(msg_context.text)
+        else:
+            # Среднее обновляется в TelegramBot.handle_message по каждому сообщению, здесь только читается
+            user_mood = self.mood_tracker.user_mood(msg_context.user_id)
+            if user_mood is None:
+                mood = self.sentimental_user.classify(msg_context.text)
+            else:
+                mood = self.sentimental_user.describe(user_mood)
+        log.debug("mood", chat_id=msg_context.chat_id, user_id=msg_context.user_id, mood=mood)
+        return mood
 
-    def generate_response(self, msg_context: MessageContext) -> str:
-        # Обновление контекста пользователя
-        self.context_manager.update_context(msg_context)
-        
-        # Получение контекста пользователя
-        context = self.context_manager.get_user_context(msg_context.chat_id, msg_context.user_id)
-        mood = self.sentimental_user.classify(msg_context.text)
-        print(mood)
+    def _search(self, msg_context: MessageContext) -> str:
+        if 'найди' not in msg_context.text.lower():
+            return ""
+        log.info("search_request", chat_id=msg_context.chat_id, query=msg_context.text)
+        search_data = self.google_scraper.get_content_with_fallback(msg_context.text.lower())
+        log.debug("search_result", chat_id=msg_context.chat_id, content=search_data)
+        return search_data or ""
+
+    def _build_prompt(self, msg_context: MessageContext, context: List[Dict], mood: Optional[str], search_data: str) -> str:
         prompt_parts = []
         if context:
             prompt_parts.append("Previous messages:")
-            for msg in context[-5:]:  # Последние 5 сообщений для контекста
-                prompt_parts.append(f"- {msg['text']}")
+            for msg in context:
+                # Сообщения других участников чата подписываются именем автора
+                if msg.get('user_id', msg_context.user_id) != msg_context.user_id:
+                    prompt_parts.append(f"- {msg.get('name') or 'user'}: {msg['text']}")
+                else:
+                    prompt_parts.append(f"- {msg['text']}")
         
         prompt_parts.append(f"\nCurrent message: {msg_context.text}")
         prompt_parts.append(f"[From user: {msg_context.first_name} (@{msg_context.username})]")
-        prompt_parts.append(f"[Your Mood: {mood}]")
+        if mood:
+            prompt_parts.append(f"[Your Mood: {mood}]")
+        if self.mood_tracker is not None and msg_context.chat_type != "private":
+            chat_mood = self.mood_tracker.chat_mood(msg_context.chat_id)
+            if chat_mood is not None:
+                prompt_parts.append(f"[Chat Mood: {self.sentimental_user.describe(chat_mood)}]")
         
         if msg_context.reply_to_message:
             prompt_parts.append(f"[Replying to: {msg_context.reply_to_message.get('text', '')}]")
         
         prompt = "\n".join(prompt_parts)
-        
-        # Безопасная обработка поиска
-        try:
-            if 'найди' in msg_context.text.lower():
-                print("Поиск:", msg_context.text.lower())
-                search_data = self.google_scraper.get_content_with_fallback(msg_context.text.lower())
-                print(search_data)
-                if search_data:
-                    prompt += f"\n[Search context: {search_data[:1000]}]"
-        except Exception as e:
-            print(f"Ошибка при поиске: {e}")
-        
+        if search_data:
+            prompt += f"\n[Search context: {search_data[:1000]}]"
+        return prompt
+
+    def _ask_llm(self, msg_context: MessageContext, context: List[Dict], mood: Optional[str], search_data: str) -> Optional[str]:
+        prompt = self._build_prompt(msg_context, context, mood, search_data)
         try:
-            send = self.ai_client.get_response(prompt)
-            return send
+            return self.ai_client.get_response(prompt)
         except Exception as e:
-            print(f"Ошибка при генерации ответа: {e}")
-            print(prompt)
+            log.error("llm_failed", chat_id=msg_context.chat_id, error=e, prompt=prompt)
+            return None
+
+    def response_stages(self, msg_context: MessageContext) -> List[Stage]:
+        """
+        Этапы формирования ответа: контекст, настроение и поиск выполняются параллельно,
+        запрос к модели ждет их всех. Упавший или опоздавший этап не попадает в промпт.
+        """
+        timeouts = Config.STAGE_TIMEOUTS
+        return [
+            Stage("context", lambda: self._update_context(msg_context), timeout=timeouts["context"], default=[]),
+            Stage("mood", lambda: self._classify_mood(msg_context), timeout=timeouts["mood"]),
+            Stage("search", lambda: self._search(msg_context), timeout=timeouts["search"], default=""),
+            Stage("reply", lambda context, mood, search_data: self._ask_llm(msg_context, context, mood, search_data),
+                  deps=("context", "mood", "search"), timeout=timeouts["llm"]),
+        ]
+
+    @timed("generate_response")
+    def generate_response(self, msg_context: MessageContext) -> Optional[str]:
+        return run_stages(self.response_stages(msg_context), self._executor)["reply"]
 
 class TelegramBot:
     def __init__(self, token: str, ai_client: AIClient, 
-                 voice_generator: VoiceGenerator, google_scraper: GoogleScraper,sentimental_user:SentimentClassifier):
+                 voice_generator: VoiceGenerator, google_scraper: GoogleScraper,sentimental_user:SentimentClassifier,
+                 bot: Optional[telebot.TeleBot] = None, data_dir: Optional[str] = None,
+                 state: Optional[StateStore] = None):
         try:
-            self.bot = telebot.TeleBot(token)
+            # Готовый экземпляр TeleBot можно передать снаружи (например, заглушку в нагрузочном тесте)
+            self.bot = bot or telebot.TeleBot(token)
+            data_dir = data_dir or os.path.join(os.path.dirname(__file__), "data")
+            # Кэш числа участников и статусов администраторов чатов
+            self.chat_cache = ChatMetadataCache(self.bot, workers=Config.CHAT_CACHE_WORKERS)
+            # Все исходящие сообщения идут через очередь с учетом flood-лимитов
+            self.outbox = OutboundScheduler(self.bot, Config.BOT_ID)
             
             # Создание менеджера контекста с указанием файла для хранения
-            context_storage_path = os.path.join(os.path.dirname(__file__), "data", "context_storage.pkl")
-            self.context_manager = ContextManager(context_storage_path)
+            self.context_manager = ContextManager(
+                os.path.join(data_dir, "context_storage.bin"), lazy=True,
+                legacy_file=os.path.join(data_dir, "context_storage.pkl"),
+                flush_interval=Config.CONTEXT_FLUSH_INTERVAL
+            )
+            
+            # Настроение пользователей и чатов хранится рядом с контекстами
+            self.mood_tracker = MoodTracker(
+                os.path.join(data_dir, "mood.bin"), alpha=Config.MOOD_ALPHA, half_life=Config.MOOD_HALF_LIFE,
+                flush_interval=Config.CONTEXT_FLUSH_INTERVAL
+            )
             
             # Создание генератора ответов с передачей менеджера контекста
-            self.response_generator = ResponseGenerator(ai_client, google_scraper, self.context_manager,sentimental_user)
+            self.response_generator = ResponseGenerator(ai_client, google_scraper, self.context_manager,sentimental_user,
+                                                        mood_tracker=self.mood_tracker)
+            # Отдельный пул для этапов уровня обработчика: они сами ждут этапы ResponseGenerator
+            self._stage_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="handler-stage")
             self.voice_generator = voice_generator
             self.start_time = time.time()
             self.google_scraper = google_scraper
+            # Поиск картинок с проверкой ссылок и кэшем file_id отправленных картинок
+            self.images = ImagePipeline(google_scraper, max_bytes=Config.IMAGE_MAX_BYTES,
+                                        check_timeout=Config.IMAGE_CHECK_TIMEOUT, maxsize=Config.IMAGE_CACHE_SIZE)
+            # Объединение серий коротких сообщений одного пользователя в один ответ
+            self.debouncer = Debouncer(self._flush_burst, window=Config.DEBOUNCE_WINDOW,
+                                       max_wait=Config.DEBOUNCE_MAX_WAIT)
+            # Ответы готовятся в потоках telebot и в пуле серий: больше одновременных запросов не бывает,
+            # а ждущие свободного потока серии и отложенные запросы учитываются как нагрузка
+            reply_workers = self.debouncer.workers + getattr(getattr(self.bot, "worker_pool", None), "num_threads", 0)
             # Создаем менеджер триггеров ответов
-            self.trigger_manager = ResponseTriggerManager()
+            self.admission = AdmissionController(
+                max_inflight=min(Config.ADMISSION_MAX_INFLIGHT, reply_workers),
+                max_queue=Config.ADMISSION_MAX_QUEUE,
+                latency_target=Config.ADMISSION_LATENCY_TARGET,
+                queue_depth=lambda: self.outbox.queue_depth,
+                backlog=lambda: self.debouncer.backlog,
+                execute=self.debouncer.execute,
+            )
+            self.trigger_manager = ResponseTriggerManager(self.admission)
             
             # Флаг активности бота - по умолчанию активен
             self.is_active = True
             
-            # Хранение отключенных чатов
-            self.inactive_chats = set()
-            self.user_message_counts = {}  # Format: {user_id: {"count": int, "reset_time": datetime}}
-            self.chat_message_counts = {}  # Format: {chat_id: {"count": int, "reset_time": datetime}}
+            # Общее для всех процессов состояние: отключенные и известные чаты, счетчики лимитов
+            self.state = state or StateStore(os.path.join(data_dir, "state.db"))
+            self.USER_MINUTE_LIMIT = 10
             self.USER_DAILY_LIMIT = 100
+            self.CHAT_MINUTE_LIMIT = 30
             self.CHAT_DAILY_LIMIT = 300
+            self.user_limiter = RateLimiter(
+                [(60, self.USER_MINUTE_LIMIT), (86400, self.USER_DAILY_LIMIT)],
+                store=self.state, name="user"
+            )
+            self.chat_limiter = RateLimiter(
+                [(60, self.CHAT_MINUTE_LIMIT), (86400, self.CHAT_DAILY_LIMIT)],
+                store=self.state, name="chat"
+            )
+            # Фоновый рассыльщик по известным чатам
+            self.broadcaster = BroadcastManager(self.bot, self.outbox, self.state)
+            # Профилирование по команде администратора
+            self.profiler = ProfilerService(self.outbox)
+            # Сервер webhook создается в run_webhook
+            self.webhook_server: Optional[WebhookServer] = None
+            # Остановка по SIGTERM/SIGINT с дообработкой начатых ответов и сохранением состояния
+            self.lifecycle = Lifecycle(drain_timeout=Config.SHUTDOWN_DRAIN_TIMEOUT)
+            self._register_shutdown()
             
             # Запуск фонового потока для периодической очистки старых контекстов
             self._start_cleanup_thread()
@@ -183,58 +298,69 @@ class TelegramBot:
             self.bot.message_handler(commands=['start_ami'])(self.handle_start_command)
             self.bot.message_handler(commands=['stop_ami'])(self.handle_stop_command)
             self.bot.message_handler(commands=['send_message'])(self.handle_send_message_command)
+            self.bot.message_handler(commands=['profile'])(self.handle_profile_command)
+            self.bot.message_handler(commands=['memprofile'])(self.handle_memprofile_command)
+            
+            # Инвалидация кэша метаданных чатов по обновлениям участников
+            self.bot.chat_member_handler()(self.chat_cache.handle_chat_member_update)
+            self.bot.my_chat_member_handler()(self.chat_cache.handle_my_chat_member_update)
+            self.bot.message_handler(content_types=['new_chat_members', 'left_chat_member'])(self.handle_members_changed)
             
             # Установка обработчиков сообщений
             self.bot.message_handler(func=self._message_filter)(self.handle_message)
         except Exception as e:
-            print(f"Ошибка инициализации бота: {e}")
+            log.error("bot_init_failed", error=e)
             raise
     def handle_send_message_command(self, message: telebot.types.Message) -> None:
       """Handler for /send_message command to broadcast messages"""
       user_id = message.from_user.id
       # Check if the sender is an admin
       if user_id != Config.ADMIN_ID:
-          self.bot.reply_to(message, "Только администраторы могут использовать эту команду.")
+          self.outbox.reply_to(message, "Только администраторы могут использовать эту команду.")
           return
           
       # Extract the message to send
       command_parts = message.text.split(' ', 1)
       if len(command_parts) < 2:
-          self.bot.reply_to(message, "Использование: /send_message <текст сообщения>")
+          self.outbox.reply_to(message, "Использование: /send_message <текст сообщения>")
           return
           
       broadcast_text = command_parts[1].strip()
       
-      # Get a list of all active chats (could be stored separately)
-      active_chats = set()
-      for chat_id in self.chat_message_counts.keys():
-          if chat_id not in self.inactive_chats:
-              active_chats.add(chat_id)
-      
-      # Add private chats from user message counts
-      for user_id in self.user_message_counts.keys():
-          # Assuming user_id is the chat_id for private chats
-          if user_id not in self.inactive_chats:
-              active_chats.add(user_id)
-      
-      # Send the message to all active chats
-      success_count = 0
-      failed_count = 0
+      # All known chats except the disabled ones
+      active_chats = [chat_id for chat_id in self.state.known_chats() if self.state.is_active(chat_id)]
       
-      for chat_id in active_chats:
-          try:
-              self.bot.send_message(chat_id, f"📢 Объявление:\n\n{broadcast_text}")
-              success_count += 1
-          except Exception as e:
-              print(f"Failed to send message to chat {chat_id}: {e}")
-              failed_count += 1
-      
-      # Notify the admin about the broadcast results
-      self.bot.reply_to(
-          message, 
-          f"Сообщение отправлено в {success_count} чатов.\n"
-          f"Не удалось отправить в {failed_count} чатов."
+      # The broadcast runs in the background and reports progress to the admin
+      job = self.broadcaster.start(
+          f"📢 Объявление:\n\n{broadcast_text}",
+          active_chats,
+          admin_chat_id=message.chat.id,
+          reply_to_message_id=message.message_id
       )
+      if job is None:
+          self.outbox.reply_to(message, "Предыдущая рассылка еще не завершена.")
+    def handle_profile_command(self, message: telebot.types.Message) -> None:
+        """Обработчик команды /profile [секунды] [top] - профилирование CPU всех потоков"""
+        if message.from_user.id != Config.ADMIN_ID:
+            self.outbox.reply_to(message, "Только администраторы могут использовать эту команду.")
+            return
+        seconds, top = self.profiler.parse_args(message.text)
+        if self.profiler.start_cpu(message.chat.id, seconds, top):
+            self.outbox.reply_to(message, f"Профилирование CPU запущено на {seconds} с.")
+        else:
+            self.outbox.reply_to(message, "Профилирование уже выполняется.")
+
+    def handle_memprofile_command(self, message: telebot.types.Message) -> None:
+        """Обработчик команды /memprofile [секунды] [top] - рост памяти по tracemalloc"""
+        if message.from_user.id != Config.ADMIN_ID:
+            self.outbox.reply_to(message, "Только администраторы могут использовать эту команду.")
+            return
+        seconds, top = self.profiler.parse_args(message.text, default_seconds=30)
+        if self.profiler.start_memory(message.chat.id, seconds, top):
+            self.outbox.reply_to(message, f"Снимки памяти будут сравнены через {seconds} с.")
+        else:
+            self.outbox.reply_to(message, "Профилирование уже выполняется.")
+
     def _register_bot_actions(self):
         """Регистрирует все действия бота в менеджере триггеров"""
         # Регистрация действий
@@ -248,62 +374,58 @@ class TelegramBot:
         
         # Здесь можно добавить новые ключевые слова для существующих действий
     def _check_message_limits(self, user_id, chat_id):
-      """Check if the user or chat has exceeded their daily message limit"""
-      current_time = datetime.now()
-      
-      # Check user limit
-      if user_id not in self.user_message_counts or current_time > self.user_message_counts[user_id]["reset_time"]:
-          self.user_message_counts[user_id] = {
-              "count": 0,
-              "reset_time": current_time + timedelta(days=1)
-          }
-      
-      self.user_message_counts[user_id]["count"] += 1
-      user_count = self.user_message_counts[user_id]["count"]
-      
-      # Check chat limit
-      if chat_id not in self.chat_message_counts or current_time > self.chat_message_counts[chat_id]["reset_time"]:
-          self.chat_message_counts[chat_id] = {
-              "count": 0,
-              "reset_time": current_time + timedelta(days=1)
-          }
-      
-      self.chat_message_counts[chat_id]["count"] += 1
-      chat_count = self.chat_message_counts[chat_id]["count"]
-      
-      # Return True if within limits, False otherwise
-      user_ok = user_count <= self.USER_DAILY_LIMIT
-      chat_ok = chat_count <= self.CHAT_DAILY_LIMIT
-      
-      return user_ok and chat_ok
+      """
+      Check the user and chat per-minute and daily message limits.
+      Returns None if the message is allowed, otherwise the limiter, its key and the exhausted window (seconds, limit).
+      """
+      now = time.time()
+      # Отклоненный запрос не учитывается: hit_window не считает его, если окно исчерпано,
+      # а учтенный лимитом пользователя отменяется, если его отклонил лимит чата
+      user_window = self.user_limiter.hit_window(user_id, now)
+      if user_window:
+          return self.user_limiter, user_id, user_window
+      chat_window = self.chat_limiter.hit_window(chat_id, now)
+      if chat_window:
+          self.user_limiter.release(user_id, now)
+          return self.chat_limiter, chat_id, chat_window
+      return None
+
+    def _limit_exceeded_text(self, limiter, key, window) -> str:
+        """Текст отказа для исчерпанного окна лимита"""
+        seconds, limit = window
+        owner = "Ваш лимит" if limiter is self.user_limiter else "Лимит чата"
+        if seconds < 3600:
+            # Без точного времени ожидания: одинаковые отказы схлопываются планировщиком
+            return f"Слишком много сообщений. {owner} {limit} в минуту, подождите немного"
+        hours, remainder = divmod(int(limiter.retry_after(key)), 3600)
+        minutes, _ = divmod(remainder, 60)
+        return f"Лимит сообщений превышен. Лимиты обновятся через {hours} ч. {minutes} мин. {owner} {limit} в сутки"
 
     def handle_start_command(self, message: telebot.types.Message) -> None:
         """Обработчик команды /start_ami для включения бота в чате"""
         # Проверка прав администратора
         if not self._is_admin(message):
-            self.bot.reply_to(message, "Только администраторы могут включать бота.")
+            self.outbox.reply_to(message, "Только администраторы могут включать бота.")
             return
             
         chat_id = message.chat.id
-        if chat_id in self.inactive_chats:
-            self.inactive_chats.remove(chat_id)
-            self.bot.reply_to(message, "Ами активирована в этом чате.")
+        if self.state.set_active(chat_id, True):
+            self.outbox.reply_to(message, "Ами активирована в этом чате.")
         else:
-            self.bot.reply_to(message, "Ами уже активна в этом чате.")
+            self.outbox.reply_to(message, "Ами уже активна в этом чате.")
 
     def handle_stop_command(self, message: telebot.types.Message) -> None:
         """Обработчик команды /stop_ami для отключения бота в чате"""
         # Проверка прав администратора
         if not self._is_admin(message):
-            self.bot.reply_to(message, "Только администраторы могут отключать Ами.")
+            self.outbox.reply_to(message, "Только администраторы могут отключать Ами.")
             return
             
         chat_id = message.chat.id
-        if chat_id not in self.inactive_chats:
-            self.inactive_chats.add(chat_id)
-            self.bot.reply_to(message, "Ами деактивирована в этом чате.")
+        if self.state.set_active(chat_id, False):
+            self.outbox.reply_to(message, "Ами деактивирована в этом чате.")
         else:
-            self.bot.reply_to(message, "Ами уже неактивена в этом чате.")
+            self.outbox.reply_to(message, "Ами уже неактивена в этом чате.")
 
     def _start_cleanup_thread(self):
         """Запускает фоновый поток для периодической очистки устаревших контекстов"""
@@ -312,25 +434,66 @@ class TelegramBot:
                 try:
                     time.sleep(3600)  # Очистка каждый час
                     self.context_manager.cleanup_old_contexts()
+                    self.user_limiter.cleanup()
+                    self.chat_limiter.cleanup()
                 except Exception as e:
-                    print(f"Ошибка в потоке очистки: {e}")
+                    log.exception("cleanup_failed", error=e)
         
         cleanup_thread = threading.Thread(target=cleanup_task, daemon=True)
         cleanup_thread.start()
 
+    def _register_shutdown(self) -> None:
+        """Порядок остановки: прием обновлений, дообработка начатого, сохранение, закрытие соединений"""
+        lifecycle = self.lifecycle
+        lifecycle.on(PHASE_INTAKE, "stop_intake", self.stop_intake)
+        # Накопленные серии сообщений отправляются в обработку, не дожидаясь окна
+        lifecycle.on(PHASE_DRAIN, "flush_bursts", self.debouncer.flush_all)
+        lifecycle.track("updates", self._pending_updates)
+        lifecycle.track("bursts", lambda: self.debouncer.pending + self.debouncer.running)
+        lifecycle.track("replies", lambda: self.admission.inflight + self.admission.deferred)
+        lifecycle.track("outbox", lambda: self.outbox.pending)
+        lifecycle.track("broadcast", lambda: int(self.broadcaster.is_running()))
+        lifecycle.on(PHASE_FLUSH, "contexts", self.context_manager.flush)
+        lifecycle.on(PHASE_FLUSH, "mood", self.mood_tracker.flush)
+        lifecycle.on(PHASE_FLUSH, "user_limits", self.user_limiter.save)
+        lifecycle.on(PHASE_FLUSH, "chat_limits", self.chat_limiter.save)
+        lifecycle.on(PHASE_CLOSE, "state", self.state.close)
+        lifecycle.on(PHASE_CLOSE, "llm", self.response_generator.ai_client.close)
+        lifecycle.on(PHASE_CLOSE, "images", self.images.close)
+        doc_index = getattr(self.response_generator.google_scraper, "doc_index", None)
+        if doc_index is not None:
+            lifecycle.on(PHASE_CLOSE, "doc_index", doc_index.close)
+
+    def stop_intake(self) -> None:
+        """Прекращает прием новых обновлений (polling или webhook)"""
+        if self.webhook_server is not None:
+            self.webhook_server.stop()
+        else:
+            self.bot.stop_polling()
+
+    def _pending_updates(self) -> int:
+        """Обновления, принятые, но еще не переданные обработчикам"""
+        pool = getattr(self.bot, "worker_pool", None)
+        queued = pool.tasks.qsize() if pool is not None and hasattr(pool, "tasks") else 0
+        return queued + (self.webhook_server.pending if self.webhook_server is not None else 0)
+
     def _message_filter(self, message: telebot.types.Message) -> bool:
         # Фильтр сообщений с учетом состояния активности в чате
         is_recent = message.date >= int(self.start_time)
-        chat_active = message.chat.id not in self.inactive_chats
+        chat_active = self.state.is_active(message.chat.id)
         return is_recent and chat_active
 
+    @timed("handle_message")
     def handle_message(self, message: telebot.types.Message) -> None:
         try:
             # Проверка чата
             if not self._validate_chat(message):
-                self.bot.reply_to(message, "К сожелению Ами не доступна в чатах если меньше 5 учасников")
+                self.outbox.notify_error(message.chat.id, "К сожелению Ами не доступна в чатах если меньше 5 учасников", message.message_id)
                 return
   
+            # Запоминаем чат для рассылок
+            self.state.add_known(message.chat.id)
+  
             # Пропускаем сообщения без текста
             if not hasattr(message, 'text') or not message.text:
               return
@@ -364,56 +527,111 @@ class TelegramBot:
                   reply_to_message=reply_data,
                   thread_id=getattr(message, 'message_thread_id', None)
               )
+            # Настроение учитывается по всем сообщениям чата, а не только по тем, на которые бот отвечает
+            self._track_mood(msg_context)
+            # История чата для подбора контекста тоже пополняется каждым сообщением
+            self.context_manager.record(msg_context)
   
+            # Сообщение из уже начатой серии пользователя объединяется с ней
+            burst_key = (chat_id, user_id)
+            if self.debouncer.join(burst_key, (message, msg_context)):
+                if self._is_direct_reply(message):
+                    self.debouncer.flush(burst_key)
+                return
+
               # Проверяем, должен ли бот ответить на сообщение
             if self.trigger_manager.should_reply(message):
                   # Получаем тип действия из сообщения
                   action_type = self.trigger_manager.get_action_type(message)
                   if not (message.text.startswith('/send_message') and self._is_admin(message)):
-                    if not self._check_message_limits(user_id, chat_id):
-                        remaining_time = self.user_message_counts[user_id]["reset_time"] - datetime.now()
-                        hours, remainder = divmod(remaining_time.seconds, 3600)
-                        minutes, _ = divmod(remainder, 60)
-                        self.bot.reply_to(
-                            message, 
-                            f"Лимит сообщений превышен. Лимиты обновятся через {hours} ч. {minutes} мин.Ваш лимит {self.USER_DAILY_LIMIT} в сутки"
-                        )
+                    exceeded = self._check_message_limits(user_id, chat_id)
+                    if exceeded:
+                        self.outbox.notify_error(message.chat.id, self._limit_exceeded_text(*exceeded), message.message_id)
                         return
-                    if action_type and action_type in self.trigger_manager.actions:
-                            # Вызываем соответствующее действие
-                        self.trigger_manager.actions[action_type](message, msg_context)
+                    if Config.DEBOUNCE_WINDOW <= 0 or self._is_direct_reply(message):
+                        self._dispatch_reply(message, msg_context, action_type)
                     else:
-                        # Стандартный ответ текстом
-                        self._handle_text_response(message, msg_context)
+                        # Ждем, не допишет ли пользователь еще несколько сообщений
+                        self.debouncer.submit(burst_key, (message, msg_context))
         except Exception as e:
-            print(f"Критическая ошибка обработки сообщения: {e}")
-            try:
-                self.bot.send_message(message.chat.id, "Произошла ошибка при обработке сообщения")
-            except:
-                pass
+            log.exception("handle_message_failed", chat_id=message.chat.id, error=e)
+            # Одинаковые уведомления об ошибках в чат схлопываются планировщиком
+            self.outbox.notify_error(message.chat.id, "Произошла ошибка при обработке сообщения")
+
+    def _track_mood(self, msg_context: MessageContext) -> None:
+        score = self.response_generator.sentimental_user.score(msg_context.text)
+        self.mood_tracker.update(msg_context.chat_id, msg_context.user_id, score)
+
+    def _is_direct_reply(self, message: telebot.types.Message) -> bool:
+        """Ответ на сообщение бота обрабатывается без ожидания окна объединения"""
+        reply = message.reply_to_message
+        return bool(reply and reply.from_user and reply.from_user.id == Config.BOT_ID)
+
+    def _dispatch_reply(self, message: telebot.types.Message, msg_context: MessageContext,
+                        action_type: Optional[str], attempt: int = 0) -> None:
+        # Под нагрузкой менее важные запросы откладываются или отбрасываются
+        tier = self.admission.classify(message, self.trigger_manager.action_keywords["bot_mention"])
+        verdict = self.admission.decide(tier, attempt)
+        if verdict == SHED:
+            return
+        if verdict == DEFER:
+            self.admission.defer(lambda: self._dispatch_reply(message, msg_context, action_type, attempt + 1))
+            return
+
+        with self.admission.track():
+            if action_type and action_type in self.trigger_manager.actions:
+                # Вызываем соответствующее действие
+                self.trigger_manager.actions[action_type](message, msg_context)
+            else:
+                # Стандартный ответ текстом
+                self._handle_text_response(message, msg_context)
+
+    def _flush_burst(self, key, items: List[tuple]) -> None:
+        """Отвечает один раз на серию сообщений пользователя: на последнее, с объединенным текстом"""
+        message, msg_context = items[-1]
+        if len(items) > 1:
+            msg_context = dataclasses.replace(msg_context, text="\n".join(ctx.text for _, ctx in items),
+                                              parts=tuple(ctx for _, ctx in items))
+        # Действие (голос, картинка) берется из первого сообщения серии, где оно запрошено
+        action_type = None
+        for burst_message, _ in items:
+            action = self.trigger_manager.get_action_type(burst_message)
+            if action in self.trigger_manager.actions:
+                action_type = action
+                break
+        self._dispatch_reply(message, msg_context, action_type)
+
+    def handle_members_changed(self, message: telebot.types.Message) -> None:
+        """Сбрасывает кэшированное число участников при входе или выходе пользователей"""
+        self.chat_cache.invalidate_chat(message.chat.id)
 
     def _validate_chat(self, message: telebot.types.Message) -> bool:
       
       return (
           message.chat.type == "private" or 
-          (message.chat.type == "supergroup" and self.bot.get_chat_members_count(message.chat.id) > 5))
+          (message.chat.type == "supergroup" and self.chat_cache.get_members_count(message.chat.id) > 5))
           
     def _handle_text_response(self, message: telebot.types.Message, msg_context: MessageContext) -> None:
         """Обработка стандартного текстового ответа"""
         try:
-          print("MessageContext",msg_context)
+          log.debug("message_context", context=msg_context)
           response = self.response_generator.generate_response(msg_context)
-          
-          print("Response",response)
             
           if response:
-            self.bot.reply_to(message, response, parse_mode='Markdown')
-            print(response)
-            print(f"Сообщение: {message.text}")
+            self._reply_or_notify(message, response, "Извините, произошла ошибка при формировании ответа", parse_mode='Markdown')
+            log.info("text_reply", chat_id=message.chat.id, message=message.text, response=response)
         except Exception as e:
-            print(f"Ошибка при подготовке текстового ответа: {e}")
-            print(e)
-            self.bot.reply_to(message, "Извините, произошла ошибка при формировании ответа")
+            log.exception("text_reply_failed", chat_id=message.chat.id, error=e)
+            self.outbox.notify_error(message.chat.id, "Извините, произошла ошибка при формировании ответа", message.message_id)
+
+    def _reply_or_notify(self, message: telebot.types.Message, text: str, error_text: str, **kwargs) -> None:
+        """Ставит ответ в очередь; если Telegram его отклонит, отправляет уведомление об ошибке"""
+        def on_done(future):
+            if future.exception() is not None:
+                log.warning("reply_send_failed", chat_id=message.chat.id, error=future.exception())
+                self.outbox.notify_error(message.chat.id, error_text, message.message_id)
+
+        self.outbox.reply_to(message, text, **kwargs).add_done_callback(on_done)
 
     def _handle_voice_request(self, message: telebot.types.Message, msg_context: MessageContext) -> None:
         """Обработка запроса на голосовое сообщение"""
@@ -421,46 +639,83 @@ class TelegramBot:
             response = self.response_generator.generate_response(msg_context)
             if response:
                 try:
-                    voice_file = self.voice_generator.generate(response)
-                    with open(voice_file, "rb") as voice:
-                        self.bot.send_voice(message.chat.id, voice)
-                    os.remove(voice_file)
-                    print(f"Голосовое сообщение: {message.text}")
+                    # Озвучка в памяти, без временного файла: отправка идет асинхронно через очередь
+                    voice_data = self.voice_generator.synthesize(response)
+
+                    def on_voice_sent(future):
+                        if future.exception() is not None:
+                            log.warning("voice_send_failed", chat_id=message.chat.id, error=future.exception())
+                            # Если не удалось отправить голос, отправляем текстовый ответ
+                            self._reply_or_notify(message, response, "Извините, произошла ошибка при формировании голосового ответа", parse_mode='Markdown')
+
+                    self.outbox.send_voice(
+                        message.chat.id, voice_data, priority=self.outbox.message_priority(message)
+                    ).add_done_callback(on_voice_sent)
+                    log.info("voice_reply", chat_id=message.chat.id, message=message.text)
                 except Exception as e:
-                    print(f"Ошибка генерации голоса: {e}")
+                    log.error("voice_generation_failed", chat_id=message.chat.id, error=e)
                     # Если не удалось сгенерировать голос, отправляем текстовый ответ
-                    self.bot.reply_to(message, response, parse_mode='Markdown')
+                    self._reply_or_notify(message, response, "Извините, произошла ошибка при формировании голосового ответа", parse_mode='Markdown')
         except Exception as e:
-            print(f"Ошибка при подготовке голосового ответа: {e}")
-            self.bot.reply_to(message, "Извините, произошла ошибка при формировании голосового ответа")
+            log.exception("voice_reply_failed", chat_id=message.chat.id, error=e)
+            self.outbox.notify_error(message.chat.id, "Извините, произошла ошибка при формировании голосового ответа", message.message_id)
 
     def _handle_image_request(self, message: telebot.types.Message, msg_context: MessageContext) -> None:
         """Обработка запроса на изображение"""
         try:
-            response = self.response_generator.generate_response(msg_context)
-            links = self.google_scraper.search_images(msg_context.text, num=5)
-            if links and len(links) > 0:
-                # Отправляем найденное изображение
-                self.send_image_from_url(message.chat.id, links[0], caption=response)
+            # Поиск и проверка картинок идут параллельно с генерацией подписи
+            results = run_stages([
+                Stage("reply", lambda: self.response_generator.generate_response(msg_context)),
+                Stage("images", lambda: self.images.candidates(msg_context.text),
+                      timeout=Config.STAGE_TIMEOUTS["image_search"], default=[]),
+            ], self._stage_executor)
+            response = results["reply"] or ""
+            sources = results["images"]
+            if sources:
+                # Отправляем первое изображение, которое примет Telegram
+                self.send_image(message.chat.id, sources, query=msg_context.text, caption=response,
+                                priority=self.outbox.message_priority(message))
             else:
-                self.bot.reply_to(message, "Извините, не удалось найти подходящее изображение. " + response)
+                self.outbox.reply_to(message, "Извините, не удалось найти подходящее изображение. " + response)
         except Exception as e:
-            print(f"Ошибка при поиске изображения: {e}")
-            self.bot.reply_to(message, "Извините, произошла ошибка при поиске изображения")
+            log.exception("image_reply_failed", chat_id=message.chat.id, error=e)
+            self.outbox.notify_error(message.chat.id, "Извините, произошла ошибка при поиске изображения", message.message_id)
 
     def _handle_search_request(self, message: telebot.types.Message, msg_context: MessageContext) -> None:
         """Обработка запроса на поиск информации"""
         self._handle_text_response(message, msg_context)
 
-    def send_image_from_url(self, chat_id, image_url, caption=None):
+    def send_image_from_url(self, chat_id, image_url, caption=None, **kwargs):
         """Отправка изображения по URL"""
-        try:
-            self.bot.send_photo(chat_id, image_url, caption=caption)
-            print(f"Image sent successfully: {image_url}")
-        except Exception as e:
-            print(f"Error sending image: {e}")
-            # Fallback message if image sending fails
-            self.bot.send_message(chat_id, f"Не удалось отправить изображение: {e}")
+        self.send_image(chat_id, [image_url], caption=caption, **kwargs)
+
+    def send_image(self, chat_id, sources: List[str], query: Optional[str] = None, caption=None, **kwargs):
+        """
+        Отправка первого из изображений (URL или file_id), которое примет Telegram.
+        file_id отправленного изображения запоминается для query и его URL.
+        """
+        def attempt(index: int) -> None:
+            source = sources[index]
+
+            def on_done(future):
+                error = future.exception()
+                if error is None:
+                    log.info("image_sent", chat_id=chat_id, url=source, attempt=index + 1)
+                    if query:
+                        self.images.remember(query, source, future.result())
+                    return
+                log.warning("image_send_failed", chat_id=chat_id, url=source, error=error)
+                self.images.forget(source)
+                # Следующий кандидат пробуется, только если не подошла сама картинка
+                if is_source_error(error) and index + 1 < len(sources):
+                    attempt(index + 1)
+                else:
+                    # Fallback message if image sending fails
+                    self.outbox.notify_error(chat_id, "Не удалось отправить изображение")
+
+            self.outbox.send_photo(chat_id, source, caption=caption, **kwargs).add_done_callback(on_done)
+
+        attempt(0)
 
     def _is_admin(self, message: telebot.types.Message) -> bool:
         try:
@@ -468,46 +723,157 @@ class TelegramBot:
             if message.chat.type == "private":
                 return True
                 
-            chat_member = self.bot.get_chat_member(message.chat.id, message.from_user.id)
-            return chat_member.status in ['creator', 'administrator']
+            status = self.chat_cache.get_member_status(message.chat.id, message.from_user.id)
+            return status in ['creator', 'administrator']
         except Exception as e:
-            print(f"Ошибка проверки администратора: {e}")
+            log.warning("admin_check_failed", chat_id=message.chat.id, error=e)
             return False
 
     def run(self) -> None:
         try:
-            print("Бот запущен...")
-            self.bot.infinity_polling(timeout=10, long_polling_timeout=5)
+            log.info("bot_started", mode="polling")
+            # chat_member обновления нужно запрашивать явно
+            self.bot.infinity_polling(timeout=10, long_polling_timeout=5, allowed_updates=telebot.util.update_types)
         except Exception as e:
-            print(f"Критическая ошибка при запуске бота: {e}")
+            log.exception("bot_run_failed", error=e)
+        finally:
+            # При остановке по сигналу ждет ее окончания, иначе запускает сама
+            self.lifecycle.shutdown("polling_stopped")
+
+    def _process_raw_update(self, data: dict) -> None:
+        """Передает обновление из webhook в обычный конвейер обработчиков telebot"""
+        update = telebot.types.Update.de_json(data)
+        self.bot.process_new_updates([update])
+
+    def run_webhook(self, url: str, secret_token: Optional[str] = None,
+                    host: str = "0.0.0.0", port: int = 8443) -> None:
+        """Запускает прием обновлений через webhook вместо long polling"""
+        try:
+            log.info("bot_started", mode="webhook", url=url)
+            path = urlparse(url).path or "/"
+            self.bot.remove_webhook()
+            self.bot.set_webhook(url=url, secret_token=secret_token, allowed_updates=telebot.util.update_types)
+            self.webhook_server = WebhookServer(self._process_raw_update, secret_token, host=host, port=port, path=path)
+            self.webhook_server.serve_forever()
+        except Exception as e:
+            log.exception("bot_run_failed", error=e)
+        finally:
+            self.lifecycle.shutdown("webhook_stopped")
+
+def warm_up_backends(ai_client: AIClient) -> None:
+    """Параллельно прогревает медленные компоненты, не блокируя запуск бота"""
+    started = time.perf_counter()
+
+    def import_search_dependencies():
+        import find_data
+        try:
+            # Обращение к атрибутам завершает отложенный импорт requests и bs4
+            find_data.requests.get
+            find_data.bs4.BeautifulSoup
+        except Exception as e:
+            log.error("import_warm_up_failed", error=e)
+
+    def report():
+        for thread in threads:
+            thread.join()
+        log.info("backends_ready", seconds=round(time.perf_counter() - started, 3))
+
+    threads = [
+        ai_client.warm_up(),
+        threading.Thread(target=import_search_dependencies, name="import-warm-up", daemon=True),
+    ]
+    threads[1].start()
+    threading.Thread(target=report, name="warm-up-report", daemon=True).start()
+
+def build_bot(data_dir: Optional[str] = None, threaded: bool = True) -> TelegramBot:
+    """
+    Создает бота со всеми компонентами (в однопроцессном режиме и в каждом рабочем процессе).
+    threaded=False - обработчики выполняются в потоке, передавшем обновление, а не в пуле telebot
+    """
+    # Подключение к модели и импорт зависимостей поиска выполняются в фоне,
+    # чтобы бот начал принимать обновления сразу после запуска
+    router = LLMRouter([build_backend(spec) for spec in Config.LLM_BACKENDS], hedge=Config.LLM_HEDGE)
+    ai_client = AIClient(router=router)
+    warm_up_backends(ai_client)
+    sentimental_user = SentimentClassifier()
+    
+    voice_generator = CoalescingVoiceGenerator(ElevenLabsVoiceGenerator(Config.ELEVEN_LABS_KEY, Config.VOICE_ID))
+    API_KEY = Config.API_KEY_SEARCH
+    CX = Config.CX
+    # Одна база состояния и один индекс страниц на все рабочие процессы
+    data_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+    doc_index = DocumentIndex(os.path.join(data_root, "documents.db"), ttl=Config.DOC_INDEX_TTL,
+                              max_docs=Config.DOC_INDEX_MAX_DOCS, min_coverage=Config.DOC_INDEX_MIN_COVERAGE)
+    google_scraper = CoalescingScraper(GoogleScraper(api_key=API_KEY, cx=CX, doc_index=doc_index))
+    
+    state = StateStore(os.path.join(data_root, "state.db"))
+    state.import_recipients(os.path.join(data_root, "recipients.pkl"))
+    
+    return TelegramBot(
+        token=Config.TOKEN,
+        bot=telebot.TeleBot(Config.TOKEN, threaded=threaded),
+        ai_client=ai_client,
+        voice_generator=voice_generator,
+        google_scraper=google_scraper,
+        sentimental_user= sentimental_user,
+        data_dir=data_dir,
+        state=state
+    )
+
+def run_sharded(shards: int) -> None:
+    """Процесс приема обновлений раздает их рабочим процессам по chat_id"""
+    # Старый список получателей переносится до запуска рабочих процессов, а не каждым из них
+    data_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+    StateStore(os.path.join(data_root, "state.db")).import_recipients(os.path.join(data_root, "recipients.pkl"))
+    runner = ShardedRunner(shards)
+    lifecycle = Lifecycle(drain_timeout=0)
+    lifecycle.on(PHASE_INTAKE, "stop_intake", runner.stop_intake)
+    # Рабочие процессы сами дообрабатывают свои очереди и сохраняют состояние
+    lifecycle.on(PHASE_CLOSE, "workers", lambda: runner.stop(timeout=Config.SHUTDOWN_DRAIN_TIMEOUT + 15))
+    lifecycle.install_signal_handlers()
+    runner.start()
+    try:
+        if Config.WEBHOOK_URL:
+            runner.run_webhook(Config.TOKEN, Config.WEBHOOK_URL, Config.WEBHOOK_SECRET,
+                               host=Config.WEBHOOK_HOST, port=Config.WEBHOOK_PORT)
+        else:
+            runner.run_polling(Config.TOKEN)
+    finally:
+        lifecycle.shutdown("intake_stopped")
 
 def main():
     try:
+        configure_logging(Config.LOG_LEVEL, Config.LOG_SAMPLE_RATES)
+        
         # Создание директории для данных
-        os.makedirs(os.path.join(os.path.dirname(__file__), "data"), exist_ok=True)
+        data_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+        os.makedirs(data_root, exist_ok=True)
+        # Контексты и настроение разбиты по рабочим процессам; при смене их числа переносятся
+        migrate_shard_data(data_root, max(Config.WORKER_PROCESSES, 1))
         
-        # Инициализация компонентов
-        ai_client = AIClient("Qwen/Qwen2.5-Coder-demo")
-        ai_client.call_in_start()
-        sentimental_user = SentimentClassifier()
+        # Эндпоинт метрик Prometheus
+        if Config.METRICS_PORT:
+            try:
+                start_metrics_server(Config.METRICS_PORT)
+            except OSError as e:
+                log.error("metrics_server_failed", error=e)
         
-        voice_generator = ElevenLabsVoiceGenerator(Config.ELEVEN_LABS_KEY, Config.VOICE_ID)
-        API_KEY = Config.API_KEY_SEARCH
-        CX = Config.CX
-        google_scraper = GoogleScraper(api_key=API_KEY, cx=CX)
+        if Config.WORKER_PROCESSES > 1:
+            run_sharded(Config.WORKER_PROCESSES)
+            return
         
-        # Создание и запуск бота
-        bot = TelegramBot(
-            token=Config.TOKEN,
-            ai_client=ai_client,
-            voice_generator=voice_generator,
-            google_scraper=google_scraper,
-            sentimental_user= sentimental_user
-        )
+        # Создание и запуск бота; в режиме webhook обработчики выполняются в пуле WebhookServer
+        # по одному на чат, а не в пуле telebot, где порядок сообщений чата не сохраняется
+        bot = build_bot(threaded=not Config.WEBHOOK_URL)
+        bot.lifecycle.install_signal_handlers()
         
-        bot.run()
+        if Config.WEBHOOK_URL:
+            bot.run_webhook(Config.WEBHOOK_URL, Config.WEBHOOK_SECRET,
+                            host=Config.WEBHOOK_HOST, port=Config.WEBHOOK_PORT)
+        else:
+            bot.run()
     except Exception as e:
-        print(f"Фатальная ошибка при запуске: {e}")
+        log.exception("startup_failed", error=e)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,315 @@
+"""
+Настроение пользователей и чатов: экспоненциально взвешенное среднее оценок
+SentimentClassifier.score по сообщениям.
+
+Каждое сообщение сдвигает среднее на долю alpha в сторону своей оценки, а между
+сообщениями среднее затухает к нейтральному с периодом полураспада half_life,
+поэтому обновление занимает O(1) и не требует пересчета сохраненных сообщений.
+
+Формат файла (числа little-endian):
+    MAGIC (8 байт) | версия u16
+    затем две таблицы (пользователи, чаты), каждая:
+        число записей n u32 | id i64[n] | оценка f64[n] | время обновления f64[n] | число сообщений u32[n]
+"""
+import os
+import struct
+import tempfile
+import threading
+import time
+from array import array
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from metrics import gauge
+from logger import get_logger
+from snapshot import SnapshotError, dump_array, load_array
+
+log = get_logger("ami.mood")
+
+MAGIC = b"AMIMOOD\x00"
+VERSION = 1
+
+_HEADER = struct.Struct("<8sH")
+_COUNT = struct.Struct("<I")
+# Тип и размер элемента столбцов таблицы
+_COLUMNS = (("q", 8), ("d", 8), ("d", 8), ("I", 4))
+
+
+class _MoodTable:
+    """Столбцы в array: id, оценка, время обновления, число сообщений; id -> номер строки в slots"""
+
+    def __init__(self):
+        self.slots: Dict[int, int] = {}
+        self.ids = array("q")
+        self.scores = array("d")
+        self.updated = array("d")
+        self.counts = array("I")
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def update(self, key: int, value: float, now: float, alpha: float, half_life: float) -> float:
+        slot = self.slots.get(key)
+        if slot is None:
+            # Новая запись начинается с нейтрального настроения: одно сообщение не задает его целиком
+            score = alpha * value
+            self.slots[key] = len(self.ids)
+            self.ids.append(key)
+            self.scores.append(score)
+            self.updated.append(now)
+            self.counts.append(1)
+            return score
+        score = _decayed(self.scores[slot], now - self.updated[slot], half_life)
+        score += alpha * (value - score)
+        self.scores[slot] = score
+        self.updated[slot] = now
+        self.counts[slot] += 1
+        return score
+
+    def get(self, key: int, now: float, half_life: float) -> Optional[float]:
+        slot = self.slots.get(key)
+        if slot is None:
+            return None
+        return _decayed(self.scores[slot], now - self.updated[slot], half_life)
+
+    def merge(self, other: "_MoodTable", slot: int) -> None:
+        """Переносит строку slot другой таблицы; из двух записей одного id остается более свежая"""
+        key = other.ids[slot]
+        mine = self.slots.get(key)
+        if mine is None:
+            self.slots[key] = len(self.ids)
+            self.ids.append(key)
+            self.scores.append(other.scores[slot])
+            self.updated.append(other.updated[slot])
+            self.counts.append(other.counts[slot])
+        elif other.updated[slot] > self.updated[mine]:
+            self.scores[mine] = other.scores[slot]
+            self.updated[mine] = other.updated[slot]
+            self.counts[mine] = other.counts[slot]
+
+    def compact(self, idle_before: float) -> int:
+        """Удаляет записи, не обновлявшиеся с idle_before; возвращает их число"""
+        keep = [slot for slot in range(len(self.ids)) if self.updated[slot] >= idle_before]
+        removed = len(self.ids) - len(keep)
+        if removed:
+            self.ids = array("q", (self.ids[slot] for slot in keep))
+            self.scores = array("d", (self.scores[slot] for slot in keep))
+            self.updated = array("d", (self.updated[slot] for slot in keep))
+            self.counts = array("I", (self.counts[slot] for slot in keep))
+            self.slots = {key: slot for slot, key in enumerate(self.ids)}
+        return removed
+
+    def dump(self) -> bytes:
+        return _COUNT.pack(len(self.ids)) + b"".join(
+            dump_array(column) for column in (self.ids, self.scores, self.updated, self.counts)
+        )
+
+    @classmethod
+    def load(cls, data: bytes, offset: int) -> Tuple["_MoodTable", int]:
+        (count,) = _COUNT.unpack_from(data, offset)
+        offset += _COUNT.size
+        columns = []
+        for typecode, size in _COLUMNS:
+            end = offset + size * count
+            if end > len(data):
+                raise SnapshotError("файл настроения обрезан")
+            columns.append(load_array(typecode, data[offset:end]))
+            offset = end
+        table = cls()
+        table.ids, table.scores, table.updated, table.counts = columns
+        table.slots = {key: slot for slot, key in enumerate(table.ids)}
+        return table, offset
+
+
+def _read_tables(path: str) -> Tuple[_MoodTable, _MoodTable]:
+    """Таблицы пользователей и чатов из файла настроения"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < _HEADER.size:
+        raise SnapshotError("файл настроения слишком короткий")
+    magic, version = _HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise SnapshotError(f"неподдерживаемый файл настроения (версия {version})")
+    users, offset = _MoodTable.load(data, _HEADER.size)
+    chats, _ = _MoodTable.load(data, offset)
+    return users, chats
+
+
+def _write_file(path: str, data: bytes) -> None:
+    """Атомарная запись: временный файл рядом с целевым, fsync и os.replace"""
+    fd, tmp_path = tempfile.mkstemp(prefix=".mood-", suffix=".tmp", dir=os.path.dirname(path) or ".")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def reshard(sources: List[str], targets: List[str], shard_of: Callable[[int], int]) -> None:
+    """
+    Перераспределяет файлы настроения при смене числа рабочих процессов: чат попадает
+    в targets[shard_of(chat_id)], а таблица пользователей (их настроение считается по чатам
+    процесса) объединяется и записывается в каждый файл. Нечитаемые файлы пропускаются.
+    """
+    users = _MoodTable()
+    chats = [_MoodTable() for _ in targets]
+    for path in sources:
+        if not os.path.exists(path):
+            continue
+        try:
+            source_users, source_chats = _read_tables(path)
+        except (OSError, SnapshotError, struct.error) as e:
+            log.error("mood_load_failed", path=path, error=e)
+            continue
+        for slot in range(len(source_users)):
+            users.merge(source_users, slot)
+        for slot in range(len(source_chats)):
+            chats[shard_of(source_chats.ids[slot])].merge(source_chats, slot)
+    prefix = _HEADER.pack(MAGIC, VERSION) + users.dump()
+    for path, table in zip(targets, chats):
+        _write_file(path, prefix + table.dump())
+    log.info("mood_resharded", sources=len(sources), targets=len(targets), users=len(users),
+             chats=sum(map(len, chats)))
+
+
+def _decayed(score: float, elapsed: float, half_life: float) -> float:
+    if elapsed <= 0:
+        return score
+    return score * 0.5 ** (elapsed / half_life)
+
+
+class MoodTracker:
+    """
+    Скользящее настроение пользователей и чатов.
+
+    Состояние хранится в столбцах array (около 28 байт на запись) и сохраняется
+    в файл рядом со снапшотом контекстов. В режиме нескольких процессов у каждого
+    процесса свой файл: настроение пользователя считается по чатам его процесса
+    (при смене числа процессов файлы перераспределяются, см. reshard).
+    """
+
+    def __init__(self, storage_file: str, alpha: float = 0.3, half_life: float = 6 * 3600,
+                 idle_ttl: float = 30 * 24 * 3600, flush_interval: Optional[float] = None):
+        """
+        Args:
+            alpha: вес нового сообщения в среднем
+            half_life: за сколько секунд без сообщений среднее уменьшается вдвое
+            idle_ttl: записи без сообщений дольше этого срока удаляются при сохранении
+            flush_interval: период фонового сохранения изменений, с (None - только flush())
+        """
+        self.storage_file = storage_file
+        self.alpha = alpha
+        self.half_life = half_life
+        self.idle_ttl = idle_ttl
+        self.users = _MoodTable()
+        self.chats = _MoodTable()
+        self._lock = threading.Lock()
+        # Сохранения идут по одному; файл пишется без self._lock
+        self._save_lock = threading.Lock()
+        self._dirty = False
+        self._load()
+        gauge("ami_mood_entries", "Пользователи и чаты с отслеживаемым настроением",
+              fn=lambda: len(self.users) + len(self.chats))
+        if flush_interval:
+            threading.Thread(target=self._flush_loop, args=(flush_interval,), name="mood-flush",
+                             daemon=True).start()
+
+    def _load(self) -> None:
+        if not os.path.exists(self.storage_file):
+            return
+        try:
+            users, chats = _read_tables(self.storage_file)
+        except (OSError, SnapshotError, struct.error) as e:
+            log.error("mood_load_failed", path=self.storage_file, error=e)
+            return
+        self.users, self.chats = users, chats
+        log.info("mood_loaded", users=len(users), chats=len(chats))
+
+    def update(self, chat_id: int, user_id: int, score: float) -> Tuple[float, float]:
+        """Учитывает оценку сообщения; возвращает новое настроение пользователя и чата"""
+        now = time.time()
+        with self._lock:
+            user = self.users.update(user_id, score, now, self.alpha, self.half_life)
+            chat = self.chats.update(chat_id, score, now, self.alpha, self.half_life)
+            self._dirty = True
+        return user, chat
+
+    def user_mood(self, user_id: int) -> Optional[float]:
+        with self._lock:
+            return self.users.get(user_id, time.time(), self.half_life)
+
+    def chat_mood(self, chat_id: int) -> Optional[float]:
+        with self._lock:
+            return self.chats.get(chat_id, time.time(), self.half_life)
+
+    def _bulk(self, table: _MoodTable, ids: Optional[Iterable[int]]) -> Dict[int, float]:
+        now = time.time()
+        with self._lock:
+            if ids is None:
+                slots = range(len(table))
+            else:
+                slots = [table.slots[key] for key in ids if key in table.slots]
+            return {
+                table.ids[slot]: _decayed(table.scores[slot], now - table.updated[slot], self.half_life)
+                for slot in slots
+            }
+
+    def user_moods(self, user_ids: Optional[Iterable[int]] = None) -> Dict[int, float]:
+        """Текущее настроение пользователей (всех, если user_ids не заданы)"""
+        return self._bulk(self.users, user_ids)
+
+    def chat_moods(self, chat_ids: Optional[Iterable[int]] = None) -> Dict[int, float]:
+        """Текущее настроение чатов (всех, если chat_ids не заданы)"""
+        return self._bulk(self.chats, chat_ids)
+
+    def export(self) -> List[Tuple[str, int, float, float, int]]:
+        """Строки (тип, id, текущее настроение, время обновления, число сообщений) для аналитики"""
+        now = time.time()
+        rows = []
+        with self._lock:
+            for kind, table in (("user", self.users), ("chat", self.chats)):
+                for slot in range(len(table)):
+                    rows.append((kind, table.ids[slot],
+                                 _decayed(table.scores[slot], now - table.updated[slot], self.half_life),
+                                 table.updated[slot], table.counts[slot]))
+        return rows
+
+    def _save(self) -> bool:
+        """
+        Сохраняет настроение; вызывается без self._lock. Под блокировкой таблицы только
+        сжимаются и сериализуются в байты, запись и fsync идут без нее.
+        """
+        with self._save_lock:
+            with self._lock:
+                idle_before = time.time() - self.idle_ttl
+                removed = self.users.compact(idle_before) + self.chats.compact(idle_before)
+                data = _HEADER.pack(MAGIC, VERSION) + self.users.dump() + self.chats.dump()
+                users, chats = len(self.users), len(self.chats)
+                self._dirty = False
+            try:
+                _write_file(self.storage_file, data)
+            except OSError as e:
+                log.error("mood_save_failed", path=self.storage_file, error=e)
+                with self._lock:
+                    self._dirty = True
+                return False
+        log.debug("mood_saved", users=users, chats=chats, removed=removed)
+        return True
+
+    def flush(self) -> bool:
+        """Сохраняет настроение, если оно менялось после последнего сохранения"""
+        with self._lock:
+            if not self._dirty:
+                return True
+        return self._save()
+
+    def _flush_loop(self, interval: float) -> None:
+        while True:
+            time.sleep(interval)
+            self.flush()
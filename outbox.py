@@ -0,0 +1,217 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Deque, Dict, Hashable, Optional, Tuple
+
+from telebot.apihelper import ApiTelegramException
+
+from metrics import counter, gauge, histogram
+from rate_limiter import TokenBucket
+from logger import get_logger
+
+log = get_logger("ami.outbox")
+
+# Приоритеты исходящих сообщений (меньше - важнее)
+PRIORITY_HIGH = 0    # личные чаты и прямые ответы боту
+PRIORITY_NORMAL = 1  # ответы в группах
+PRIORITY_LOW = 2     # уведомления об ошибках, рассылки
+
+
+class _Job:
+    __slots__ = ("chat_id", "method", "args", "kwargs", "priority", "seq", "future", "attempts", "queued_at")
+
+    def __init__(self, chat_id, method, args, kwargs, priority, seq):
+        self.chat_id = chat_id
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.seq = seq
+        self.future: Future = Future()
+        self.attempts = 0
+        self.queued_at = time.perf_counter()
+
+
+class OutboundScheduler:
+    """
+    Центральная очередь исходящих сообщений с учетом flood-лимитов Telegram.
+
+    Общий лимит ~30 сообщений/с, в личный чат ~1 сообщение/с, в группу ~20 сообщений/мин.
+    Диспетчер выбирает самое приоритетное сообщение среди чатов, чей лимит позволяет
+    отправку; внутри чата порядок сохраняется (в полете не больше одного сообщения на чат).
+    Ответ 429 приостанавливает чат на retry_after и возвращает сообщение в начало его очереди.
+    Одинаковые уведомления об ошибках в чат схлопываются.
+    """
+
+    MAX_ATTEMPTS = 5
+    MAX_IDLE_BUCKETS = 1000
+
+    def __init__(self, bot, bot_id: int, global_rate: float = 30, private_rate: float = 1,
+                 group_per_minute: float = 20, workers: int = 8, error_coalesce_window: float = 30):
+        self.bot = bot
+        self.bot_id = bot_id
+        self.global_bucket = TokenBucket(global_rate)
+        self.private_rate = private_rate
+        self.group_rate = group_per_minute / 60
+        self.error_coalesce_window = error_coalesce_window
+
+        self._queues: Dict[int, Deque[_Job]] = {}
+        self._buckets: Dict[int, TokenBucket] = {}
+        self._busy = set()
+        self._recent_errors: Dict[Hashable, float] = {}
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="outbox")
+        self._sent = counter("ami_outbox_sent_total", "Исходящие сообщения по результату", ("result",))
+        self._wait = histogram("ami_outbox_wait_seconds", "Время ожидания сообщения в очереди отправки")
+        self._coalesced = counter("ami_outbox_coalesced_total", "Схлопнутые повторные уведомления об ошибках")
+        gauge("ami_outbox_queue_depth", "Сообщения в очереди отправки", fn=lambda: self.queue_depth)
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, daemon=True)
+        self._dispatcher.start()
+
+    @property
+    def queue_depth(self) -> int:
+        """Число сообщений, ожидающих отправки"""
+        with self._cond:
+            return sum(len(queue) for queue in self._queues.values())
+
+    @property
+    def pending(self) -> int:
+        """Сообщения в очереди и отправляемые прямо сейчас"""
+        with self._cond:
+            return sum(len(queue) for queue in self._queues.values()) + len(self._busy)
+
+    def _bucket_for(self, chat_id: int) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            # В Telegram id личных чатов положительные, групп - отрицательные
+            if chat_id > 0:
+                bucket = TokenBucket(self.private_rate)
+            else:
+                bucket = TokenBucket(self.group_rate, capacity=3)
+            self._buckets[chat_id] = bucket
+        return bucket
+
+    def submit(self, chat_id: int, method: str, *args, priority: int = PRIORITY_NORMAL, **kwargs) -> Future:
+        """Ставит вызов метода бота (send_message, send_photo, ...) в очередь отправки"""
+        with self._cond:
+            self._seq += 1
+            job = _Job(chat_id, method, args, kwargs, priority, self._seq)
+            self._queues.setdefault(chat_id, deque()).append(job)
+            self._cond.notify()
+        return job.future
+
+    def message_priority(self, message) -> int:
+        """Личные чаты и ответы на сообщения бота обслуживаются первыми"""
+        if message.chat.type == "private":
+            return PRIORITY_HIGH
+        reply = message.reply_to_message
+        if reply and reply.from_user and reply.from_user.id == self.bot_id:
+            return PRIORITY_HIGH
+        return PRIORITY_NORMAL
+
+    def reply_to(self, message, text: str, **kwargs) -> Future:
+        kwargs.setdefault("priority", self.message_priority(message))
+        return self.submit(message.chat.id, "reply_to", message, text, **kwargs)
+
+    def send_message(self, chat_id: int, text: str, **kwargs) -> Future:
+        return self.submit(chat_id, "send_message", chat_id, text, **kwargs)
+
+    def send_photo(self, chat_id: int, photo, **kwargs) -> Future:
+        return self.submit(chat_id, "send_photo", chat_id, photo, **kwargs)
+
+    def send_voice(self, chat_id: int, voice, **kwargs) -> Future:
+        return self.submit(chat_id, "send_voice", chat_id, voice, **kwargs)
+
+    def notify_error(self, chat_id: int, text: str, reply_to_message_id: Optional[int] = None) -> Optional[Future]:
+        """Отправляет уведомление об ошибке, если такое же не отправлялось в чат недавно"""
+        key = (chat_id, text)
+        now = time.monotonic()
+        with self._cond:
+            last = self._recent_errors.get(key)
+            if last is not None and now - last < self.error_coalesce_window:
+                self._coalesced.inc()
+                return None
+            self._recent_errors[key] = now
+            if len(self._recent_errors) > 10000:
+                self._recent_errors = {
+                    k: t for k, t in self._recent_errors.items() if now - t < self.error_coalesce_window
+                }
+        kwargs = {"reply_to_message_id": reply_to_message_id} if reply_to_message_id else {}
+        return self.submit(chat_id, "send_message", chat_id, text, priority=PRIORITY_LOW, **kwargs)
+
+    def _next_job(self) -> Tuple[Optional[_Job], float]:
+        """Выбирает готовое к отправке сообщение; иначе возвращает время до следующей попытки"""
+        global_wait = self.global_bucket.wait_time()
+        if global_wait > 0:
+            return None, global_wait
+
+        candidates = sorted(
+            (queue[0].priority, queue[0].seq, chat_id)
+            for chat_id, queue in self._queues.items()
+            if queue and chat_id not in self._busy
+        )
+        wait = 1.0
+        for _, _, chat_id in candidates:
+            chat_wait = self._bucket_for(chat_id).try_acquire()
+            if chat_wait <= 0:
+                self.global_bucket.try_acquire()
+                return self._queues[chat_id].popleft(), 0.0
+            wait = min(wait, chat_wait)
+        return None, wait
+
+    def _dispatch_loop(self) -> None:
+        while True:
+            with self._cond:
+                job, wait = self._next_job()
+                if job is None:
+                    self._cond.wait(timeout=wait)
+                    continue
+                self._busy.add(job.chat_id)
+            self._executor.submit(self._execute, job)
+
+    def _finish(self, job: _Job) -> None:
+        with self._cond:
+            self._busy.discard(job.chat_id)
+            if not self._queues.get(job.chat_id):
+                self._queues.pop(job.chat_id, None)
+            if len(self._buckets) > self.MAX_IDLE_BUCKETS:
+                self._prune_buckets()
+            self._cond.notify()
+
+    def _prune_buckets(self) -> None:
+        """Удаляет бакеты чатов без очереди, которые успели полностью восстановиться"""
+        for chat_id in list(self._buckets):
+            bucket = self._buckets[chat_id]
+            if chat_id not in self._queues and chat_id not in self._busy and bucket.wait_time(bucket.capacity) <= 0:
+                del self._buckets[chat_id]
+
+    def _execute(self, job: _Job) -> None:
+        job.attempts += 1
+        if job.attempts == 1:
+            self._wait.observe(time.perf_counter() - job.queued_at)
+        try:
+            result = getattr(self.bot, job.method)(*job.args, **job.kwargs)
+        except ApiTelegramException as e:
+            if e.error_code == 429 and job.attempts < self.MAX_ATTEMPTS:
+                retry_after = (e.result_json or {}).get("parameters", {}).get("retry_after", 1)
+                log.warning("flood_limit", chat_id=job.chat_id, retry_after=retry_after)
+                self._sent.labels("flood_retry").inc()
+                with self._cond:
+                    self._bucket_for(job.chat_id).pause(retry_after)
+                    self._queues.setdefault(job.chat_id, deque()).appendleft(job)
+                self._finish(job)
+                return
+            self._sent.labels("error").inc()
+            job.future.set_exception(e)
+            self._finish(job)
+            return
+        except Exception as e:
+            self._sent.labels("error").inc()
+            job.future.set_exception(e)
+            self._finish(job)
+            return
+        self._sent.labels("ok").inc()
+        job.future.set_result(result)
+        self._finish(job)
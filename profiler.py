@@ -0,0 +1,159 @@
+import io
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from typing import Optional, Tuple
+
+from logger import get_logger
+
+log = get_logger("ami.profiler")
+
+# Ограничения на длительность сессий, чтобы случайно не оставить профилирование включенным
+MAX_DURATION = 120
+MAX_TOP = 50
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+class SamplingProfiler:
+    """
+    Статистический профилировщик: с заданным интервалом снимает стеки всех потоков
+    через sys._current_frames(). Накладные расходы не зависят от числа вызовов функций,
+    поэтому его можно запускать на работающем боте.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.samples = 0
+
+    def run(self, duration: float) -> "SamplingProfiler":
+        """Собирает выборки в течение duration секунд в текущем потоке"""
+        own_id = threading.get_ident()
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[tuple(reversed(stack))] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+        return self
+
+    def collapsed(self) -> str:
+        """Стеки в формате collapsed stacks (flamegraph.pl, speedscope)"""
+        return "\n".join(f"{';'.join(stack)} {count}" for stack, count in self.stacks.most_common()) + "\n"
+
+    def top(self, n: int = 15) -> str:
+        """Функции с наибольшим собственным и суммарным временем"""
+        self_counts: Counter = Counter()
+        total_counts: Counter = Counter()
+        for stack, count in self.stacks.items():
+            self_counts[stack[-1]] += count
+            for name in set(stack[1:]):
+                total_counts[name] += count
+
+        total = sum(self.stacks.values()) or 1
+        lines = [f"Выборок: {self.samples}, стеков потоков: {total}", "", "Собственное время:"]
+        for name, count in self_counts.most_common(n):
+            lines.append(f"{count * 100 / total:5.1f}%  {name}")
+        lines.append("")
+        lines.append("Суммарное время:")
+        for name, count in total_counts.most_common(n):
+            lines.append(f"{count * 100 / total:5.1f}%  {name}")
+        return "\n".join(lines)
+
+
+def memory_diff(duration: float, top: int = 15, frames: int = 1) -> str:
+    """Сравнивает снимки tracemalloc в начале и конце интервала и возвращает рост памяти"""
+    started_here = not tracemalloc.is_tracing()
+    if started_here:
+        tracemalloc.start(frames)
+    try:
+        before = tracemalloc.take_snapshot()
+        time.sleep(duration)
+        after = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        if started_here:
+            tracemalloc.stop()
+
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen importlib._bootstrap>")]
+    stats = after.filter_traces(filters).compare_to(before.filter_traces(filters), "lineno")
+    lines = [
+        f"Отслеживается: {current / 2 ** 20:.1f} МБ, пик: {peak / 2 ** 20:.1f} МБ",
+        f"Рост за {duration:.0f} с:",
+    ]
+    for stat in stats[:top]:
+        frame = stat.traceback[0]
+        lines.append(
+            f"{stat.size_diff / 1024:+9.1f} КБ {stat.count_diff:+7d} объектов  "
+            f"{os.path.basename(frame.filename)}:{frame.lineno}"
+        )
+    return "\n".join(lines)
+
+
+class ProfilerService:
+    """Запускает профилирование по команде администратора и отправляет отчет в чат"""
+
+    def __init__(self, outbox):
+        self.outbox = outbox
+        self._lock = threading.Lock()
+        self._active: Optional[str] = None
+
+    def _start(self, kind: str, target) -> bool:
+        with self._lock:
+            if self._active is not None:
+                return False
+            self._active = kind
+
+        def run():
+            try:
+                target()
+            except Exception as e:
+                log.exception("profiling_failed", kind=kind, error=e)
+            finally:
+                with self._lock:
+                    self._active = None
+
+        threading.Thread(target=run, name=f"profiler-{kind}", daemon=True).start()
+        return True
+
+    @staticmethod
+    def parse_args(text: str, default_seconds: int = 10, default_top: int = 15) -> Tuple[int, int]:
+        """Разбирает аргументы команды: /profile [секунды] [top]"""
+        parts = text.split()[1:]
+        numbers = [int(p) for p in parts if p.isdigit()]
+        seconds = numbers[0] if numbers else default_seconds
+        top = numbers[1] if len(numbers) > 1 else default_top
+        return max(1, min(seconds, MAX_DURATION)), max(1, min(top, MAX_TOP))
+
+    def start_cpu(self, chat_id: int, seconds: int, top: int) -> bool:
+        """Профилирование CPU всех потоков; возвращает False, если сессия уже идет"""
+        def target():
+            profile = SamplingProfiler().run(seconds)
+            self.outbox.send_message(chat_id, f"Профиль CPU за {seconds} с\n\n{profile.top(top)}"[:4096])
+            document = io.BytesIO(profile.collapsed().encode("utf-8"))
+            document.name = f"profile-{int(time.time())}.folded"
+            self.outbox.submit(chat_id, "send_document", chat_id, document,
+                               caption="collapsed stacks: flamegraph.pl / speedscope")
+        return self._start("cpu", target)
+
+    def start_memory(self, chat_id: int, seconds: int, top: int) -> bool:
+        """Сравнение снимков tracemalloc; возвращает False, если сессия уже идет"""
+        def target():
+            report = memory_diff(seconds, top)
+            self.outbox.send_message(chat_id, f"Профиль памяти\n\n{report}"[:4096])
+        return self._start("memory", target)
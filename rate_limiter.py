@@ -0,0 +1,252 @@
+import os
+import pickle
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from logger import get_logger
+
+log = get_logger("ami.limits")
+
+
+class RateLimiter:
+    """
+    Ограничитель частоты с несколькими скользящими окнами на ключ (user_id / chat_id).
+
+    Для каждого окна хранится только номер текущего интервала и два счетчика
+    (текущий и предыдущий интервал), оценка числа запросов за последние
+    `window` секунд считается взвешиванием предыдущего интервала.
+    Ключи, не активные дольше самого длинного окна, удаляются автоматически.
+    """
+
+    # Раз в сколько вызовов hit() выполнять вытеснение неактивных ключей
+    EVICT_EVERY = 1024
+
+    def __init__(self, windows: List[Tuple[int, int]], storage_file: Optional[str] = None,
+                 store=None, name: str = "default"):
+        """
+        Args:
+            windows: список пар (длина окна в секундах, лимит запросов в окне)
+            storage_file: файл для сохранения состояния между перезапусками (опционально)
+            store: общий StateStore; если задан, счетчики хранятся в нем и видны всем процессам
+            name: имя набора счетчиков в общем хранилище
+        """
+        self.windows = [(int(seconds), int(limit)) for seconds, limit in windows]
+        self.idle_ttl = max(seconds for seconds, _ in self.windows)
+        self.storage_file = storage_file
+        self.store = store
+        self.name = name
+        self._entry_size = 1 + len(self.windows) * 3
+        # {key: [last_seen, bucket_0, cur_0, prev_0, bucket_1, cur_1, prev_1, ...]}
+        self._state: Dict[int, List[int]] = {}
+        self._lock = threading.Lock()
+        self._ops = 0
+        if storage_file:
+            self._load()
+
+    def _roll(self, entry: List[int], now: float) -> None:
+        """Сдвигает интервалы всех окон записи к текущему моменту"""
+        for i, (seconds, _) in enumerate(self.windows):
+            base = 1 + i * 3
+            bucket = int(now // seconds)
+            stored = entry[base]
+            if bucket != stored:
+                entry[base + 2] = entry[base + 1] if bucket == stored + 1 else 0
+                entry[base + 1] = 0
+                entry[base] = bucket
+
+    def _estimate(self, entry: List[int], index: int, now: float) -> float:
+        seconds = self.windows[index][0]
+        base = 1 + index * 3
+        elapsed = (now % seconds) / seconds
+        return entry[base + 2] * (1 - elapsed) + entry[base + 1]
+
+    def _hit_entry(self, entry: List[int], now: float) -> Optional[Tuple[int, int]]:
+        self._roll(entry, now)
+        entry[0] = int(now)
+
+        for i, (seconds, limit) in enumerate(self.windows):
+            if self._estimate(entry, i, now) + 1 > limit:
+                return seconds, limit
+
+        for i in range(len(self.windows)):
+            entry[2 + i * 3] += 1
+        return None
+
+    def hit(self, key: int, now: Optional[float] = None) -> bool:
+        """Учитывает запрос; возвращает False, если хотя бы одно окно исчерпано"""
+        return self.hit_window(key, now) is None
+
+    def hit_window(self, key: int, now: Optional[float] = None) -> Optional[Tuple[int, int]]:
+        """Учитывает запрос; возвращает исчерпанное окно (длина в секундах, лимит) или None"""
+        now = time.time() if now is None else now
+        if self.store is not None:
+            return self.store.update_limit(self.name, key, self._entry_size, lambda entry: self._hit_entry(entry, now))
+        with self._lock:
+            entry = self._state.get(key)
+            if entry is None:
+                entry = [0] * self._entry_size
+                self._state[key] = entry
+
+            self._ops += 1
+            if self._ops % self.EVICT_EVERY == 0:
+                self._evict(now)
+            return self._hit_entry(entry, now)
+
+    def release(self, key: int, now: float) -> None:
+        """
+        Отменяет запрос, учтенный hit()/hit_window() с тем же now: например, когда его
+        отклонил другой ограничитель и запрос не выполняется
+        """
+        if self.store is not None:
+            self.store.update_limit(self.name, key, self._entry_size, lambda entry: self._release_entry(entry, now))
+            return
+        with self._lock:
+            entry = self._state.get(key)
+            if entry is not None:
+                self._release_entry(entry, now)
+
+    def _release_entry(self, entry: List[int], now: float) -> None:
+        self._roll(entry, now)
+        for i in range(len(self.windows)):
+            if entry[2 + i * 3] > 0:
+                entry[2 + i * 3] -= 1
+
+    def retry_after(self, key: int, now: Optional[float] = None) -> float:
+        """Возвращает число секунд до момента, когда запрос по ключу снова будет разрешен"""
+        now = time.time() if now is None else now
+        if self.store is not None:
+            return self.store.update_limit(self.name, key, self._entry_size,
+                                           lambda entry: self._retry_after_entry(entry, now))
+        with self._lock:
+            entry = self._state.get(key)
+            if entry is None:
+                return 0.0
+            return self._retry_after_entry(entry, now)
+
+    def _retry_after_entry(self, entry: List[int], now: float) -> float:
+        self._roll(entry, now)
+
+        wait = 0.0
+        for i, (seconds, limit) in enumerate(self.windows):
+            base = 1 + i * 3
+            cur, prev = entry[base + 1], entry[base + 2]
+            if prev * (1 - (now % seconds) / seconds) + cur + 1 <= limit:
+                continue
+            until_next = seconds - now % seconds
+            if cur + 1 <= limit:
+                # Достаточно, чтобы вес предыдущего интервала уменьшился
+                fraction = 1 - (limit - cur - 1) / prev
+                wait = max(wait, fraction * seconds - now % seconds)
+            else:
+                # Нужно дождаться следующего интервала и остывания текущего
+                wait = max(wait, until_next + seconds * (1 - (limit - 1) / cur))
+        return max(wait, 0.0)
+
+    def keys(self) -> List[int]:
+        """Возвращает список ключей, для которых хранится состояние"""
+        if self.store is not None:
+            return self.store.limit_keys(self.name)
+        with self._lock:
+            return list(self._state.keys())
+
+    def _evict(self, now: float) -> int:
+        idle_before = now - self.idle_ttl
+        stale = [key for key, entry in self._state.items() if entry[0] < idle_before]
+        for key in stale:
+            del self._state[key]
+        return len(stale)
+
+    def cleanup(self) -> int:
+        """Удаляет неактивные ключи и сохраняет состояние; возвращает число удаленных ключей"""
+        if self.store is not None:
+            return self.store.evict_limits(self.name, time.time() - self.idle_ttl)
+        with self._lock:
+            removed = self._evict(time.time())
+        self.save()
+        return removed
+
+    def _load(self) -> None:
+        """Загружает сохраненное состояние, отбрасывая записи с другой схемой окон"""
+        try:
+            if os.path.exists(self.storage_file):
+                with open(self.storage_file, 'rb') as f:
+                    saved = pickle.load(f)
+                if saved.get('windows') == self.windows:
+                    self._state = saved.get('state', {})
+                    self._evict(time.time())
+        except Exception as e:
+            log.error("limits_load_failed", error=e)
+            self._state = {}
+
+    def save(self) -> None:
+        """Атомарно сохраняет состояние в файл, если он задан"""
+        if not self.storage_file or self.store is not None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.storage_file) or '.', exist_ok=True)
+            with self._lock:
+                data = pickle.dumps({'windows': self.windows, 'state': self._state})
+            tmp_file = f"{self.storage_file}.tmp"
+            with open(tmp_file, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_file, self.storage_file)
+        except Exception as e:
+            log.error("limits_save_failed", error=e)
+
+
+class TokenBucket:
+    """
+    Потокобезопасный token bucket для равномерного темпа запросов.
+
+    Токены пополняются со скоростью `rate` в секунду до `capacity`.
+    pause() останавливает выдачу токенов всем потребителям (например, по retry_after).
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens: float = 1) -> float:
+        """Пытается забрать токены; возвращает 0 при успехе или время ожидания в секундах"""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+            self._refill(now)
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0.0
+            return (tokens - self._tokens) / self.rate
+
+    def wait_time(self, tokens: float = 1) -> float:
+        """Возвращает время ожидания токенов, не забирая их"""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+            self._refill(now)
+            return max(0.0, (tokens - self._tokens) / self.rate)
+
+    def acquire(self, tokens: float = 1) -> None:
+        """Блокирует поток до получения токенов"""
+        while True:
+            wait = self.try_acquire(tokens)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        """Приостанавливает выдачу токенов на заданное время"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+            self._updated = self._paused_until
@@ -0,0 +1,201 @@
+import math
+import threading
+from collections import Counter, OrderedDict, deque
+from typing import Deque, Dict, Hashable, Iterable, List, Tuple
+
+from sentimental import preprocess_text, stem_word
+from metrics import gauge
+
+# Служебные слова, не несущие смысла для поиска
+STOP_WORDS = {
+    'и', 'в', 'во', 'на', 'с', 'со', 'к', 'ко', 'по', 'за', 'из', 'от', 'до', 'о', 'об', 'у', 'а', 'но',
+    'же', 'ли', 'бы', 'то', 'это', 'как', 'что', 'так', 'вот', 'ну', 'да', 'я', 'ты', 'он', 'она',
+    'мы', 'вы', 'они', 'мне', 'тебе', 'меня', 'тебя', 'его', 'ее', 'её', 'их', 'там', 'тут', 'уже',
+    'еще', 'ещё', 'для', 'при', 'или', 'если', 'чтобы', 'тоже', 'все', 'всё', 'был', 'была', 'было',
+    'такое', 'такой', 'какой', 'какая', 'какие', 'кто', 'где', 'когда', 'зачем', 'почему', 'сколько',
+}
+# Односимвольные падежные окончания, которые stem_word оставляет (планета/планету/планеты)
+_SHORT_ENDINGS = tuple('аеиоуыьйюя')
+
+
+def _term(word: str) -> str:
+    stem = stem_word(word)
+    if len(stem) > 4 and stem.endswith(_SHORT_ENDINGS):
+        return stem[:-1]
+    return stem
+
+
+def tokenize(text: str) -> List[str]:
+    """Основы значимых слов текста (стемминг SentimentClassifier плюс отсечение односимвольных окончаний)"""
+    return [_term(word) for word in preprocess_text(text or "") if word not in STOP_WORDS]
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов модели: ~3 символа кириллицы на токен"""
+    return len(text) // 3 + 1
+
+
+def _message_key(message: Dict) -> Tuple[float, str]:
+    # Сообщение в контексте пользователя и в истории чата - разные словари с общими полями
+    return message.get('timestamp', 0), message.get('text', '')
+
+
+def bm25_scores(terms: Iterable[str], postings: Dict[str, Dict[Hashable, int]], lengths: Dict[Hashable, int],
+                total_length: int, k1: float = 1.5, b: float = 0.75) -> Dict[Hashable, float]:
+    """
+    Оценки BM25 документов, содержащих хотя бы один из термов.
+
+    Args:
+        postings: {терм: {документ: частота терма в документе}}
+        lengths: {документ: число термов}
+        total_length: сумма lengths
+    """
+    count = len(lengths)
+    if not count:
+        return {}
+    avg_length = total_length / count or 1.0
+    scores: Dict[Hashable, float] = {}
+    for term in set(terms):
+        posting = postings.get(term)
+        if not posting:
+            continue
+        idf = math.log(1 + (count - len(posting) + 0.5) / (len(posting) + 0.5))
+        for doc, tf in posting.items():
+            norm = k1 * (1 - b + b * lengths[doc] / avg_length)
+            scores[doc] = scores.get(doc, 0.0) + idf * tf * (k1 + 1) / (tf + norm)
+    return scores
+
+
+class _Doc:
+    __slots__ = ("seq", "message", "terms", "length")
+
+    def __init__(self, seq: int, message: Dict, terms: Counter):
+        self.seq = seq
+        self.message = message
+        self.terms = terms
+        self.length = sum(terms.values())
+
+
+class _ChatIndex:
+    """Инвертированный индекс одного чата с окном из последних max_docs сообщений"""
+
+    def __init__(self, max_docs: int):
+        self.max_docs = max_docs
+        self.docs: Deque[_Doc] = deque()
+        self.postings: Dict[str, Dict[int, int]] = {}
+        self.lengths: Dict[int, int] = {}
+        self.total_length = 0
+        self.seq = 0
+
+    def add(self, message: Dict) -> None:
+        terms = Counter(tokenize(message.get('text', '')))
+        self.seq += 1
+        doc = _Doc(self.seq, message, terms)
+        self.docs.append(doc)
+        self.lengths[doc.seq] = doc.length
+        self.total_length += doc.length
+        for term, tf in terms.items():
+            self.postings.setdefault(term, {})[doc.seq] = tf
+        if len(self.docs) > self.max_docs:
+            self._evict(self.docs.popleft())
+
+    def _evict(self, doc: _Doc) -> None:
+        self.total_length -= doc.length
+        del self.lengths[doc.seq]
+        for term in doc.terms:
+            posting = self.postings[term]
+            del posting[doc.seq]
+            if not posting:
+                del self.postings[term]
+
+    def search(self, terms: Iterable[str], k1: float, b: float) -> Dict[int, float]:
+        """BM25: {seq сообщения: оценка} для сообщений, содержащих хотя бы один терм"""
+        return bm25_scores(terms, self.postings, self.lengths, self.total_length, k1, b)
+
+    def message(self, seq: int) -> Dict:
+        # seq идут подряд, поэтому позиция в окне вычисляется без поиска
+        return self.docs[seq - self.docs[0].seq].message
+
+
+class ChatHistoryIndex:
+    """
+    BM25-индекс истории сообщений по чатам для выбора релевантного контекста промпта.
+
+    Индекс обновляется инкрементально при каждом сообщении: хранятся последние
+    max_docs сообщений каждого из max_chats недавно активных чатов.
+    Индекс живет только в памяти и после перезапуска наполняется заново.
+    """
+
+    def __init__(self, max_docs: int = 300, max_chats: int = 500, k1: float = 1.5, b: float = 0.75):
+        self.max_docs = max_docs
+        self.max_chats = max_chats
+        self.k1 = k1
+        self.b = b
+        self._chats: "OrderedDict[int, _ChatIndex]" = OrderedDict()
+        self._lock = threading.Lock()
+        gauge("ami_history_index_chats", "Чаты в индексе истории сообщений", fn=lambda: len(self._chats))
+
+    def add(self, chat_id: int, message: Dict) -> None:
+        """message: {'text', 'timestamp', 'user_id', 'name'}"""
+        with self._lock:
+            index = self._chats.get(chat_id)
+            if index is None:
+                index = self._chats[chat_id] = _ChatIndex(self.max_docs)
+                if len(self._chats) > self.max_chats:
+                    self._chats.popitem(last=False)
+            else:
+                self._chats.move_to_end(chat_id)
+            index.add(message)
+
+    def search(self, chat_id: int, query: str, k: int = 5, exclude: Iterable[Dict] = ()) -> List[Tuple[float, Dict]]:
+        """До k сообщений чата, наиболее релевантных запросу, по убыванию оценки"""
+        terms = tokenize(query)
+        excluded = {_message_key(message) for message in exclude}
+        with self._lock:
+            index = self._chats.get(chat_id)
+            if index is None or not terms:
+                return []
+            scores = index.search(terms, self.k1, self.b)
+            ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+            results = []
+            for seq, score in ranked:
+                message = index.message(seq)
+                if _message_key(message) in excluded:
+                    continue
+                results.append((score, message))
+                if len(results) >= k:
+                    break
+            return results
+
+    def select(self, chat_id: int, query: str, recent: List[Dict], token_budget: int,
+               k: int = 5, keep_recent: int = 2, exclude: Iterable[Dict] = ()) -> List[Dict]:
+        """
+        Контекст для промпта в пределах token_budget: сначала keep_recent последних
+        сообщений пользователя из recent (связность диалога), затем до k наиболее
+        релевантных запросу сообщений чата. Результат упорядочен по времени.
+        """
+        selected: List[Dict] = []
+        excluded = list(exclude)
+        seen = {_message_key(message) for message in excluded}
+        budget = token_budget
+
+        def take(message: Dict) -> None:
+            nonlocal budget
+            key = _message_key(message)
+            cost = estimate_tokens(message.get('text', ''))
+            if key in seen or cost > budget:
+                return
+            seen.add(key)
+            budget -= cost
+            selected.append(message)
+
+        for message in reversed(recent[-keep_recent:] if keep_recent else []):
+            take(message)
+        retrieved = 0
+        for _, message in self.search(chat_id, query, k=k + len(selected), exclude=excluded):
+            if retrieved >= k:
+                break
+            before = len(selected)
+            take(message)
+            retrieved += len(selected) - before
+        return sorted(selected, key=lambda message: message.get('timestamp', 0))
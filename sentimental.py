@@ -1,5 +1,50 @@
 import re
 from collections import Counter
+from functools import lru_cache
+from typing import List
+
+# Частые окончания русских слов
+RUSSIAN_ENDINGS = [
+    'ая', 'ый', 'ой', 'ий', 'ей', 'ые', 'ие', 'ого', 'его', 'ому', 'ему',
+    'ом', 'ем', 'ой', 'ей', 'ую', 'юю', 'ые', 'ии', 'ях', 'ами', 'ями',
+    'ть', 'ти', 'шь', 'ет', 'ут', 'ют', 'ат', 'ят', 'ешь', 'ишь', 'ем',
+    'им', 'ете', 'ите', 'ал', 'ял', 'ыл', 'ил', 'ла', 'ло', 'ли', 'ся',
+    'сь', 'енн', 'нн', 'ств', 'ост', 'есть', 'ичь', 'аться', 'иться',
+    'ющий', 'юща', 'ющи', 'вш', 'авш', 'ивш', 'енн', 'еннo', 'ива', 'ыва'
+]
+# Сначала проверяются самые длинные окончания
+_ENDINGS_BY_LENGTH = sorted(set(RUSSIAN_ENDINGS), key=len, reverse=True)
+# Усредненные оценки ближе к нулю, чем эта, считаются нейтральными
+MOOD_NEUTRAL_BAND = 0.1
+
+
+def preprocess_text(text: str) -> List[str]:
+    """Нижний регистр, без пунктуации, разбиение на слова"""
+    return re.sub(r'[^\w\s]', '', text.lower()).split()
+
+
+@lru_cache(maxsize=65536)
+def stem_word(word: str) -> str:
+    """
+    Простой алгоритм стемминга для русского языка
+
+    Args:
+        word (str): Слово для стемминга
+
+    Returns:
+        str: Основа слова
+    """
+    if len(word) <= 3:  # Короткие слова оставляем без изменений
+        return word
+
+    # Удаляем окончания
+    for ending in _ENDINGS_BY_LENGTH:
+        if word.endswith(ending) and len(word) - len(ending) >= 3:
+            return word[:-len(ending)]
+
+    # Если не нашли окончаний, возвращаем оригинальное слово
+    return word
+
 
 class SentimentClassifier:
     def __init__(self):
@@ -49,47 +94,14 @@ class SentimentClassifier:
     }
 
     # Частые окончания русских слов
-      self.endings = [
-        'ая', 'ый', 'ой', 'ий', 'ей', 'ые', 'ие', 'ого', 'его', 'ому', 'ему',
-        'ом', 'ем', 'ой', 'ей', 'ую', 'юю', 'ые', 'ии', 'ях', 'ами', 'ями',
-        'ть', 'ти', 'шь', 'ет', 'ут', 'ют', 'ат', 'ят', 'ешь', 'ишь', 'ем',
-        'им', 'ете', 'ите', 'ал', 'ял', 'ыл', 'ил', 'ла', 'ло', 'ли', 'ся',
-        'сь', 'енн', 'нн', 'ств', 'ост', 'есть', 'ичь', 'аться', 'иться',
-        'ющий', 'юща', 'ющи', 'вш', 'авш', 'ивш', 'енн', 'еннo', 'ива', 'ыва'
-    ]
+      self.endings = RUSSIAN_ENDINGS
     
     def _preprocess_text(self, text):
-        # Преобразование текста к нижнему регистру
-        text = text.lower()
-        
-        # Удаление пунктуации (кроме пробелов)
-        text = re.sub(r'[^\w\s]', '', text)
-        
-        # Разделение на слова
-        words = text.split()
-        
-        return words
+        return preprocess_text(text)
     
     def _stem_word(self, word):
-        """
-        Простой алгоритм стемминга для русского языка
-        
-        Args:
-            word (str): Слово для стемминга
-        
-        Returns:
-            str: Основа слова
-        """
-        if len(word) <= 3:  # Короткие слова оставляем без изменений
-            return word
-            
-        # Удаляем окончания
-        for ending in sorted(self.endings, key=len, reverse=True):
-            if word.endswith(ending) and len(word) - len(ending) >= 3:
-                return word[:-len(ending)]
-                
-        # Если не нашли окончаний, возвращаем оригинальное слово
-        return word
+        """Основа слова (см. stem_word)"""
+        return stem_word(word)
     
     def _word_matches_dictionary(self, word, dictionary):
         """
@@ -111,22 +123,15 @@ class SentimentClassifier:
                 
         return False
     
-    def classify(self, text):
+    def _count(self, text):
         """
-        Классифицирует текст по настроению и возвращает одно слово-характеристику
+        Подсчитывает позитивные и негативные слова с учетом отрицаний и усилителей
         
-        Args:
-            text (str): Текст для анализа
-            
         Returns:
-            str: Одно слово, описывающее настроение ('позитивное', 'негативное', 'нейтральное')
+            tuple: (число позитивных, число негативных)
         """
-        if not text:
-            return "нейтральное"
-        
         words = self._preprocess_text(text)
         
-        # Подсчет позитивных и негативных слов с учетом отрицаний и усилителей
         pos_count = 0
         neg_count = 0
         
@@ -161,6 +166,55 @@ class SentimentClassifier:
             
             i += 1
         
+        return pos_count, neg_count
+    
+    def score(self, text):
+        """
+        Числовая оценка настроения текста
+        
+        Args:
+            text (str): Текст для анализа
+            
+        Returns:
+            float: от -1 (только негативные слова) до 1 (только позитивные), 0 - нейтральный текст
+        """
+        if not text:
+            return 0.0
+        pos_count, neg_count = self._count(text)
+        if not pos_count and not neg_count:
+            return 0.0
+        return (pos_count - neg_count) / (pos_count + neg_count)
+    
+    def describe(self, score):
+        """
+        Слово-характеристика для оценки score (в т.ч. усредненной), согласованное с classify:
+        перевес в два раза и больше соответствует |score| >= 1/3
+        """
+        if score >= 1 / 3:
+            return "восторженное"
+        if score >= MOOD_NEUTRAL_BAND:
+            return "позитивное"
+        if score <= -1 / 3:
+            return "негативное"
+        if score <= -MOOD_NEUTRAL_BAND:
+            return "разочарованное"
+        return "нейтральное"
+    
+    def classify(self, text):
+        """
+        Классифицирует текст по настроению и возвращает одно слово-характеристику
+        
+        Args:
+            text (str): Текст для анализа
+            
+        Returns:
+            str: Одно слово, описывающее настроение ('позитивное', 'негативное', 'нейтральное')
+        """
+        if not text:
+            return "нейтральное"
+        
+        pos_count, neg_count = self._count(text)
+        
         # Определение преобладающего настроения
         if pos_count > neg_count:
             if pos_count >= neg_count * 2:
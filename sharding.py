@@ -0,0 +1,288 @@
+import json
+import multiprocessing
+import os
+import queue
+import shutil
+import signal
+import threading
+import time
+from functools import partial
+from typing import Callable, List, Optional
+
+from config import Config
+from keyed_executor import KeyedExecutor
+from logger import get_logger, configure_logging
+from metrics import counter, gauge, start_metrics_server
+from mood import reshard as reshard_mood
+from snapshot import reshard_snapshots
+
+log = get_logger("ami.shards")
+
+# Типы обновлений, в которых чат лежит в поле "chat" самого объекта
+_CHAT_UPDATE_FIELDS = (
+    "message", "edited_message", "channel_post", "edited_channel_post",
+    "chat_member", "my_chat_member", "chat_join_request",
+)
+
+
+def chat_id_of(update: dict) -> Optional[int]:
+    """Идентификатор чата из необработанного обновления Telegram (None, если его нет или формат другой)"""
+    for field in _CHAT_UPDATE_FIELDS:
+        if field in update:
+            return _chat_id(update[field])
+    callback = update.get("callback_query")
+    if isinstance(callback, dict):
+        return _chat_id(callback.get("message"))
+    return None
+
+
+def _chat_id(obj) -> Optional[int]:
+    chat = obj.get("chat") if isinstance(obj, dict) else None
+    chat_id = chat.get("id") if isinstance(chat, dict) else None
+    return chat_id if isinstance(chat_id, int) else None
+
+
+def shard_for(chat_id: Optional[int], shards: int) -> int:
+    """Все обновления одного чата попадают в один и тот же процесс"""
+    return 0 if chat_id is None else chat_id % shards
+
+
+# Файлы процесса, разбитые по чатам (общее состояние лежит в корне data)
+SHARD_FILES = ("context_storage.bin", "mood.bin")
+# Число процессов, по которому разбиты файлы
+_LAYOUT_FILE = "shards.json"
+
+
+def shard_dir(data_root: str, shard: int, shards: int) -> str:
+    """Директория файлов процесса; в однопроцессном режиме - сам корень data"""
+    return data_root if shards == 1 else os.path.join(data_root, f"shard-{shard}")
+
+
+def _stored_shards(data_root: str) -> int:
+    try:
+        with open(os.path.join(data_root, _LAYOUT_FILE)) as f:
+            return int(json.load(f)["shards"])
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        log.warning("shard_layout_unreadable", error=e)
+    # Данные, сохраненные до появления файла разбиения: по директориям процессов
+    shards = [int(name[6:]) for name in os.listdir(data_root)
+              if name.startswith("shard-") and name[6:].isdigit()]
+    return max(shards) + 1 if shards else 1
+
+
+def migrate_shard_data(data_root: str, shards: int) -> None:
+    """
+    Перераспределяет контексты и настроение по процессам, если с прошлого запуска
+    изменилось их число: иначе чаты, попавшие в другой процесс, теряют сохраненные данные.
+    Вызывается до запуска рабочих процессов. Новые файлы сначала собираются во временной
+    директории и только затем заменяют прежние.
+    """
+    previous = _stored_shards(data_root)
+    if previous != shards:
+        staging = os.path.join(data_root, "reshard.tmp")
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+        try:
+            shard_of = partial(shard_for, shards=shards)
+            sources = [shard_dir(data_root, shard, previous) for shard in range(previous)]
+            staged = [os.path.join(staging, str(shard)) for shard in range(shards)]
+            for directory in staged:
+                os.makedirs(directory)
+            contexts = reshard_snapshots([os.path.join(d, "context_storage.bin") for d in sources],
+                                         [os.path.join(d, "context_storage.bin") for d in staged], shard_of)
+            reshard_mood([os.path.join(d, "mood.bin") for d in sources],
+                         [os.path.join(d, "mood.bin") for d in staged], shard_of)
+        except Exception as e:
+            # Прежние файлы не тронуты; перенос повторится при следующем запуске
+            log.error("shard_data_migration_failed", previous=previous, shards=shards, error=e)
+            shutil.rmtree(staging, ignore_errors=True)
+            return
+        for directory in sources:
+            for name in SHARD_FILES:
+                try:
+                    os.unlink(os.path.join(directory, name))
+                except FileNotFoundError:
+                    pass
+            if directory != data_root:
+                try:
+                    # Директория процесса, которого больше нет (или которую заново создаст перенос)
+                    os.rmdir(directory)
+                except OSError:
+                    pass
+        for shard, directory in enumerate(staged):
+            target = shard_dir(data_root, shard, shards)
+            os.makedirs(target, exist_ok=True)
+            for name in SHARD_FILES:
+                os.replace(os.path.join(directory, name), os.path.join(target, name))
+        shutil.rmtree(staging, ignore_errors=True)
+        log.info("shard_data_migrated", previous=previous, shards=shards, contexts=contexts)
+    with open(os.path.join(data_root, _LAYOUT_FILE), "w") as f:
+        json.dump({"shards": shards}, f)
+
+
+def worker_main(shard: int, shards: int, updates, workers: int = 4) -> None:
+    """
+    Точка входа рабочего процесса: собственный TelegramBot с контекстами и настроением
+    в data/shard-N (общее состояние чатов и лимиты - в data/state.db),
+    обновления читаются из очереди в порядке поступления до получения None,
+    после чего процесс дожидается начатых ответов и сохраняет состояние.
+
+    Обработчики выполняются в пуле из workers потоков: обновления одного чата - по одному
+    в порядке поступления, разных чатов - параллельно. TeleBot создается с threaded=False,
+    иначе он передал бы обработчики в свой пул и порядок внутри чата не сохранился бы.
+    """
+    # Остановкой управляет процесс приема: он прекращает прием, присылает None
+    # и ждет, пока процесс дообработает очередь и сохранит состояние
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, signal.SIG_IGN)
+    configure_logging(Config.LOG_LEVEL, Config.LOG_SAMPLE_RATES)
+    if Config.METRICS_PORT:
+        try:
+            start_metrics_server(Config.METRICS_PORT + 1 + shard)
+        except OSError as e:
+            log.error("metrics_server_failed", shard=shard, error=e)
+
+    from main import build_bot
+    data_dir = shard_dir(os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"), shard, shards)
+    os.makedirs(data_dir, exist_ok=True)
+    bot = build_bot(data_dir=data_dir, threaded=False)
+    handlers = KeyedExecutor(workers, thread_name_prefix=f"shard-{shard}")
+    parent = os.getppid()
+    log.info("shard_started", shard=shard, shards=shards, pid=os.getpid())
+
+    while True:
+        try:
+            update = updates.get(timeout=1.0)
+        except queue.Empty:
+            if os.getppid() != parent:
+                log.error("shard_orphaned", shard=shard)
+                break
+            continue
+        if update is None:
+            break
+        handlers.submit(chat_id_of(update), lambda update=update: bot._process_raw_update(update))
+    # Сначала дообрабатываются уже полученные обновления, затем останавливается бот
+    handlers.shutdown(wait=True)
+    bot.lifecycle.shutdown("queue_closed")
+    log.info("shard_stopped", shard=shard)
+
+
+class ShardedRunner:
+    """
+    Процесс приема обновлений (polling или webhook), распределяющий их по chat_id
+    между N рабочими процессами через локальные очереди. Очередь у каждого процесса
+    одна, поэтому обновления одного чата доставляются в порядке поступления.
+    Упавший рабочий процесс перезапускается с той же очередью.
+    """
+
+    def __init__(self, shards: int, worker: Callable = worker_main, queue_size: int = 1000,
+                 supervise_interval: float = 5.0):
+        self.shards = shards
+        self.worker = worker
+        self.supervise_interval = supervise_interval
+        self._context = multiprocessing.get_context("spawn")
+        self.queues = [self._context.Queue(maxsize=queue_size) for _ in range(shards)]
+        self.processes: List[Optional[multiprocessing.Process]] = [None] * shards
+        self._stopping = threading.Event()
+        self._server = None
+        self._dispatched = counter("ami_shard_updates_total", "Обновления, переданные рабочим процессам", ("shard",))
+        gauge("ami_shard_alive", "Живые рабочие процессы",
+              fn=lambda: sum(1 for p in self.processes if p is not None and p.is_alive()))
+
+    def _spawn(self, shard: int) -> None:
+        process = self._context.Process(
+            target=self.worker, args=(shard, self.shards, self.queues[shard]), name=f"ami-shard-{shard}"
+        )
+        process.start()
+        self.processes[shard] = process
+
+    def _supervise(self) -> None:
+        while not self._stopping.wait(self.supervise_interval):
+            for shard, process in enumerate(self.processes):
+                if process is not None and not process.is_alive():
+                    log.error("shard_died", shard=shard, exitcode=process.exitcode)
+                    self._spawn(shard)
+
+    def start(self) -> None:
+        for shard in range(self.shards):
+            self._spawn(shard)
+        threading.Thread(target=self._supervise, name="shard-supervisor", daemon=True).start()
+
+    def dispatch(self, update: dict) -> None:
+        """Передает обновление процессу его чата; блокируется, если очередь процесса заполнена"""
+        shard = shard_for(chat_id_of(update), self.shards)
+        self.queues[shard].put(update)
+        self._dispatched.labels(shard).inc()
+
+    def stop_intake(self) -> None:
+        """Прекращает прием обновлений; уже переданные в очереди будут обработаны"""
+        self._stopping.set()
+        if self._server is not None:
+            self._server.stop()
+
+    def stop(self, timeout: float = 30.0) -> None:
+        """Сообщает процессам о завершении и ждет, пока они дообработают свои очереди"""
+        self._stopping.set()
+        for queue in self.queues:
+            queue.put(None)
+        deadline = time.monotonic() + timeout
+        for process in self.processes:
+            if process is not None:
+                process.join(max(0.0, deadline - time.monotonic()))
+                if process.is_alive():
+                    process.terminate()
+
+    def run_polling(self, token: str, timeout: int = 10, long_polling_timeout: int = 5) -> None:
+        """Long polling в процессе приема: необработанные обновления сразу уходят в очереди"""
+        import telebot
+        from telebot import apihelper
+
+        telebot.TeleBot(token).remove_webhook()
+        log.info("bot_started", mode="polling", shards=self.shards)
+        offset = None
+        while not self._stopping.is_set():
+            try:
+                updates = apihelper.get_updates(
+                    token, offset=offset, timeout=timeout,
+                    allowed_updates=telebot.util.update_types, long_polling_timeout=long_polling_timeout
+                )
+            except Exception as e:
+                log.warning("get_updates_failed", error=e)
+                time.sleep(3)
+                continue
+            for update in updates:
+                offset = update["update_id"] + 1
+                self.dispatch(update)
+        self._confirm_offset(token, offset)
+
+    @staticmethod
+    def _confirm_offset(token: str, offset: Optional[int]) -> None:
+        """
+        Подтверждает Telegram последние переданные обновления: без этого после
+        перезапуска он прислал бы последнюю пачку повторно
+        """
+        if offset is None:
+            return
+        from telebot import apihelper
+        try:
+            apihelper.get_updates(token, offset=offset, limit=1, timeout=0)
+        except Exception as e:
+            log.warning("confirm_offset_failed", offset=offset, error=e)
+
+    def run_webhook(self, token: str, url: str, secret_token: Optional[str] = None,
+                    host: str = "0.0.0.0", port: int = 8443) -> None:
+        """Webhook в процессе приема; разбор обновлений выполняют рабочие процессы"""
+        import telebot
+        from urllib.parse import urlparse
+        from webhook import WebhookServer
+
+        bot = telebot.TeleBot(token)
+        bot.remove_webhook()
+        bot.set_webhook(url=url, secret_token=secret_token, allowed_updates=telebot.util.update_types)
+        log.info("bot_started", mode="webhook", url=url, shards=self.shards)
+        # Обновления одного чата передаются в очередь процесса по одному, в порядке поступления
+        self._server = WebhookServer(self.dispatch, secret_token, host=host, port=port,
+                                     path=urlparse(url).path or "/", key=chat_id_of)
+        self._server.serve_forever()
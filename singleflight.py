@@ -0,0 +1,94 @@
+import os
+import tempfile
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, List
+
+from metrics import counter
+from voice_generator import VoiceGenerator
+
+SINGLEFLIGHT_CALLS = counter("ami_singleflight_calls_total", "Вызовы, реально ушедшие во внешний сервис", ("group",))
+SINGLEFLIGHT_SUPPRESSED = counter(
+    "ami_singleflight_suppressed_total", "Дубликаты, получившие результат уже выполняющегося вызова", ("group",)
+)
+
+
+class SingleFlight:
+    """
+    Объединяет одновременные одинаковые запросы: первый вызывающий (лидер) выполняет
+    функцию в своем потоке, остальные с тем же ключом ждут и получают тот же результат
+    или то же исключение. Результат не кэшируется после завершения вызова.
+    """
+
+    def __init__(self, group: str):
+        self.group = group
+        self._inflight: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+        self._calls = SINGLEFLIGHT_CALLS.labels(group)
+        self._suppressed = SINGLEFLIGHT_SUPPRESSED.labels(group)
+
+    def do(self, key: Hashable, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._inflight[key] = future
+
+        if not leader:
+            self._suppressed.inc()
+            return future.result()
+
+        self._calls.inc()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+
+class CoalescingScraper:
+    """GoogleScraper, у которого одинаковые одновременные запросы поиска выполняются один раз"""
+
+    def __init__(self, scraper):
+        self._scraper = scraper
+        self._content = SingleFlight("web_search")
+        self._images = SingleFlight("image_search")
+
+    def __getattr__(self, name: str):
+        return getattr(self._scraper, name)
+
+    def get_content_with_fallback(self, query: str) -> str:
+        return self._content.do(query, self._scraper.get_content_with_fallback, query)
+
+    def search_images(self, query: str, num: int = 5) -> List[str]:
+        # Копия списка: вызывающие не должны менять общий результат
+        return list(self._images.do((query, num), self._scraper.search_images, query, num=num))
+
+
+class CoalescingVoiceGenerator(VoiceGenerator):
+    """
+    Озвучка одного текста выполняется один раз на всех одновременных вызывающих:
+    они получают байты, полученные лидером. generate() записывает их в собственный
+    временный файл вызывающего, который он может удалить после отправки.
+    """
+
+    def __init__(self, generator: VoiceGenerator):
+        self._generator = generator
+        self._flight = SingleFlight("tts")
+
+    def synthesize(self, text: str) -> bytes:
+        return self._flight.do(text, self._generator.synthesize, text)
+
+    def generate(self, text: str) -> str:
+        data = self.synthesize(text)
+        fd, path = tempfile.mkstemp(suffix=".mp3")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        return path
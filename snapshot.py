@@ -0,0 +1,229 @@
+"""
+Бинарный снапшот контекстов диалогов.
+
+Формат (числа little-endian):
+    заголовок  MAGIC (8 байт) | версия u16 | число диалогов u32 | смещение индекса u64
+    записи     на диалог: число сообщений n u16 | время f64[n] | длина текста u32[n] |
+               тексты UTF-8 подряд
+    индекс     смещения записей u64[n + 1] | время последнего сообщения f64[n] |
+               ключи "chat_id:user_id" в UTF-8 через перевод строки
+
+Индекс лежит в конце файла и читается целиком несколькими операциями над массивами,
+без разбора отдельных записей; сообщения декодируются по запросу из отображенного
+в память файла. Запись идет во временный файл рядом с целевым и заменяет его
+через os.replace, поэтому сбой во время сохранения не портит предыдущий снапшот.
+"""
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from array import array
+from itertools import accumulate
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+MAGIC = b"AMICTX\x00\x00"
+VERSION = 1
+
+_HEADER = struct.Struct("<8sHIQ")
+_COUNT = struct.Struct("<H")
+_LAYOUTS: Dict[int, struct.Struct] = {}
+
+
+class SnapshotError(ValueError):
+    """Файл не является снапшотом поддерживаемой версии или поврежден"""
+
+
+def _layout(count: int) -> struct.Struct:
+    layout = _LAYOUTS.get(count)
+    if layout is None:
+        layout = _LAYOUTS[count] = struct.Struct(f"<H{count}d{count}I")
+    return layout
+
+
+def encode_messages(messages: List[Dict]) -> bytes:
+    texts = [(message.get('text') or '').encode('utf-8') for message in messages]
+    return _layout(len(messages)).pack(
+        len(messages), *[message.get('timestamp', 0) for message in messages], *map(len, texts)
+    ) + b"".join(texts)
+
+
+def decode_messages(data: bytes) -> List[Dict]:
+    (count,) = _COUNT.unpack_from(data, 0)
+    layout = _layout(count)
+    fields = layout.unpack_from(data, 0)
+    offset = layout.size
+    messages = []
+    for timestamp, length in zip(fields[1:count + 1], fields[count + 1:]):
+        messages.append({'text': data[offset:offset + length].decode('utf-8'), 'timestamp': timestamp})
+        offset += length
+    return messages
+
+
+def load_array(typecode: str, data: bytes) -> array:
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values
+
+
+def dump_array(values: array) -> bytes:
+    if sys.byteorder != "little":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+class SnapshotReader:
+    """
+    Снапшот, отображенный в память. Диалоги адресуются номером (слотом) в порядке
+    записи; соответствие ключей слотам строит slots().
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < _HEADER.size:
+                raise SnapshotError(f"{path}: файл слишком короткий")
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, count, index_offset = _HEADER.unpack_from(self._mmap, 0)
+            if magic != MAGIC:
+                raise SnapshotError(f"{path}: не снапшот контекста")
+            if version != VERSION:
+                raise SnapshotError(f"{path}: неподдерживаемая версия {version}")
+            times_offset = index_offset + 8 * (count + 1)
+            self._keys_offset = times_offset + 8 * count
+            if self._keys_offset > size:
+                raise SnapshotError(f"{path}: индекс обрезан")
+            self.count = count
+            self.offsets = load_array("Q", self._mmap[index_offset:times_offset])
+            self.last_at = load_array("d", self._mmap[times_offset:self._keys_offset])
+            if self.offsets[0] != _HEADER.size or self.offsets[-1] != index_offset:
+                raise SnapshotError(f"{path}: смещения записей не совпадают с заголовком")
+        except BaseException:
+            self._mmap.close()
+            raise
+
+    def __len__(self) -> int:
+        return self.count
+
+    def slots(self) -> Dict[str, int]:
+        """{ключ диалога: слот}"""
+        if not self.count:
+            return {}
+        keys = self._mmap[self._keys_offset:].decode('utf-8').split("\n")
+        if len(keys) != self.count:
+            raise SnapshotError(f"{self.path}: число ключей не совпадает с заголовком")
+        return dict(zip(keys, range(self.count)))
+
+    def last_timestamp(self, slot: int) -> float:
+        return self.last_at[slot]
+
+    def raw(self, slot: int) -> bytes:
+        """Закодированная запись диалога без декодирования (для пересохранения)"""
+        return self._mmap[self.offsets[slot]:self.offsets[slot + 1]]
+
+    def read(self, slot: int) -> List[Dict]:
+        return decode_messages(self.raw(slot))
+
+    def close(self) -> None:
+        self._mmap.close()
+
+
+def write_snapshot(path: str, records: Iterable[Tuple[str, bytes, float]],
+                   source: Optional[SnapshotReader] = None, keep: Optional[Dict[str, int]] = None) -> int:
+    """
+    Атомарно записывает снапшот и возвращает число диалогов.
+
+    Args:
+        records: новые записи (ключ, закодированные сообщения, время последнего сообщения)
+        source, keep: {ключ: слот} диалогов, копируемых из source без декодирования;
+            подряд идущие слоты копируются одним куском
+
+    Слоты в новом снапшоте идут в порядке records, затем в порядке keep.
+    """
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(prefix=".context-", suffix=".tmp", dir=directory)
+    keys: List[str] = []
+    offsets = array("Q", [_HEADER.size])
+    last_at = array("d")
+    try:
+        with os.fdopen(fd, 'wb', buffering=1 << 20) as f:
+            f.write(_HEADER.pack(MAGIC, VERSION, 0, 0))
+            offset = _HEADER.size
+            records = list(records)
+            if records:
+                new_keys, chunks, timestamps = zip(*records)
+                f.write(b"".join(chunks))
+                ends = list(accumulate(map(len, chunks), initial=offset))
+                keys.extend(new_keys)
+                offsets.extend(ends[1:])
+                last_at.extend(timestamps)
+                offset = ends[-1]
+            if keep:
+                keys.extend(keep)
+                offset = _copy_runs(f, source, list(keep.values()), offset, offsets, last_at)
+            f.write(dump_array(offsets))
+            f.write(dump_array(last_at))
+            f.write("\n".join(keys).encode('utf-8'))
+            f.seek(0)
+            f.write(_HEADER.pack(MAGIC, VERSION, len(keys), offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    return len(keys)
+
+
+def _copy_runs(f, source: SnapshotReader, slots: List[int], offset: int, offsets: array, last_at: array) -> int:
+    # Границы участков подряд идущих слотов; обычно все слоты идут подряд
+    if slots == list(range(slots[0], slots[0] + len(slots))):
+        starts = [0, len(slots)]
+    else:
+        starts = [0] + [i for i in range(1, len(slots)) if slots[i] != slots[i - 1] + 1] + [len(slots)]
+    for i, j in zip(starts, starts[1:]):
+        first, last = slots[i], slots[j - 1]
+        start, end = source.offsets[first], source.offsets[last + 1]
+        f.write(source._mmap[start:end])
+        shift = offset - start
+        positions = source.offsets[first + 1:last + 2]
+        offsets.extend(positions if shift == 0 else map(shift.__add__, positions))
+        last_at.extend(source.last_at[first:last + 1])
+        offset += end - start
+    return offset
+
+
+def reshard_snapshots(sources: List[str], targets: List[str], shard_of: Callable[[int], int]) -> int:
+    """
+    Перераспределяет диалоги снапшотов sources по снапшотам targets (при смене числа
+    рабочих процессов): диалог попадает в targets[shard_of(chat_id)]. Записи копируются
+    без декодирования; из двух записей одного ключа остается более свежая.
+    Возвращает число диалогов.
+    """
+    records: List[Dict[str, Tuple[bytes, float]]] = [{} for _ in targets]
+    readers = []
+    try:
+        for path in sources:
+            if not os.path.exists(path):
+                continue
+            reader = SnapshotReader(path)
+            readers.append(reader)
+            for key, slot in reader.slots().items():
+                target = records[shard_of(int(key.split(":", 1)[0]))]
+                last = reader.last_timestamp(slot)
+                if key not in target or target[key][1] < last:
+                    target[key] = (reader.raw(slot), last)
+        for path, target in zip(targets, records):
+            write_snapshot(path, ((key, raw, last) for key, (raw, last) in target.items()))
+    finally:
+        for reader in readers:
+            reader.close()
+    return sum(map(len, records))
@@ -0,0 +1,86 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, Executor, Future, wait
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from metrics import counter
+from logger import get_logger
+
+log = get_logger("ami.stages")
+
+STAGE_DEGRADED = counter(
+    "ami_stage_degraded_total", "Этапы, замененные значением по умолчанию", ("stage", "reason")
+)
+
+
+class Stage:
+    """
+    Этап обработки сообщения.
+
+    Args:
+        name: имя этапа, под ним результат доступен зависимым этапам
+        fn: функция, получающая результаты зависимостей позиционно в порядке deps
+        deps: имена этапов, результаты которых нужны fn
+        timeout: дедлайн этапа в секундах от его запуска (None - без ограничения)
+        default: значение при ошибке или истечении дедлайна
+    """
+
+    def __init__(self, name: str, fn: Callable[..., Any], deps: Sequence[str] = (),
+                 timeout: Optional[float] = None, default: Any = None):
+        self.name = name
+        self.fn = fn
+        self.deps = tuple(deps)
+        self.timeout = timeout
+        self.default = default
+
+
+def run_stages(stages: List[Stage], executor: Executor) -> Dict[str, Any]:
+    """
+    Выполняет граф этапов: каждый этап запускается в executor, как только готовы
+    его зависимости, поэтому независимые этапы идут параллельно и общее время
+    определяется критическим путем. Этап, упавший или не уложившийся в дедлайн,
+    получает значение по умолчанию, и зависимые от него этапы продолжают работу.
+    Запуски этапов, не уложившихся в дедлайн, не прерываются, их результат отбрасывается.
+
+    Executor не должен быть тем же пулом, в котором выполняется вызывающий код,
+    иначе вложенные графы могут исчерпать потоки и ждать друг друга.
+    """
+    results: Dict[str, Any] = {}
+    waiting = list(stages)
+    running: Dict[Future, Tuple[Stage, Optional[float]]] = {}
+
+    def degrade(stage: Stage, reason: str, error: Optional[BaseException] = None) -> None:
+        STAGE_DEGRADED.labels(stage.name, reason).inc()
+        log.warning("stage_degraded", stage=stage.name, reason=reason, error=error)
+        results[stage.name] = stage.default
+
+    while waiting or running:
+        for stage in [s for s in waiting if all(dep in results for dep in s.deps)]:
+            waiting.remove(stage)
+            deadline = time.monotonic() + stage.timeout if stage.timeout is not None else None
+            future = executor.submit(stage.fn, *(results[dep] for dep in stage.deps))
+            running[future] = (stage, deadline)
+
+        if not running:
+            # Остались этапы с неизвестными зависимостями
+            for stage in waiting:
+                degrade(stage, "missing_dependency")
+            break
+
+        deadlines = [deadline for _, deadline in running.values() if deadline is not None]
+        timeout = max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+        done, _ = wait(list(running), timeout=timeout, return_when=FIRST_COMPLETED)
+
+        for future in done:
+            stage, _ = running.pop(future)
+            try:
+                results[stage.name] = future.result()
+            except Exception as e:
+                degrade(stage, "error", e)
+
+        now = time.monotonic()
+        for future, (stage, deadline) in list(running.items()):
+            if deadline is not None and now >= deadline:
+                del running[future]
+                degrade(stage, "timeout")
+
+    return results
@@ -0,0 +1,248 @@
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Set
+
+from metrics import gauge
+from logger import get_logger
+
+log = get_logger("ami.state")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chats (
+    chat_id INTEGER PRIMARY KEY,
+    active INTEGER NOT NULL DEFAULT 1,
+    known INTEGER NOT NULL DEFAULT 0,
+    settings TEXT NOT NULL DEFAULT '{}',
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS limits (
+    name TEXT NOT NULL,
+    key INTEGER NOT NULL,
+    last_seen INTEGER NOT NULL,
+    entry TEXT NOT NULL,
+    PRIMARY KEY (name, key)
+);
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER NOT NULL,
+    at REAL NOT NULL
+);
+"""
+
+
+class StateStore:
+    """
+    Общее состояние бота в SQLite (WAL): флаги активности чатов, известные чаты
+    для рассылок, настройки чатов и счетчики лимитов.
+
+    Флаги и настройки чатов читаются из кэша в памяти, поэтому проверка в фильтре
+    сообщений не обращается к диску. Каждое изменение чата пишется в журнал changes;
+    фоновый поток раз в poll_interval секунд перечитывает измененные другими процессами
+    чаты и уведомляет подписчиков. Один файл могут использовать несколько процессов.
+    """
+
+    # Сколько секунд хранить записи журнала изменений
+    CHANGES_TTL = 3600
+
+    def __init__(self, path: str, poll_interval: float = 1.0):
+        self.path = path
+        self.poll_interval = poll_interval
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._inactive: Set[int] = set()
+        self._known: Set[int] = set()
+        self._settings: Dict[int, Dict[str, Any]] = {}
+        self._listeners: List[Callable[[int], None]] = []
+        self._closed = threading.Event()
+
+        with self._connection() as conn:
+            conn.executescript(SCHEMA)
+        self._last_seq = self._connection().execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+        for row in self._connection().execute("SELECT chat_id, active, known, settings FROM chats"):
+            self._cache_row(*row)
+
+        gauge("ami_state_known_chats", "Известные чаты для рассылок", fn=lambda: len(self._known))
+        gauge("ami_state_inactive_chats", "Чаты, где бот отключен", fn=lambda: len(self._inactive))
+        threading.Thread(target=self._poll_changes, name="state-changes", daemon=True).start()
+
+    def _connection(self) -> sqlite3.Connection:
+        # У каждого потока свое соединение: sqlite3 не разделяет их между потоками
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _cache_row(self, chat_id: int, active: int, known: int, settings: str) -> None:
+        with self._lock:
+            if active:
+                self._inactive.discard(chat_id)
+            else:
+                self._inactive.add(chat_id)
+            if known:
+                self._known.add(chat_id)
+            else:
+                self._known.discard(chat_id)
+            parsed = json.loads(settings)
+            if parsed:
+                self._settings[chat_id] = parsed
+            else:
+                self._settings.pop(chat_id, None)
+
+    def _write_chat(self, chat_id: int, sql: str, params: tuple) -> None:
+        """Меняет строку чата, записывает изменение в журнал и обновляет кэш"""
+        now = time.time()
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("INSERT OR IGNORE INTO chats (chat_id, updated_at) VALUES (?, ?)", (chat_id, now))
+            conn.execute(sql, params + (now, chat_id))
+            conn.execute("INSERT INTO changes (chat_id, at) VALUES (?, ?)", (chat_id, now))
+            row = conn.execute("SELECT chat_id, active, known, settings FROM chats WHERE chat_id = ?",
+                               (chat_id,)).fetchone()
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        self._cache_row(*row)
+        self._notify(chat_id)
+
+    def _notify(self, chat_id: int) -> None:
+        for listener in list(self._listeners):
+            try:
+                listener(chat_id)
+            except Exception as e:
+                log.error("state_listener_failed", chat_id=chat_id, error=e)
+
+    def subscribe(self, listener: Callable[[int], None]) -> None:
+        """Вызывает listener(chat_id) при изменении чата в этом или другом процессе"""
+        self._listeners.append(listener)
+
+    def _poll_changes(self) -> None:
+        while not self._closed.wait(self.poll_interval):
+            try:
+                conn = self._connection()
+                changed = conn.execute(
+                    "SELECT seq, chat_id FROM changes WHERE seq > ? ORDER BY seq", (self._last_seq,)
+                ).fetchall()
+                if not changed:
+                    continue
+                self._last_seq = changed[-1][0]
+                for chat_id in {chat_id for _, chat_id in changed}:
+                    row = conn.execute("SELECT chat_id, active, known, settings FROM chats WHERE chat_id = ?",
+                                       (chat_id,)).fetchone()
+                    if row:
+                        self._cache_row(*row)
+                        self._notify(chat_id)
+                conn.execute("DELETE FROM changes WHERE at < ?", (time.time() - self.CHANGES_TTL,))
+            except Exception as e:
+                log.error("state_poll_failed", error=e)
+
+    def close(self) -> None:
+        """
+        Останавливает опрос изменений и переносит журнал WAL в основной файл.
+        Изменения пишутся сразу, поэтому отдельного сохранения не требуется.
+        """
+        self._closed.set()
+        try:
+            self._connection().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except sqlite3.Error as e:
+            log.warning("state_checkpoint_failed", error=e)
+
+    # --- чаты ---
+
+    def is_active(self, chat_id: int) -> bool:
+        return chat_id not in self._inactive
+
+    def set_active(self, chat_id: int, active: bool) -> bool:
+        """Включает или отключает бота в чате; возвращает False, если состояние не изменилось"""
+        if self.is_active(chat_id) == active:
+            return False
+        self._write_chat(chat_id, "UPDATE chats SET active = ?, updated_at = ? WHERE chat_id = ?", (int(active),))
+        return True
+
+    def add_known(self, chat_id: int) -> None:
+        """Запоминает чат для рассылок; запись на диск только для нового чата"""
+        if chat_id in self._known:
+            return
+        self._write_chat(chat_id, "UPDATE chats SET known = ?, updated_at = ? WHERE chat_id = ?", (1,))
+
+    def forget(self, chat_id: int) -> None:
+        """Исключает чат из рассылок (бот удален или заблокирован)"""
+        if chat_id not in self._known:
+            return
+        self._write_chat(chat_id, "UPDATE chats SET known = ?, updated_at = ? WHERE chat_id = ?", (0,))
+
+    def known_chats(self) -> List[int]:
+        with self._lock:
+            return list(self._known)
+
+    def get_setting(self, chat_id: int, name: str, default: Any = None) -> Any:
+        return self._settings.get(chat_id, {}).get(name, default)
+
+    def set_setting(self, chat_id: int, name: str, value: Any) -> None:
+        settings = dict(self._settings.get(chat_id, {}))
+        settings[name] = value
+        self._write_chat(chat_id, "UPDATE chats SET settings = ?, updated_at = ? WHERE chat_id = ?",
+                         (json.dumps(settings, ensure_ascii=False),))
+
+    def import_recipients(self, storage_file: str) -> int:
+        """Переносит список получателей из старого recipients.pkl и переименовывает файл"""
+        if not os.path.exists(storage_file):
+            return 0
+        try:
+            with open(storage_file, 'rb') as f:
+                chats = list(pickle.load(f))
+        except Exception as e:
+            log.error("recipients_import_failed", error=e)
+            return 0
+        for chat_id in chats:
+            self.add_known(chat_id)
+        try:
+            os.replace(storage_file, f"{storage_file}.migrated")
+        except FileNotFoundError:
+            # Файл одновременно перенес другой процесс; повторное добавление чатов ничего не меняет
+            return 0
+        log.info("recipients_imported", count=len(chats))
+        return len(chats)
+
+    # --- лимиты ---
+
+    def update_limit(self, name: str, key: int, size: int, fn: Callable[[List[int]], Any]) -> Any:
+        """
+        Атомарно (между процессами) читает запись лимита, передает ее в fn для изменения
+        на месте и сохраняет. Запись другой длины (сменилась схема окон) начинается заново.
+        """
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT entry FROM limits WHERE name = ? AND key = ?", (name, key)).fetchone()
+            entry = json.loads(row[0]) if row else []
+            if len(entry) != size:
+                entry = [0] * size
+            result = fn(entry)
+            conn.execute(
+                "INSERT OR REPLACE INTO limits (name, key, last_seen, entry) VALUES (?, ?, ?, ?)",
+                (name, key, entry[0], json.dumps(entry))
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return result
+
+    def limit_keys(self, name: str) -> List[int]:
+        return [row[0] for row in self._connection().execute("SELECT key FROM limits WHERE name = ?", (name,))]
+
+    def evict_limits(self, name: str, idle_before: float) -> int:
+        cursor = self._connection().execute(
+            "DELETE FROM limits WHERE name = ? AND last_seen < ?", (name, int(idle_before))
+        )
+        return cursor.rowcount
@@ -13,13 +13,18 @@ from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.common.exceptions import TimeoutException, WebDriverException
 
+from fingerprint import distinct_texts
+
 
 class AIBrowser:
     """
     Веб-браузер для ИИ, управляемый через текстовые запросы с псевдокодом,
     использующий Selenium для поддержки JavaScript
     """
-    def __init__(self):
+    def __init__(self, doc_index=None):
+        # Локальный индекс страниц (doc_index.DocumentIndex), куда сохраняется извлеченный текст
+        self.doc_index = doc_index
+        
         # Настройка опций Chrome
         self.options = Options()
         self.options.add_argument('--headless')  # Запуск в фоновом режиме
@@ -172,6 +177,13 @@ class AIBrowser:
             # Разделяем параграфы двойным переносом строки для лучшей читабельности
             main_content = re.sub(r'\n', '\n\n', main_content)
             main_content = re.sub(r'\n{3,}', '\n\n', main_content)
+            
+            # Повторяющиеся и почти одинаковые абзацы оставляем один раз
+            main_content = '\n\n'.join(distinct_texts(main_content.split('\n\n')))
+            
+            if self.doc_index is not None and self.current_url:
+                title = self.soup.title.get_text(strip=True) if self.soup.title else ""
+                self.doc_index.add(self.current_url, title, main_content, urlparse(self.current_url).netloc)
         
         return main_content if main_content else "Не удалось извлечь основной текст страницы"
     
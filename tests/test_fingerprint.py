@@ -0,0 +1,57 @@
+import unittest
+
+from fingerprint import distinct_texts, is_near_duplicate, normalize_url, simhash
+
+ARTICLE = (
+    "Марс - четвертая по удаленности от Солнца планета Солнечной системы. Его называют красной "
+    "планетой из-за оксида железа на поверхности. У Марса два спутника, Фобос и Деймос, и самый "
+    "высокий известный вулкан, гора Олимп, высотой около двадцати шести километров."
+)
+
+
+class DistinctTextsTest(unittest.TestCase):
+    def test_short_distinct_paragraphs_are_kept(self):
+        # Пункты списков и строки таблиц: у коротких текстов отпечатки случайно оказываются близкими
+        # (у первых двух строк расстояние 7 при пороге 8)
+        items = [
+            "Вес товара 454 кг",
+            "Вес товара 776 кг",
+            "Цена: 100 руб.",
+            "Цена: 200 руб.",
+            "Вес 5 кг",
+            "Вес 7 кг",
+            "Доставка по Москве",
+            "Доставка по России",
+            "Гарантия 1 год",
+            "Срок службы 10 лет",
+            "Цвет: красный",
+            "Цвет: синий",
+        ]
+        self.assertEqual(distinct_texts(items), items)
+
+    def test_short_exact_repeats_are_dropped(self):
+        items = ["Читайте также", "Цена: 100 руб.", "читайте  также!", "Цена: 100 руб."]
+        self.assertEqual(distinct_texts(items), ["Читайте также", "Цена: 100 руб."])
+
+    def test_near_duplicate_paragraphs_are_dropped(self):
+        copy = "Реклама. " + ARTICLE + " Источник: example.com"
+        other = (
+            "Юпитер - крупнейшая планета Солнечной системы, газовый гигант с массой в две с половиной "
+            "раза больше массы всех остальных планет вместе взятых и десятками известных спутников."
+        )
+        self.assertEqual(distinct_texts([ARTICLE, copy, other]), [ARTICLE, other])
+
+
+class FingerprintTest(unittest.TestCase):
+    def test_simhash_tolerates_small_edits(self):
+        self.assertTrue(is_near_duplicate(simhash(ARTICLE), simhash(ARTICLE.replace("два спутника", "2 спутника"))))
+
+    def test_normalize_url(self):
+        self.assertEqual(
+            normalize_url("https://www.example.com/news/index.html?utm_source=x&id=5#top"),
+            "example.com/news?id=5",
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from mood import MoodTracker, reshard
+
+NOW = 1_000_000.0
+
+
+class MoodTrackerTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.dir = directory.name
+        clock = mock.patch("mood.time.time", return_value=NOW)
+        clock.start()
+        self.addCleanup(clock.stop)
+
+    def tracker(self, name="mood.bin", **kwargs) -> MoodTracker:
+        return MoodTracker(os.path.join(self.dir, name), alpha=0.5, half_life=3600, **kwargs)
+
+    def test_moving_average(self):
+        tracker = self.tracker()
+        self.assertIsNone(tracker.user_mood(1))
+        # Новая запись начинается с нейтрального настроения
+        self.assertEqual(tracker.update(-100, 1, 1.0), (0.5, 0.5))
+        self.assertEqual(tracker.update(-100, 1, 1.0), (0.75, 0.75))
+        self.assertEqual(tracker.update(-100, 2, -1.0), (-0.5, -0.125))
+
+    def test_decays_between_messages(self):
+        tracker = self.tracker()
+        tracker.update(-100, 1, 1.0)
+        with mock.patch("mood.time.time", return_value=NOW + 3600):
+            self.assertAlmostEqual(tracker.user_mood(1), 0.25)
+
+    def test_round_trip(self):
+        tracker = self.tracker()
+        tracker.update(-100, 1, 1.0)
+        tracker.update(-200, 2, -1.0)
+        self.assertTrue(tracker.flush())
+        loaded = self.tracker()
+        self.assertEqual(loaded.user_moods(), {1: 0.5, 2: -0.5})
+        self.assertEqual(loaded.chat_moods(), {-100: 0.5, -200: -0.5})
+
+    def test_reshard_splits_chats_and_merges_users(self):
+        first, second = self.tracker("a.bin"), self.tracker("b.bin")
+        first.update(-100, 1, 1.0)
+        with mock.patch("mood.time.time", return_value=NOW + 10):
+            # Более свежая запись того же пользователя в другом процессе
+            second.update(-101, 1, -1.0)
+        first.flush()
+        second.flush()
+        targets = [os.path.join(self.dir, f"shard-{shard}.bin") for shard in range(2)]
+        reshard([first.storage_file, second.storage_file, os.path.join(self.dir, "missing.bin")],
+                targets, lambda chat_id: chat_id % 2)
+        even, odd = (MoodTracker(path, half_life=3600) for path in targets)
+        self.assertEqual(even.chat_moods(), {-100: 0.5})
+        self.assertEqual(odd.chat_moods(), {-101: -0.5})
+        with mock.patch("mood.time.time", return_value=NOW + 10):
+            self.assertEqual(even.user_moods(), {1: -0.5})
+            self.assertEqual(odd.user_moods(), {1: -0.5})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+import threading
+import time
+import unittest
+
+from telebot.apihelper import ApiTelegramException
+
+from outbox import OutboundScheduler
+
+CHAT_ID = 42
+# Ожидание результатов отправки в тестах, с
+TIMEOUT = 5.0
+
+
+def flood_error(retry_after: float) -> ApiTelegramException:
+    return ApiTelegramException("sendMessage", None, {
+        "ok": False, "error_code": 429, "description": "Too Many Requests",
+        "parameters": {"retry_after": retry_after},
+    })
+
+
+class FloodingBot:
+    """Отвечает 429 на первые `floods` попытки отправить текст `flooded`, остальные отправки записывает"""
+
+    def __init__(self, flooded: str, floods: int, retry_after: float = 0.2):
+        self.flooded = flooded
+        self.floods = floods
+        self.retry_after = retry_after
+        self.attempts = []
+        self._lock = threading.Lock()
+
+    def send_message(self, chat_id, text, **kwargs):
+        with self._lock:
+            self.attempts.append((text, time.monotonic()))
+            if text == self.flooded and self.floods:
+                self.floods -= 1
+                raise flood_error(self.retry_after)
+        return text
+
+
+class OutboundSchedulerTest(unittest.TestCase):
+    def scheduler(self, bot) -> OutboundScheduler:
+        # Лимиты чата не мешают: ожидание в тесте задает только retry_after
+        return OutboundScheduler(bot, bot_id=1, global_rate=1000, private_rate=1000)
+
+    def test_flood_retry_keeps_chat_order(self):
+        bot = FloodingBot("first", floods=1)
+        outbox = self.scheduler(bot)
+        futures = [outbox.send_message(CHAT_ID, text) for text in ("first", "second", "third")]
+
+        self.assertEqual([future.result(TIMEOUT) for future in futures], ["first", "second", "third"])
+        # Сообщение после 429 возвращается в начало очереди чата, а не в конец
+        self.assertEqual([text for text, _ in bot.attempts], ["first", "first", "second", "third"])
+        # и повторяется не раньше retry_after
+        self.assertGreaterEqual(bot.attempts[1][1] - bot.attempts[0][1], bot.retry_after - 0.05)
+
+    def test_other_chats_are_not_paused(self):
+        bot = FloodingBot("flooded", floods=1, retry_after=1.0)
+        outbox = self.scheduler(bot)
+        flooded = outbox.send_message(CHAT_ID, "flooded")
+        other = outbox.send_message(CHAT_ID + 1, "other")
+
+        self.assertEqual(other.result(TIMEOUT), "other")
+        self.assertFalse(flooded.done())
+        self.assertEqual(flooded.result(TIMEOUT), "flooded")
+
+    def test_gives_up_after_max_attempts(self):
+        bot = FloodingBot("first", floods=OutboundScheduler.MAX_ATTEMPTS, retry_after=0.01)
+        outbox = self.scheduler(bot)
+        failed = outbox.send_message(CHAT_ID, "first")
+        after = outbox.send_message(CHAT_ID, "second")
+
+        with self.assertRaises(ApiTelegramException):
+            failed.result(TIMEOUT)
+        self.assertEqual(after.result(TIMEOUT), "second")
+        self.assertEqual(len(bot.attempts), OutboundScheduler.MAX_ATTEMPTS + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+import os
+import tempfile
+import unittest
+
+from rate_limiter import RateLimiter
+from state_store import StateStore
+
+# Начало минутного интервала: время в тестах задается явно
+START = 600.0
+
+
+class RateLimiterTest(unittest.TestCase):
+    def limiters(self):
+        """Ограничитель в памяти и ограничитель с общим хранилищем должны вести себя одинаково"""
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        store = StateStore(os.path.join(directory.name, "state.db"))
+        self.addCleanup(store.close)
+        windows = [(60, 3), (86400, 5)]
+        return {"memory": RateLimiter(windows), "store": RateLimiter(windows, store=store, name="user")}
+
+    def test_hit_window_reports_exhausted_window(self):
+        for name, limiter in self.limiters().items():
+            with self.subTest(name):
+                for i in range(3):
+                    self.assertIsNone(limiter.hit_window(1, START + i))
+                self.assertEqual(limiter.hit_window(1, START + 3), (60, 3))
+                # Другой ключ считается отдельно
+                self.assertIsNone(limiter.hit_window(2, START + 3))
+
+    def test_rejected_hit_is_not_counted(self):
+        for name, limiter in self.limiters().items():
+            with self.subTest(name):
+                for i in range(3):
+                    limiter.hit_window(1, START + i)
+                for _ in range(10):
+                    self.assertEqual(limiter.hit_window(1, START + 3), (60, 3))
+                # Через 4 минуты (предыдущий интервал уже не учитывается) проходят еще 2 запроса
+                # до суточного лимита: отклоненные попытки его не расходуют
+                self.assertIsNone(limiter.hit_window(1, START + 240))
+                self.assertIsNone(limiter.hit_window(1, START + 241))
+                self.assertEqual(limiter.hit_window(1, START + 242), (86400, 5))
+
+    def test_retry_after_matches_next_allowed_hit(self):
+        for name, limiter in self.limiters().items():
+            with self.subTest(name):
+                self.assertEqual(limiter.retry_after(1, START), 0.0)
+                for i in range(3):
+                    limiter.hit_window(1, START + i)
+                # Текущий интервал заполнен: ждать начала следующего (57 с), а затем, пока вес
+                # предыдущего интервала (3 запроса) не опустится до 2 (еще 20 с)
+                wait = limiter.retry_after(1, START + 3)
+                self.assertAlmostEqual(wait, 77.0)
+                self.assertEqual(limiter.hit_window(1, START + 3 + wait - 1), (60, 3))
+                self.assertIsNone(limiter.hit_window(1, START + 3 + wait))
+
+    def test_release_undoes_hit(self):
+        for name, limiter in self.limiters().items():
+            with self.subTest(name):
+                for i in range(3):
+                    limiter.hit_window(1, START + i)
+                limiter.release(1, START + 2)
+                self.assertIsNone(limiter.hit_window(1, START + 3))
+                self.assertEqual(limiter.hit_window(1, START + 4), (60, 3))
+
+
+if __name__ == "__main__":
+    unittest.main()
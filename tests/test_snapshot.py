@@ -0,0 +1,91 @@
+import os
+import struct
+import tempfile
+import unittest
+
+from snapshot import (
+    MAGIC, VERSION, SnapshotError, SnapshotReader, encode_messages, reshard_snapshots, write_snapshot,
+)
+
+CONTEXTS = {
+    "-100:1": [{'text': "привет", 'timestamp': 10.0}, {'text': "как дела?", 'timestamp': 11.5}],
+    "-100:2": [{'text': "", 'timestamp': 12.0}],
+    "-101:1": [{'text': "длинный текст " * 50, 'timestamp': 13.25}],
+    "7:7": [{'text': "личный чат", 'timestamp': 14.0}],
+}
+
+
+def records(contexts):
+    return [(key, encode_messages(messages), messages[-1]['timestamp']) for key, messages in contexts.items()]
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.dir = directory.name
+        self.path = os.path.join(self.dir, "context_storage.bin")
+
+    def read_all(self, path):
+        reader = SnapshotReader(path)
+        try:
+            return {key: reader.read(slot) for key, slot in reader.slots().items()}
+        finally:
+            reader.close()
+
+    def test_round_trip(self):
+        self.assertEqual(write_snapshot(self.path, records(CONTEXTS)), len(CONTEXTS))
+        reader = SnapshotReader(self.path)
+        self.addCleanup(reader.close)
+        slots = reader.slots()
+        self.assertEqual(list(slots), list(CONTEXTS))
+        for key, messages in CONTEXTS.items():
+            self.assertEqual(reader.read(slots[key]), messages)
+            self.assertEqual(reader.last_timestamp(slots[key]), messages[-1]['timestamp'])
+
+    def test_empty_snapshot(self):
+        self.assertEqual(write_snapshot(self.path, []), 0)
+        self.assertEqual(self.read_all(self.path), {})
+
+    def test_copies_kept_slots_from_source(self):
+        write_snapshot(self.path, records(CONTEXTS))
+        source = SnapshotReader(self.path)
+        slots = source.slots()
+        # Несмежные слоты копируются несколькими участками, новые записи идут перед ними
+        keep = {key: slots[key] for key in ("-100:1", "-101:1", "7:7")}
+        changed = {"-100:2": [{'text': "новое", 'timestamp': 20.0}]}
+        target = os.path.join(self.dir, "next.bin")
+        self.assertEqual(write_snapshot(target, records(changed), source=source, keep=keep), 4)
+        source.close()
+        expected = dict(changed, **{key: CONTEXTS[key] for key in keep})
+        self.assertEqual(self.read_all(target), expected)
+
+    def test_rejects_other_version(self):
+        write_snapshot(self.path, records(CONTEXTS))
+        with open(self.path, 'r+b') as f:
+            f.seek(len(MAGIC))
+            f.write(struct.pack("<H", VERSION + 1))
+        with self.assertRaisesRegex(SnapshotError, "версия"):
+            SnapshotReader(self.path)
+
+    def test_rejects_foreign_and_truncated_files(self):
+        with open(self.path, 'wb') as f:
+            f.write(b"\x80\x04not a snapshot at all, just some pickle-like bytes")
+        with self.assertRaises(SnapshotError):
+            SnapshotReader(self.path)
+        write_snapshot(self.path, records(CONTEXTS))
+        with open(self.path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.path) - 40)
+        with self.assertRaises(SnapshotError):
+            SnapshotReader(self.path)
+
+    def test_reshard_moves_dialogs_by_chat(self):
+        write_snapshot(self.path, records(CONTEXTS))
+        targets = [os.path.join(self.dir, f"shard-{shard}.bin") for shard in range(2)]
+        self.assertEqual(reshard_snapshots([self.path], targets, lambda chat_id: chat_id % 2), len(CONTEXTS))
+        self.assertEqual(self.read_all(targets[0]), {key: CONTEXTS[key] for key in ("-100:1", "-100:2")})
+        self.assertEqual(self.read_all(targets[1]), {key: CONTEXTS[key] for key in ("-101:1", "7:7")})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,19 +1,33 @@
-import requests
 import os
+import tempfile
 from abc import ABC, abstractmethod
+from metrics import timed
+from lazy import lazy_import
+
+requests = lazy_import("requests")
 
 class VoiceGenerator(ABC):
     @abstractmethod
     def generate(self, text: str) -> str:
         pass
 
+    def synthesize(self, text: str) -> bytes:
+        """Озвучка в памяти; по умолчанию читает и удаляет файл, созданный generate()"""
+        path = self.generate(text)
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        finally:
+            os.remove(path)
+
 class ElevenLabsVoiceGenerator(VoiceGenerator):
     def __init__(self, api_key: str, voice_id: str):
         self.api_key = api_key
         self.voice_id = voice_id
         self.chunk_size = 1024
 
-    def generate(self, text: str) -> str:
+    @timed("tts")
+    def synthesize(self, text: str) -> bytes:
         url = f"https://api.elevenlabs.io/v1/text-to-speech/{self.voice_id}"
         headers = {
             "Accept": "audio/mpeg",
@@ -30,11 +44,13 @@ class ElevenLabsVoiceGenerator(VoiceGenerator):
         }
         
         response = requests.post(url, json=data, headers=headers)
-        output_file = 'a.mp3'
+        return b"".join(chunk for chunk in response.iter_content(chunk_size=self.chunk_size) if chunk)
+
+    def generate(self, text: str) -> str:
+        # Отдельный файл на каждый вызов: общий 'a.mp3' перезаписывался параллельными запросами
+        fd, output_file = tempfile.mkstemp(suffix=".mp3")
         
-        with open(output_file, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=self.chunk_size):
-                if chunk:
-                    f.write(chunk)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.synthesize(text))
         
-        return output_file
\ No newline at end of file
+        return output_file
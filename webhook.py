@@ -0,0 +1,213 @@
+import asyncio
+import hmac
+import json
+import sys
+import threading
+import urllib.request
+from typing import Callable, Dict, Hashable, Optional, Tuple
+
+from metrics import counter, gauge
+from logger import get_logger
+from keyed_executor import KeyedExecutor
+from sharding import chat_id_of
+
+log = get_logger("ami.webhook")
+
+
+class _RequestError(Exception):
+    """Запрос нельзя прочитать; соединение закрывается после ответа с этим кодом"""
+
+    def __init__(self, status: int, reason: str):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+
+
+class WebhookServer:
+    """
+    Встроенный асинхронный HTTP-сервер для приема обновлений Telegram через webhook.
+
+    Проверяет заголовок X-Telegram-Bot-Api-Secret-Token, сразу отвечает 200
+    и передает разобранное обновление в пул потоков обработки.
+    Обновления с одним ключом (по умолчанию - чат) обрабатываются по одному
+    в порядке поступления, разные чаты - параллельно; порядок обработки сохраняется,
+    только если process_update сам обрабатывает обновление, а не ставит его в другую
+    очередь (например, TeleBot должен быть создан с threaded=False).
+    При переполнении очереди отвечает 503, и Telegram повторит доставку позже.
+    """
+
+    MAX_BODY_SIZE = 1024 * 1024
+    SECRET_HEADER = "x-telegram-bot-api-secret-token"
+
+    def __init__(self, process_update: Callable[[dict], None], secret_token: Optional[str] = None,
+                 host: str = "0.0.0.0", port: int = 8443, path: str = "/webhook",
+                 workers: int = 4, max_pending: int = 1000,
+                 key: Callable[[dict], Optional[Hashable]] = chat_id_of):
+        self.process_update = process_update
+        self.key = key
+        self.secret_token = secret_token
+        self.host = host
+        self.port = port
+        self.path = path
+        self.max_pending = max_pending
+        self._executor = KeyedExecutor(workers, thread_name_prefix="webhook")
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._requests = counter("ami_webhook_requests_total", "Запросы к webhook по коду ответа", ("status",))
+        gauge("ami_webhook_pending_updates", "Принятые, но не обработанные обновления", fn=lambda: self._pending)
+
+    @property
+    def pending(self) -> int:
+        """Число обновлений, принятых, но еще не обработанных"""
+        return self._pending
+
+    def _run_update(self, update: dict) -> None:
+        try:
+            self.process_update(update)
+        except Exception as e:
+            log.exception("webhook_update_failed", error=e)
+        finally:
+            with self._pending_lock:
+                self._pending -= 1
+
+    def _dispatch(self, update: dict) -> bool:
+        key = self.key(update)
+        with self._pending_lock:
+            if self._pending >= self.max_pending:
+                return False
+            self._pending += 1
+        self._executor.submit(key, lambda: self._run_update(update))
+        return True
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Optional[Tuple[str, str, Dict[str, str], bytes]]:
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            return None
+
+        lines = head.decode("latin-1").split("\r\n")
+        parts = lines[0].split(" ")
+        if len(parts) < 2:
+            return None
+        method, target = parts[0], parts[1]
+
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+
+        try:
+            length = int(headers.get("content-length", "0") or 0)
+        except ValueError:
+            raise _RequestError(400, "Bad Request")
+        if length < 0:
+            raise _RequestError(400, "Bad Request")
+        if length > self.MAX_BODY_SIZE:
+            # Тело не читается, поэтому соединение дальше использовать нельзя
+            raise _RequestError(413, "Payload Too Large")
+        body = await reader.readexactly(length) if length else b""
+        return method, target, headers, body
+
+    @staticmethod
+    def _response(status: int, reason: str, keep_alive: bool) -> bytes:
+        connection = "keep-alive" if keep_alive else "close"
+        return (
+            f"HTTP/1.1 {status} {reason}\r\n"
+            f"Content-Length: 0\r\nConnection: {connection}\r\n\r\n"
+        ).encode("latin-1")
+
+    def _handle(self, method: str, target: str, headers: Dict[str, str], body: bytes) -> Tuple[int, str]:
+        if target.split("?", 1)[0] != self.path:
+            return 404, "Not Found"
+        if method != "POST":
+            return 405, "Method Not Allowed"
+        if self.secret_token and not hmac.compare_digest(
+            headers.get(self.SECRET_HEADER, ""), self.secret_token
+        ):
+            return 403, "Forbidden"
+        if not body:
+            return 400, "Bad Request"
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return 400, "Bad Request"
+        # Обновление Telegram - всегда JSON-объект
+        if not isinstance(update, dict):
+            return 400, "Bad Request"
+        if not self._dispatch(update):
+            return 503, "Service Unavailable"
+        return 200, "OK"
+
+    async def _on_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader)
+                except _RequestError as e:
+                    self._requests.labels(e.status).inc()
+                    writer.write(self._response(e.status, e.reason, keep_alive=False))
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                method, target, headers, body = request
+                try:
+                    status, reason = self._handle(method, target, headers, body)
+                except Exception as e:
+                    log.warning("webhook_request_failed", error=e)
+                    status, reason = 400, "Bad Request"
+                self._requests.labels(status).inc()
+                keep_alive = headers.get("connection", "").lower() != "close"
+                writer.write(self._response(status, reason, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _serve(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._server = await asyncio.start_server(self._on_connection, self.host, self.port)
+        log.info("webhook_listening", host=self.host, port=self.port, path=self.path)
+        async with self._server:
+            try:
+                await self._server.serve_forever()
+            except asyncio.CancelledError:
+                pass
+
+    def serve_forever(self) -> None:
+        """Запускает сервер в текущем потоке до вызова stop()"""
+        asyncio.run(self._serve())
+
+    def stop(self) -> None:
+        """Прекращает прием соединений (можно вызывать из другого потока)"""
+        if self._loop and self._server:
+            self._loop.call_soon_threadsafe(self._server.close)
+
+
+def post_updates(path: str, url: str = "http://127.0.0.1:8443/webhook", secret_token: Optional[str] = None) -> None:
+    """Отправляет записанные обновления (JSON-объект или список) на webhook для локальной проверки"""
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    updates = data if isinstance(data, list) else [data]
+
+    for update in updates:
+        request = urllib.request.Request(url, data=json.dumps(update).encode("utf-8"), method="POST")
+        request.add_header("Content-Type", "application/json")
+        if secret_token:
+            request.add_header("X-Telegram-Bot-Api-Secret-Token", secret_token)
+        with urllib.request.urlopen(request, timeout=10) as response:
+            print(f"update {update.get('update_id')}: {response.status}")
+
+
+if __name__ == "__main__":
+    # Пример: python webhook.py updates.json http://127.0.0.1:8443/webhook secret
+    if len(sys.argv) < 2:
+        print("Использование: python webhook.py <updates.json> [url] [secret_token]")
+        sys.exit(1)
+    post_updates(*sys.argv[1:4])